@@ -1,10 +1,11 @@
 import dataclasses
+import json
 import logging
 import os
 import shutil
 import sys
 from pathlib import Path
-from typing import List
+from typing import Callable, List, Optional
 
 import hyperqueue
 import typer
@@ -13,28 +14,46 @@ from hyperqueue.task.function import PythonEnv
 from hyperqueue.task.task import Task
 from hyperqueue.visualization import visualize_job
 
-from ligate.awh.common import Complex, Ligand
-from ligate.awh.ligen.common import LigenTaskContext
+from ligate.awh.common import Complex, ComplexOrLigand, Ligand
+from ligate.awh.ligen.cache import ScreeningCacheConfig
+from ligate.awh.ligen.calibration import ThreadLayout, load_thread_layout
+from ligate.awh.ligen.common import FileMappingMode, LigenTaskContext
+from ligate.awh.ligen.prefilter import LigandFilterRules
+from ligate.awh.ligen.smi import LigandCostModel
+from ligate.awh.ligen.telemetry import (
+    aggregate_telemetry, format_telemetry_report, read_telemetry_records,
+)
+from ligate.awh.ligen.virtual_screening import ScreeningTarget
 # from ligate.awh.pipeline.awh import AWHParams, run_awh_until_convergence
-from ligate.awh.pipeline.common import ComplexOrLigandTask, construct_edge_set_from_dir
-from ligate.awh.pipeline.docking import (
-    DockingPipelineConfig, SubmittedDockingPipeline, hq_submit_ligen_docking_workflow,
+from ligate.awh.pipeline.calibration import (
+    CalibrationPipelineConfig, hq_submit_ligen_calibration,
 )
+from ligate.awh.pipeline.common import construct_edge_set_from_dir
+from ligate.awh.pipeline.create_hybrid_ligands import CreateHybridLigandsParams
+from ligate.awh.pipeline.create_hybrid_ligands.tasks import hq_submit_hybrid_ligands
 from ligate.awh.pipeline.equilibrate import EquilibrateParams, prepare_equilibrate
 from ligate.awh.pipeline.equilibrate.tasks import hq_submit_equilibrate
-from ligate.awh.pipeline.hq import HqCtx
+from ligate.awh.pipeline.funnel import (
+    ScreeningFunnelConfig, SubmittedScreeningFunnel, hq_submit_screening_funnel,
+)
+from ligate.awh.pipeline.hq import HqCtx, TaskBatcher
+from ligate.awh.pipeline.ledger import (
+    IncrementalStages, ItemState, StageEntry, StageLedger, hash_tree, stage_fingerprint,
+    sync_input_items, tree_content_hash,
+)
 from ligate.awh.pipeline.minimization import MinimizationParams
 from ligate.awh.pipeline.minimization.tasks import hq_submit_minimization
 from ligate.awh.pipeline.prepare_production_simulation import PrepareProductionSimulationParams
 from ligate.awh.pipeline.prepare_production_simulation.tasks import \
     hq_submit_prepare_production_simulation
-from ligate.awh.pipeline.select_ligands import LigandSelectionConfig, hq_submit_select_ligands
-from ligate.awh.pipeline.virtual_screening import (
-    VirtualScreeningPipelineConfig,
-    hq_submit_ligen_virtual_screening_workflow,
+from ligate.awh.pipeline.priority import (
+    TaskDurationModel, assign_critical_path_priorities, trace_task_durations,
 )
+from ligate.awh.pipeline.resources import CoreScalingModel
+from ligate.awh.pipeline.virtual_screening import VirtualScreeningPipelineConfig
 from ligate.utils.io import check_file_exists, delete_path, ensure_directory
 from ligate.utils.serde import deserialize_yaml
+from ligate.utils.snapshot import snapshot_directory
 from ligate.wrapper.gromacs import Gromacs
 
 app = typer.Typer()
@@ -45,164 +64,221 @@ class LigenWorkflowData:
     protein_pdb: Path
     probe_mol2: Path
     smi: Path
+    # Other proteins that the ligands are screened against, together with `protein_pdb`
+    additional_targets: List[ScreeningTarget] = dataclasses.field(default_factory=list)
 
 
 @dataclasses.dataclass
 class LigenWorkfowParams:
     data: LigenWorkflowData
     max_molecules_per_smi: int = 10
+    # Balance the SMI shards by the estimated cost of their ligands instead of by line count
+    balance_shards: bool = True
+    # Expand and screen each shard in a single task, without storing expanded MOL2 files
+    fuse_expansion: bool = False
+    # Only screen a single copy of ligands with the same canonical SMILES
+    deduplicate: bool = False
+    # Only screen ligands that satisfy these physicochemical rules
+    prefilter: Optional[LigandFilterRules] = None
+    # Compress intermediate expanded ligands and scores ("gzip" or "zstd")
+    compression: Optional[str] = None
+    # Quarantine ligands that crash LiGen instead of failing their whole shard
+    bisect_failures: bool = False
+    # Prepare the pocket of each protein once, instead of in every screening and docking task
+    prepare_targets: bool = False
+    # Reuse scores of ligands screened by previous campaigns, stored in this SQLite database
+    screening_cache: Optional[Path] = None
+    # Maximum number of cores of a single LiGen task evaluated by calibration
+    calibration_max_cores: int = 8
+    # Rescore this fraction of the best screened ligands with D23RTMB before docking
+    rescore_fraction: Optional[float] = None
+    # Number of best ligands that are docked
+    dock_ligands: int = 10
 
 
 def ligen_workflow(
         job: Job,
         params: LigenWorkfowParams,
         ligen_ctx: LigenTaskContext,
-        dock: bool
-) -> SubmittedDockingPipeline:
+        dock: bool,
+        thread_layout: Optional[ThreadLayout] = None,
+        resume: bool = False,
+) -> SubmittedScreeningFunnel:
     """
-    Checks the input protein, performs virtual screening and docking of the most
-    promising ligands.
+    Checks the input protein, performs virtual screening, (optionally) rescoring and docking of the
+    most promising ligands.
     """
     ensure_directory(ligen_ctx.workdir)
 
     # Perform virtual screening. Expand SMI into MOL2, and generate a CSV with scores for each
     # ligand in the input SMI file.
+    screening_cache = None
+    if params.screening_cache is not None:
+        screening_cache = ScreeningCacheConfig(path=params.screening_cache.absolute())
     screening_config = VirtualScreeningPipelineConfig(
         input_smi=params.data.smi,
         input_probe_mol2=params.data.probe_mol2,
         input_protein=params.data.protein_pdb,
+        additional_targets=params.data.additional_targets,
         max_molecules_per_smi=params.max_molecules_per_smi,
+        cost_model=LigandCostModel() if params.balance_shards else None,
+        fuse_expansion=params.fuse_expansion,
+        compression=params.compression,
+        bisect_failures=params.bisect_failures,
+        prepare_targets=params.prepare_targets,
+        deduplicate=params.deduplicate,
+        prefilter=params.prefilter,
+        cache=screening_cache,
+        thread_layout=thread_layout,
+        resume=resume,
     )
-    output = hq_submit_ligen_virtual_screening_workflow(
-        ligen_ctx,
-        ligen_ctx.workdir / "vscreening",
-        config=screening_config,
-        job=job,
-        deps=[]
-        # deps=[task],
+    # Rescore the best fraction of the screened ligands, then select the best N ligands and dock
+    # them.
+    funnel_config = ScreeningFunnelConfig(
+        screening=screening_config,
+        rescore_fraction=params.rescore_fraction,
+        dock_count=params.dock_ligands if dock else None,
+    )
+    return hq_submit_screening_funnel(
+        ligen_ctx, ligen_ctx.workdir, config=funnel_config, job=job, deps=[]
     )
-
-    # Select best N ligands based on the assigned scores, and generate a new SMI file with the
-    # best ligands.
-    if dock:
-        best_ligands_smi = ligen_ctx.workdir / "selected-ligands.smi"
-        selection_config = LigandSelectionConfig(
-            input_smi=screening_config.input_smi,
-            scores_csv=output.output_scores_csv,
-            output_smi=best_ligands_smi,
-            n_ligands=10,
-        )
-        select_task = hq_submit_select_ligands(selection_config, job, output.tasks)
-    
-        # Dock the best ligands.
-        docking_config = DockingPipelineConfig(
-            input_smi=best_ligands_smi,
-            input_probe_mol2=params.data.probe_mol2,
-            input_protein=params.data.protein_pdb,
-        )
-        return hq_submit_ligen_docking_workflow(
-            ligen_ctx, ligen_ctx.workdir / "docking", docking_config, job, deps=[select_task]
-        )
 
 
 def awh_workflow(
         input_dir: Path,
         workdir: Path,
+        run_job: Callable[[Job], None],
 ) -> Job:
+    """
+    Builds the AWH workflow incrementally. Each stage records the hashes of its inputs and outputs
+    for each pose in a stage ledger (see `StageLedger`), and poses whose stage inputs have not
+    changed since a previous run in `workdir` are not submitted again.
+    """
     gmx = Gromacs("installed/gromacs/bin/gmx")
 
     reference_dir = ensure_directory("workdir-reference")
+    ledger = StageLedger(workdir / "ledger")
 
-    def snapshot_dir(dir: Path, name: str):
+    def snapshot_dir(dir: Path, name: str, previous: Optional[str] = None):
+        # Snapshots share the object store of the ledger, so unchanged files are stored only once.
+        # Without a previous snapshot, the files are compared with the last snapshot of this name.
         target = reference_dir / name
-        if target.is_dir():
-            delete_path(target)
-        shutil.copytree(dir, reference_dir / name)
-
-    def snapshot_task(job: Job, dir: Path, name: str, tasks: List[Task]) -> Task:
-        return job.function(lambda: snapshot_dir(dir, name), deps=tasks, name=f"snapshot-{name}")
-
-    def ref_dir(name: str) -> Path:
-        return reference_dir / name
-
-    # Copy the original input directory
-    snapshot_dir(input_dir, "after-gromacs-ligen-integration")
+        snapshot_directory(
+            dir, target, ledger.objects, previous=reference_dir / (previous or name)
+        )
 
-    # start_step = "after-gromacs-ligen-integration"
-    start_step = "after-hybrid-ligands"
-    # start_step = "after-minimization"
-    # start_step = "after-prepare-equilibrate"
-    # start_step = "after-equilibrate"
-    # start_step = "after-prepare-production-simulation"
-    actual_input_dir = workdir / "cadd"
-    shutil.copytree(ref_dir(start_step), actual_input_dir)
+    def snapshot_task(
+        job: Job, dir: Path, name: str, tasks: List[Task], previous: Optional[str] = None
+    ) -> Task:
+        return job.function(
+            snapshot_dir, args=(dir, name, previous), deps=tasks, name=f"snapshot-{name}"
+        )
 
     hq_workdir = workdir / "hq"
 
-    # First job
-    # job = create_job(hq_workdir)
-    # hq_ctx = HqCtx(job=job)
-    # dep = hq_submit_hybrid_ligands(
-    #     CreateHybridLigandsParams(directory=actual_input_dir, cores=8),
-    #     hq=hq_ctx
-    # )
-    # snapshot_task(job, actual_input_dir, "after-hybrid-ligands", [dep])
-    # run_hq_job(job, local_cluster=True)
-
-    # Second job
+    # Hybrid ligands are created by a separate job, because the edges and poses that the rest of
+    # the workflow consists of are only known once they are created
+    if not construct_edge_set_from_dir(input_dir).edges:
+        snapshot_dir(input_dir, "after-gromacs-ligen-integration")
+        hybrid_dir = workdir / "hybrid-ligands"
+        fingerprint = stage_fingerprint(
+            "hybrid-ligands", None, [tree_content_hash(hash_tree(input_dir))]
+        )
+        entry = ledger.load("hybrid-ligands", "all")
+        if entry is None or entry.fingerprint != fingerprint or not hybrid_dir.is_dir():
+            delete_path(hybrid_dir)
+            shutil.copytree(input_dir, hybrid_dir)
+            job = create_job(hq_workdir)
+            hq_submit_hybrid_ligands(
+                CreateHybridLigandsParams(directory=hybrid_dir, cores=8), hq=HqCtx(job=job)
+            )
+            run_job(job)
+            ledger.store(
+                StageEntry(stage="hybrid-ligands", item="all", fingerprint=fingerprint, outputs={})
+            )
+        input_dir = hybrid_dir
+    snapshot_dir(input_dir, "after-hybrid-ligands")
+
+    actual_input_dir = ensure_directory(workdir / "cadd")
+    edge_set = construct_edge_set_from_dir(input_dir)
+    items = sync_input_items(ledger, input_dir, actual_input_dir, edge_set)
+
     job = create_job(hq_workdir)
-    hq_ctx = HqCtx(job=job)
-
-    # Construct the initial task item for a ligand and complex in each pose
-    edge_set = construct_edge_set_from_dir(actual_input_dir)
-    tasks: List[ComplexOrLigandTask] = []
-    for (edge, pose) in edge_set.iterate_poses():
-        for item in (Complex, Ligand):
-            tasks.append(ComplexOrLigandTask(
-                edge=edge,
-                pose=pose,
-                item=item(edge.pose_dir(pose)),
-            ))
+    hq_ctx = HqCtx(job=job, batcher=TaskBatcher(job, report_dir=workdir / "batches"))
+    stages = IncrementalStages(ledger, job, items)
+
+    def submit_legs(
+        submit: Callable[[ComplexOrLigand, HqCtx], Task]
+    ) -> Callable[[ItemState], List[Task]]:
+        """
+        Submits a task for the ligand and the complex of a pose.
+        """
+        def submit_item(state: ItemState) -> List[Task]:
+            return [
+                submit(item(state.directory), hq_ctx.with_deps(state.deps))
+                for item in (Complex, Ligand)
+            ]
+        return submit_item
+
+    snapshots: List[str] = []
+
+    def snapshot_stage(name: str):
+        """
+        Snapshots the working directory once all submitted tasks of the previous stage finish.
+        The following stage starts after the snapshot.
+        """
+        deps = list(dict.fromkeys(dep for state in items for dep in state.deps))
+        previous = snapshots[-1] if snapshots else None
+        snapshot = snapshot_task(job, actual_input_dir, name, deps, previous=previous)
+        snapshots.append(name)
+        for state in items:
+            state.deps = [snapshot]
 
     mode = "minimize"
+    # Ligand legs are much smaller than complex legs, so they get fewer cores
+    core_scaling = CoreScalingModel()
 
     # Minimization
     if mode == "minimize":
-        minimization_params = MinimizationParams(steps=10, cores=4)
-        for task in tasks:
-            task.task = hq_submit_minimization(task.item, params=minimization_params, gmx=gmx,
-                                               hq=hq_ctx.with_dep(task.task))
-        dep = snapshot_task(job, actual_input_dir, "after-minimization", [t.task for t in tasks])
+        minimization_params = MinimizationParams(steps=10, cores=4, scaling=core_scaling)
+        stages.submit_per_item("minimization", minimization_params, submit_legs(
+            lambda item, hq: hq_submit_minimization(
+                item, params=minimization_params, gmx=gmx, hq=hq
+            )
+        ))
+        snapshot_stage("after-minimization")
 
         # Prepare equilibration
-        equilibrate_params = EquilibrateParams(steps=10, cores=4)
-        dep = job.function(
+        equilibrate_params = EquilibrateParams(steps=10, cores=4, scaling=core_scaling)
+        stages.submit_shared("prepare-equilibrate", equilibrate_params, lambda deps: job.function(
             prepare_equilibrate,
             args=(actual_input_dir, equilibrate_params, gmx),
             name="prepare-equilibrate",
-            deps=[dep]
-        )
-        dep = snapshot_task(job, actual_input_dir, "after-prepare-equilibrate", [dep])
+            deps=deps
+        ))
+        snapshot_stage("after-prepare-equilibrate")
 
         # Equilibration
-        for task in tasks:
-            task.task = hq_submit_equilibrate(task.item, params=equilibrate_params, gmx=gmx,
-                                              hq=hq_ctx.with_dep(dep))
-        dep = snapshot_task(job, actual_input_dir, "after-equilibrate", [t.task for t in tasks])
+        stages.submit_per_item("equilibrate", equilibrate_params, submit_legs(
+            lambda item, hq: hq_submit_equilibrate(
+                item, params=equilibrate_params, gmx=gmx, hq=hq
+            )
+        ))
+        snapshot_stage("after-equilibrate")
 
         # Prepare production simulation
         production_params = PrepareProductionSimulationParams(steps=50)
-        for task in tasks:
-            task.task = hq_submit_prepare_production_simulation(
-                task.item, params=production_params, gmx=gmx,
-                hq=hq_ctx.with_dep(dep))
-        dep = snapshot_task(job, actual_input_dir, "after-prepare-production-simulation",
-                            [t.task for t in tasks])
+        stages.submit_per_item("prepare-production-simulation", production_params, submit_legs(
+            lambda item, hq: hq_submit_prepare_production_simulation(
+                item, params=production_params, gmx=gmx, hq=hq
+            )
+        ))
+        snapshot_stage("after-prepare-production-simulation")
     elif mode == "awh":
         awh_params = AWHParams(
             cores=8
         )
-        dep = snapshot_task(actual_input_dir, "after-prepare-production-simulation", [dep])
+        snapshot_stage("after-prepare-production-simulation")
         # awh_params = AWHParams(
         #     cores=8
         # )
@@ -216,6 +292,7 @@ def awh_workflow(
             # break
     else:
         assert False
+    stages.finish()
     return job
 
 
@@ -224,17 +301,37 @@ def load_ligen_params(path: Path) -> LigenWorkfowParams:
     check_file_exists(params.data.protein_pdb)
     check_file_exists(params.data.probe_mol2)
     check_file_exists(params.data.smi)
-    return LigenWorkfowParams(
+    for target in params.data.additional_targets:
+        check_file_exists(target.protein_pdb)
+        check_file_exists(target.probe_mol2)
+    return dataclasses.replace(
+        params,
         data=LigenWorkflowData(
             protein_pdb=params.data.protein_pdb.resolve(),
             probe_mol2=params.data.probe_mol2.resolve(),
             smi=params.data.smi.resolve(),
+            additional_targets=[
+                dataclasses.replace(
+                    target,
+                    protein_pdb=target.protein_pdb.resolve(),
+                    probe_mol2=target.probe_mol2.resolve(),
+                )
+                for target in params.data.additional_targets
+            ],
         ),
-        max_molecules_per_smi=params.max_molecules_per_smi
     )
 
 
-def run_hq_job(job: Job, local_cluster: bool = False):
+def run_hq_job(job: Job, local_cluster: bool = False, trace_dir: Optional[Path] = None):
+    """
+    Submits `job` and waits until it finishes.
+    If `trace_dir` is set, the tasks are prioritized by their critical path, estimated from the
+    task durations recorded there by previous runs, and their durations are recorded again.
+    """
+    if trace_dir is not None:
+        assign_critical_path_priorities(job, TaskDurationModel.from_traces(trace_dir))
+        trace_task_durations(job, trace_dir)
+
     env = PythonEnv(
         prologue=f"""export PYTHONPATH=$PYTHONPATH:{os.getcwd()}""",
         python_bin=sys.executable
@@ -253,6 +350,12 @@ def run_hq_job(job: Job, local_cluster: bool = False):
         run(Client(server_dir=os.environ.get("HQ_SERVER_DIR"), python_env=env))
 
 
+def default_trace_dir(workdir: Path) -> Path:
+    # Traces are stored next to the working directory, because it is cleared by each new run, while
+    # the traces should be used by the following runs
+    return workdir.parent / f"{workdir.name}-traces"
+
+
 def create_job(workdir) -> Job:
     return Job(default_workdir=workdir, default_env=dict(HQ_PYLOG="DEBUG"))
 
@@ -264,35 +367,91 @@ def ligen(
         ligen_container: Path,
         dock: bool = False,
         local_cluster: bool = False,
+        persistent_session: bool = False,
+        bind_files: bool = False,
+        calibrate: bool = False,
+        resume: bool = False,
+        stage_inputs: bool = False,
+        trace_dir: Optional[Path] = None,
 ):
-    workdir = ensure_directory(workdir, clear=True)
+    # When resuming, screening shards completed by a previous run in `workdir` are not recomputed
+    workdir = ensure_directory(workdir, clear=not resume)
+    trace_dir = ensure_directory(trace_dir or default_trace_dir(workdir))
     job = create_job(workdir / "hq")
 
     ligen_ctx = LigenTaskContext(
         workdir=workdir,
-        container_path=ligen_container.resolve()
+        container_path=ligen_container.resolve(),
+        persistent_session=persistent_session,
+        file_mapping=FileMappingMode.Bind if bind_files else FileMappingMode.Copy,
+        stage_shared_inputs=stage_inputs,
+        telemetry_dir=workdir / "telemetry",
     )
     params = load_ligen_params(params)
 
+    thread_layout = None
+    if calibrate:
+        # Find out the best threading settings on a sample of the ligands before submitting
+        # the rest of the workflow
+        calibration_job = create_job(workdir / "hq-calibration")
+        calibration = hq_submit_ligen_calibration(
+            dataclasses.replace(ligen_ctx, telemetry_dir=workdir / "calibration" / "telemetry"),
+            workdir / "calibration",
+            CalibrationPipelineConfig(
+                input_smi=params.data.smi,
+                input_probe_mol2=params.data.probe_mol2,
+                input_protein=params.data.protein_pdb,
+                max_cores=params.calibration_max_cores,
+            ),
+            calibration_job,
+            deps=[],
+        )
+        run_hq_job(calibration_job, local_cluster=local_cluster)
+        thread_layout = load_thread_layout(calibration.output_layout_json)
+        logging.info(f"Using calibrated thread layout {thread_layout}")
+
     ligen_workflow(
         job,
         params=params,
         ligen_ctx=ligen_ctx,
-        dock=dock
+        dock=dock,
+        thread_layout=thread_layout,
+        resume=resume,
     )
 
     visualize_job(job, "job.dot")
 
-    run_hq_job(job, local_cluster=local_cluster)
+    run_hq_job(job, local_cluster=local_cluster, trace_dir=trace_dir)
+
+
+@app.command()
+def ligen_telemetry(workdir: Path, json_output: Optional[Path] = None):
+    """
+    Aggregates the per-shard timings recorded by the LiGen tasks of a campaign in `workdir` into
+    a throughput and overhead report.
+    """
+    paths = sorted((workdir / "telemetry").glob("*.jsonl"))
+    if not paths:
+        raise Exception(f"No telemetry records found in {workdir / 'telemetry'}")
+    summaries = aggregate_telemetry(read_telemetry_records(paths))
+    print(format_telemetry_report(summaries))
+    if json_output is not None:
+        with open(json_output, "w") as f:
+            json.dump([summary.to_dict() for summary in summaries], f, indent=2)
 
 
 @app.command()
-def awh():
-    workdir = ensure_directory(Path("workdir"), clear=True)
+def awh(clear: bool = False):
+    # Poses whose stages were already computed by a previous run in `workdir` are skipped
+    workdir = ensure_directory(Path("workdir"), clear=clear)
+    trace_dir = default_trace_dir(workdir)
 
     job = awh_workflow(Path(
         "backup/ligate-workflows/referenceData/02_refOut_GROMACS_LiGen_integration").resolve(),
-                       workdir)
+                       workdir,
+                       run_job=lambda job: run_hq_job(
+                           job, local_cluster=True, trace_dir=trace_dir
+                       ))
     # awh_workflow(job, Path("data/mcl1/02_refOut_GROMACS_LiGen_integration").absolute(), workdir)
     # awh_workflow(job, Path(
     #     "backup/ligate-workflows/referenceData-mcl1/03_refOut_createHybridLigands").resolve(),
@@ -300,7 +459,7 @@ def awh():
 
     visualize_job(job, "job.dot")
 
-    run_hq_job(job, local_cluster=True)
+    run_hq_job(job, local_cluster=True, trace_dir=trace_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+import csv
+import itertools
+import logging
+import math
+import tempfile
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+from ...utils.io import atomic_output, open_compressed, uncompressed_name
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MOL2_MOLECULE_HEADER = b"@<TRIPOS>MOLECULE"
+
+
+# Maximum number of ligands that are isolated in a single shard. Isolating a ligand costs about
+# 2 * log2(N) runs of LiGen, where N is the number of ligands in the shard.
+MAX_REJECTED_LIGANDS = 4
+
+
+class BisectionAborted(Exception):
+    """
+    Bisection was stopped, because the failure does not seem to be caused by individual ligands.
+    """
+
+
+def bisection_run_limit(records: int) -> int:
+    return 2 * max(math.ceil(math.log2(max(records, 2))), 1) * MAX_REJECTED_LIGANDS
+
+
+def bisect_failures(
+    records: List[bytes], run: Callable[[List[bytes]], T], max_runs: Optional[int] = None
+) -> Tuple[List[T], List[bytes]]:
+    """
+    Isolates records (ligands) that make `run` fail, after `run` has already failed for all
+    `records`.
+
+    The records are recursively split into halves, and `run` is executed separately for each half,
+    until each failing part contains only a single record. Such records are rejected.
+    Returns the results of successful runs (in the order of their records) and the rejected
+    records.
+
+    Raises `BisectionAborted` if `run` would be executed more than `max_runs` times. A failure
+    that is not caused by individual records (e.g. the container cannot be started or it runs out
+    of memory) makes every part fail, so it exhausts the limit quickly.
+    """
+    results: List[Tuple[int, T]] = []
+    rejected: List[Tuple[int, bytes]] = []
+    runs = 0
+
+    def attempt(half: List[bytes]) -> T:
+        nonlocal runs
+        if max_runs is not None and runs >= max_runs:
+            raise BisectionAborted(f"Bisection has exceeded the limit of {max_runs} run(s)")
+        runs += 1
+        return run(half)
+
+    def bisect(part: List[bytes], offset: int):
+        middle = len(part) // 2
+        failed = []
+        for (start, half) in ((offset, part[:middle]), (offset + middle, part[middle:])):
+            if not half:
+                continue
+            try:
+                results.append((start, attempt(half)))
+            except BisectionAborted:
+                raise
+            except Exception as error:
+                failed.append((start, half, error))
+        for (start, half, error) in failed:
+            if len(half) == 1:
+                logger.warning(f"Rejecting a ligand that makes LiGen fail: {error}")
+                rejected.append((start, half[0]))
+            else:
+                bisect(half, start)
+
+    if len(records) == 1:
+        return ([], list(records))
+    bisect(records, 0)
+    return (
+        [result for (_, result) in sorted(results, key=lambda item: item[0])],
+        [record for (_, record) in sorted(rejected, key=lambda item: item[0])],
+    )
+
+
+def read_smi_records(path: Path) -> List[bytes]:
+    with open_compressed(path, "rb") as f:
+        return [line if line.endswith(b"\n") else line + b"\n" for line in f if line.strip()]
+
+
+def read_mol2_records(path: Path) -> List[bytes]:
+    """
+    Splits a MOL2 file into records, each record contains a single molecule.
+    """
+    records = []
+    current = []
+    with open_compressed(path, "rb") as f:
+        for line in f:
+            if line.startswith(MOL2_MOLECULE_HEADER) and current:
+                records.append(b"".join(current))
+                current = []
+            current.append(line)
+    if current:
+        records.append(b"".join(current))
+    return records
+
+
+def write_records(path: Path, records: List[bytes]):
+    with atomic_output(path) as output, open_compressed(output, "wb") as f:
+        f.writelines(records)
+
+
+def concatenate_files(inputs: List[Path], output: Path):
+    with atomic_output(output) as output_path, open_compressed(output_path, "wb") as f:
+        for path in inputs:
+            with open_compressed(path, "rb") as input:
+                for line in input:
+                    f.write(line if line.endswith(b"\n") else line + b"\n")
+
+
+def concatenate_csvs(inputs: List[Path], output: Path):
+    """
+    Concatenates CSV files with the same header, the header is written only once.
+    """
+    header_written = False
+    with atomic_output(output) as output_path:
+        with open_compressed(output_path, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            for path in inputs:
+                with open_compressed(path, "r", newline="") as input:
+                    reader = csv.reader(input)
+                    header = next(reader, None)
+                    if header is None:
+                        continue
+                    if not header_written:
+                        writer.writerow(header)
+                        header_written = True
+                    writer.writerows(row for row in reader if row)
+
+
+def run_with_bisection(
+    run: Callable[[Path, Path], None],
+    input: Path,
+    output: Path,
+    read_records: Callable[[Path], List[bytes]],
+    merge: Callable[[List[Path], Path], None],
+    rejects: Optional[Path],
+):
+    """
+    Runs `run(input, output)`. If it fails and `rejects` is set, the ligands (records) of `input`
+    are bisected (see `bisect_failures`) to isolate the ligands that make `run` fail. Outputs of
+    the successful parts are merged into `output`, and the failing ligands are quarantined into
+    `rejects`, so that all other ligands of the shard are still processed.
+
+    The bisection runs inside the task of the shard, because the HQ task graph is static and
+    tasks for the halves cannot be submitted once the shard has failed. To bound the time that
+    the task holds its cores, the bisection is stopped (and the original error is raised) after
+    `bisection_run_limit` runs (enough to isolate about `MAX_REJECTED_LIGANDS` ligands), or if no
+    ligand could be processed at all.
+    """
+    if rejects is None:
+        run(input, output)
+        return
+    try:
+        run(input, output)
+        return
+    except Exception as error:
+        logger.warning(f"Processing of {input} has failed ({error}), bisecting its ligands")
+        failure = error
+
+    records = read_records(input)
+    with tempfile.TemporaryDirectory(dir=output.parent) as tmpdir:
+        counter = itertools.count()
+
+        def run_part(part: List[bytes]) -> Path:
+            index = next(counter)
+            part_input = Path(tmpdir) / f"part-{index}-{uncompressed_name(input)}"
+            part_output = Path(tmpdir) / f"part-{index}-{uncompressed_name(output)}"
+            write_records(part_input, part)
+            run(part_input, part_output)
+            return part_output
+
+        try:
+            (outputs, rejected) = bisect_failures(
+                records, run_part, max_runs=bisection_run_limit(len(records))
+            )
+        except BisectionAborted as error:
+            logger.warning(f"Bisection of {input} was stopped: {error}")
+            raise failure from error
+        if len(records) > 1 and not outputs:
+            # If no ligand can be processed, the failure is most likely not caused by the ligands
+            raise failure
+        merge(outputs, output)
+    write_records(rejects, rejected)
+    logger.warning(f"Rejected {len(rejected)} ligand(s) of {input}, stored into {rejects}")
@@ -0,0 +1,393 @@
+import csv
+import dataclasses
+import functools
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .scores import Row
+from .smi import parse_smi_line
+from .target import POCKET_TRIMMING_VERSION
+from .virtual_screening import ScreeningConfig, create_screening_description
+from ...utils.io import ensure_directory, hash_file, open_compressed
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ScreeningCacheConfig:
+    """
+    Persistent store of screening scores, shared by screening campaigns that use the same protein,
+    probe and screening pipeline.
+    """
+
+    """
+    SQLite database that stores the cached scores.
+    """
+    path: Path
+    """
+    Maximum total size (in bytes) of the cached score rows.
+    When it is exceeded, the least recently used rows are evicted. None means unlimited size.
+    """
+    max_size: Optional[int] = 1024 * 1024 * 1024
+
+
+@dataclass
+class ScreeningCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stored: int = 0
+    evicted: int = 0
+
+    def __str__(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0
+        return (
+            f"{self.hits} hit(s), {self.misses} miss(es) ({hit_rate:.1f}% hit rate), "
+            f"{self.stored} stored, {self.evicted} evicted"
+        )
+
+
+@functools.lru_cache
+def get_smiles_canonicalizer() -> Callable[[str], Optional[str]]:
+    try:
+        from rdkit import Chem, RDLogger
+
+        RDLogger.DisableLog("rdApp.*")
+    except ImportError:
+        logger.warning("RDKit is not available, SMILES will not be canonicalized for caching")
+        return lambda smiles: smiles
+
+    def canonicalize(smiles: str) -> Optional[str]:
+        molecule = Chem.MolFromSmiles(smiles)
+        return Chem.MolToSmiles(molecule) if molecule is not None else None
+
+    return canonicalize
+
+
+@functools.lru_cache
+def ligand_key_scheme() -> str:
+    """
+    Returns an identifier of the way ligand cache keys are computed (see `ligand_cache_key`).
+    Canonical SMILES might differ between RDKit versions, so the version is included.
+    """
+    try:
+        import rdkit
+    except ImportError:
+        return "raw"
+    return f"rdkit-{rdkit.__version__}"
+
+
+def ligand_cache_key(smiles: str) -> str:
+    """
+    Returns a cache key of a ligand, based on the hash of its canonical SMILES.
+    If the SMILES cannot be canonicalized, its original form is used instead.
+    """
+    canonical = get_smiles_canonicalizer()(smiles) or smiles
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def screening_context_key(config: ScreeningConfig) -> str:
+    """
+    Returns a key that identifies everything (besides the ligand itself) that affects the score
+    of a ligand: the proteins and probes of the targets and the LiGen pipeline description.
+
+    Paths and parallelism settings do not affect the scores, so they are normalized before the
+    description is hashed.
+    """
+    normalized = dataclasses.replace(
+        config,
+        input_expanded_mol2=Path("ligands.mol2"),
+        output_scores_csv=Path("scores.csv"),
+        cores=1,
+        num_parser=1,
+        num_workers_unfold=1,
+        num_workers_docknscore=1,
+    )
+    hasher = hashlib.sha256()
+    targets = []
+    for (index, target) in enumerate(config.targets):
+        hasher.update(hash_file(target.protein_pdb).encode())
+        hasher.update(hash_file(target.probe_mol2).encode())
+        pocket_pdb = None
+        if target.pocket_pdb is not None:
+            # The trimmed protein might lead to different scores than the whole protein
+            if target.pocket_radius is not None:
+                # A prepared pocket might not exist yet when the key is computed, so the way it
+                # is prepared from the protein and the probe is hashed instead of its content
+                pocket = f"pocket:{target.pocket_radius}:{POCKET_TRIMMING_VERSION}"
+            else:
+                pocket = hash_file(target.pocket_pdb)
+            hasher.update(pocket.encode())
+            pocket_pdb = Path(f"pocket-{index}.pdb")
+        targets.append(
+            dataclasses.replace(
+                target,
+                protein_pdb=Path(f"protein-{index}.pdb"),
+                probe_mol2=Path(f"probe-{index}.mol2"),
+                pocket_pdb=pocket_pdb,
+            )
+        )
+    description = create_screening_description(
+        normalized,
+        input_ligands=normalized.input_expanded_mol2,
+        input_targets=targets,
+        output_csv=normalized.output_scores_csv,
+    )
+    hasher.update(json.dumps(description, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+class ScreeningCache:
+    """
+    Local on-disk (SQLite) store of score rows, keyed by a screening context key and a ligand key.
+    """
+
+    # Maximum number of SQL parameters used in a single lookup query
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    @staticmethod
+    def open(path: Path) -> "ScreeningCache":
+        ensure_directory(path.parent)
+        connection = sqlite3.connect(path, timeout=300)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS contexts (key TEXT PRIMARY KEY, header TEXT NOT NULL)"
+        )
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS scores (
+                context TEXT NOT NULL,
+                ligand TEXT NOT NULL,
+                row TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                used REAL NOT NULL,
+                PRIMARY KEY (context, ligand)
+            ) WITHOUT ROWID"""
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS scores_used ON scores (used)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        # Ligand keys computed with a different scheme would never match, so the cache would
+        # silently never hit (e.g. if RDKit is only available on some nodes)
+        scheme = ligand_key_scheme()
+        connection.execute(
+            "INSERT OR IGNORE INTO meta (name, value) VALUES ('key_scheme', ?)", (scheme,)
+        )
+        connection.commit()
+        (cache_scheme,) = connection.execute(
+            "SELECT value FROM meta WHERE name = 'key_scheme'"
+        ).fetchone()
+        if cache_scheme != scheme:
+            connection.close()
+            raise Exception(
+                f"Screening cache {path} uses ligand keys of scheme {cache_scheme}, but the "
+                f"current environment computes keys of scheme {scheme}. Use the same RDKit "
+                "installation on all nodes, or use a different cache path."
+            )
+        return ScreeningCache(connection)
+
+    def header(self, context: str) -> Optional[Row]:
+        result = self.connection.execute(
+            "SELECT header FROM contexts WHERE key = ?", (context,)
+        ).fetchone()
+        return json.loads(result[0]) if result is not None else None
+
+    def lookup(self, context: str, ligands: List[str]) -> Dict[str, Row]:
+        """
+        Returns the cached rows of the given `ligands` (ligand keys).
+        Ligands without a cached row are not included in the result.
+        """
+        rows = {}
+        ligands = list(dict.fromkeys(ligands))
+        for start in range(0, len(ligands), ScreeningCache.LOOKUP_CHUNK):
+            chunk = ligands[start:start + ScreeningCache.LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            for (ligand, row) in self.connection.execute(
+                f"SELECT ligand, row FROM scores WHERE context = ? AND ligand IN ({placeholders})",
+                (context, *chunk),
+            ):
+                rows[ligand] = json.loads(row)
+        if rows:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE scores SET used = ? WHERE context = ? AND ligand = ?",
+                ((now, context, ligand) for ligand in rows),
+            )
+            # Do not block other campaigns that use the cache for the whole lookup
+            self.connection.commit()
+        return rows
+
+    def store(self, context: str, header: Row, rows: Iterable[Tuple[str, Row]]) -> int:
+        """
+        Stores (ligand key, row) pairs for the given `context`.
+        Returns the number of stored rows.
+        """
+        existing = self.header(context)
+        if existing is None:
+            self.connection.execute(
+                "INSERT INTO contexts (key, header) VALUES (?, ?)", (context, json.dumps(header))
+            )
+        elif existing != header:
+            raise Exception(f"Header {header} does not match the cached header {existing}")
+
+        now = time.time()
+        entries = []
+        for (ligand, row) in rows:
+            serialized = json.dumps(row)
+            entries.append((context, ligand, serialized, len(serialized), now))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO scores (context, ligand, row, size, used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            entries,
+        )
+        return len(entries)
+
+    def evict(self, max_size: int) -> int:
+        """
+        Removes the least recently used rows until the total size of the cached rows is at most
+        `max_size` bytes. Returns the number of evicted rows.
+        """
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM scores").fetchone()[0]
+        if total <= max_size:
+            return 0
+        evicted = []
+        for (context, ligand, size) in self.connection.execute(
+            "SELECT context, ligand, size FROM scores ORDER BY used"
+        ):
+            if total <= max_size:
+                break
+            evicted.append((context, ligand))
+            total -= size
+        self.connection.executemany(
+            "DELETE FROM scores WHERE context = ? AND ligand = ?", evicted
+        )
+        return len(evicted)
+
+    def add_stats(self, stats: ScreeningCacheStats):
+        self.connection.executemany(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            dataclasses.asdict(stats).items(),
+        )
+
+    def stats(self) -> ScreeningCacheStats:
+        """
+        Returns cumulative statistics of all campaigns that have used this cache.
+        """
+        values = dict(self.connection.execute("SELECT name, value FROM stats"))
+        return ScreeningCacheStats(
+            **{
+                field.name: values.get(field.name, 0)
+                for field in dataclasses.fields(ScreeningCacheStats)
+            }
+        )
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self) -> "ScreeningCache":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.connection.commit()
+        self.close()
+
+
+class ScreeningCacheLookup:
+    """
+    SMI line filter (see `shard_smi_file`) that skips ligands that already have a cached score.
+    The cached rows are written to `output` (a CSV writer), with their NAME column replaced by the
+    name of the ligand in the current SMI file.
+    """
+
+    def __init__(self, cache: ScreeningCache, context: str, output):
+        self.cache = cache
+        self.context = context
+        self.output = output
+        self.header = cache.header(context)
+        self.header_written = False
+        self.stats = ScreeningCacheStats()
+
+    def __call__(self, lines: List[bytes]) -> List[bool]:
+        if self.header is None:
+            self.stats.misses += len(lines)
+            return [True] * len(lines)
+
+        ligands = [
+            (parse_smi_line(line), ligand_cache_key(line.split(maxsplit=1)[0].decode()))
+            for line in lines
+        ]
+        cached = self.cache.lookup(self.context, [key for (_, key) in ligands])
+        name_index = self.header.index("NAME")
+        keep = []
+        for (name, key) in ligands:
+            row = cached.get(key)
+            if row is None:
+                self.stats.misses += 1
+                keep.append(True)
+                continue
+            if not self.header_written:
+                self.output.writerow(self.header)
+                self.header_written = True
+            row = list(row)
+            row[name_index] = name
+            self.output.writerow(row)
+            self.stats.hits += 1
+            keep.append(False)
+        return keep
+
+
+@dataclass(frozen=True)
+class ScreeningCacheStoreConfig:
+    """
+    Stores the scores of freshly screened ligands into the screening cache.
+    """
+
+    cache: ScreeningCacheConfig
+    context: str
+    """
+    (SMI shard, scores CSV) pairs of the screened ligands.
+    """
+    inputs: List[Tuple[Path, Path]]
+
+
+def store_screening_scores(config: ScreeningCacheStoreConfig):
+    stats = ScreeningCacheStats()
+    with ScreeningCache.open(config.cache.path) as cache:
+        for (smi, scores_csv) in config.inputs:
+            with open(smi, "rb") as f:
+                keys = {
+                    parse_smi_line(line): ligand_cache_key(line.split(maxsplit=1)[0].decode())
+                    for line in f
+                    if line.strip()
+                }
+            if scores_csv.stat().st_size == 0:
+                continue
+            with open_compressed(scores_csv, "r", newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader, None)
+                if header is None:
+                    continue
+                name_index = header.index("NAME")
+                rows = [
+                    (keys[row[name_index]], row)
+                    for row in reader
+                    if row and row[name_index] in keys
+                ]
+            stats.stored += cache.store(config.context, header, rows)
+        if config.cache.max_size is not None:
+            stats.evicted = cache.evict(config.cache.max_size)
+        cache.add_stats(stats)
+        logger.info(f"Screening cache: {stats}, cumulative: {cache.stats()}")
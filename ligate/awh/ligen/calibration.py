@@ -0,0 +1,154 @@
+import dataclasses
+import json
+import logging
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+from .common import LigenTaskContext
+from .docking import DockingConfig
+from .telemetry import shard_telemetry
+from .virtual_screening import ScreeningConfig, ligen_output_scores_csv, run_screening
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ThreadLayout:
+    """
+    Number of cores requested for a single LiGen task, and the number of threads used by the
+    individual stages of the LiGen pipeline.
+    """
+
+    cores: int
+    num_parser: int
+    num_workers_unfold: int
+    num_workers_dock: int
+    num_workers_score: int
+
+    def apply_to_screening(self, config: ScreeningConfig, max_cores: int) -> ScreeningConfig:
+        # The screening pipeline uses the same number of workers for docking and scoring
+        return dataclasses.replace(
+            config,
+            cores=min(self.cores, max_cores),
+            num_parser=self.num_parser,
+            num_workers_unfold=self.num_workers_unfold,
+            num_workers_docknscore=self.num_workers_dock,
+        )
+
+    def apply_to_docking(self, config: DockingConfig) -> DockingConfig:
+        return dataclasses.replace(
+            config,
+            cores=self.cores,
+            num_parser=self.num_parser,
+            num_workers_unfold=self.num_workers_unfold,
+            num_workers_dock=self.num_workers_dock,
+            num_workers_score=self.num_workers_score,
+        )
+
+
+def load_thread_layout(path: Path) -> ThreadLayout:
+    with open(path) as f:
+        return ThreadLayout(**json.load(f))
+
+
+def candidate_thread_layouts(max_cores: int) -> List[ThreadLayout]:
+    """
+    Creates thread layouts that should be evaluated by calibration: power-of-two core counts up to
+    `max_cores`, each with and without 2x oversubscription of the docking and scoring stages.
+    """
+    layouts = []
+    cores = 1
+    while cores <= max_cores:
+        for oversubscription in (1, 2):
+            layouts.append(
+                ThreadLayout(
+                    cores=cores,
+                    num_parser=cores,
+                    num_workers_unfold=cores,
+                    num_workers_dock=cores * oversubscription,
+                    num_workers_score=cores * oversubscription,
+                )
+            )
+        cores *= 2
+    return layouts
+
+
+@dataclass(frozen=True)
+class CalibrationProbeConfig:
+    """
+    Screens a small sample of ligands using a specific thread layout, and measures the throughput.
+    """
+
+    layout: ThreadLayout
+    """
+    Screening of the sample ligands, its threading settings are overridden by `layout`.
+    """
+    screening: ScreeningConfig
+    ligand_count: int
+    """
+    JSON file that will contain the layout and its measured throughput (excluding container
+    startup, see `ligen_calibration_probe`).
+    """
+    output_json: Path
+
+
+def ligen_calibration_probe(ctx: LigenTaskContext, config: CalibrationProbeConfig):
+    screening = config.layout.apply_to_screening(config.screening, max_cores=config.layout.cores)
+    with shard_telemetry(ctx, "calibration", screening.input_expanded_mol2) as telemetry:
+        start = time.time()
+        run_screening(
+            ctx,
+            screening,
+            screening.input_expanded_mol2,
+            ligen_output_scores_csv(screening),
+            telemetry,
+        )
+        duration = time.time() - start
+        telemetry.ligands = config.ligand_count
+
+    # The container startup and file copying do not depend on the layout, and on a small sample
+    # they would dominate the measurement and favor layouts with fewer cores. Only the time spent
+    # by LiGen itself is thus measured.
+    timings = telemetry.timings
+    compute = timings.compute
+    if compute <= 0:
+        overhead = timings.setup + timings.input_copy + timings.startup + timings.output_copy
+        compute = max(duration - overhead, 1e-6)
+
+    throughput = config.ligand_count / compute / config.layout.cores
+    logger.info(
+        f"Calibration probe {config.layout} screened {config.ligand_count} ligand(s) in "
+        f"{compute:.3f}s of compute time, {duration:.3f}s in total "
+        f"({throughput:.3f} ligands/s/core)"
+    )
+    with open(config.output_json, "w") as f:
+        json.dump(
+            dict(
+                layout=dataclasses.asdict(config.layout),
+                duration=duration,
+                compute=compute,
+                throughput=throughput,
+            ),
+            f,
+        )
+
+
+def select_thread_layout(probe_jsons: List[Path], output_json: Path):
+    """
+    Selects the layout with the highest throughput per core from the results of calibration
+    probes, and stores it into `output_json` (see `load_thread_layout`).
+    """
+    results = []
+    for path in probe_jsons:
+        with open(path) as f:
+            results.append(json.load(f))
+    if not results:
+        raise Exception("No calibration results are available")
+    best = max(results, key=lambda result: result["throughput"])
+    logger.info(
+        f"Selected thread layout {best['layout']} ({best['throughput']:.3f} ligands/s/core)"
+    )
+    with open(output_json, "w") as f:
+        json.dump(best["layout"], f)
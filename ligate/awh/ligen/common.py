@@ -1,8 +1,49 @@
+import enum
+import os
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Dict, Optional
+
+# Command prefix that executes the D23RTMB scoring function inside the LiGen container
+D23RTMB_PREFIX = (
+    "micromamba --name d23rtmb run -e BABEL_LIBDIR=/opt/micromamba/envs/d23rtmb/lib/openbabel/3.1.0"
+)
+
+
+class FileMappingMode(enum.Enum):
+    """
+    Copy input files into a temporary directory mounted into the container, and copy output files
+    back to their destination after LiGen finishes.
+    """
+
+    Copy = enum.auto()
+    """
+    Bind-mount input files (read-only) and output files directly into the container, so that LiGen
+    reads and writes them in place. Falls back to copying for files that cannot be mounted.
+    """
+    Bind = enum.auto()
 
 
 @dataclass
 class LigenTaskContext:
     workdir: Path
     container_path: Path
+    # Execute LiGen inside a long-lived container instance shared by all tasks on the same node
+    persistent_session: bool = False
+    # How long (in seconds) should an idle persistent session stay alive
+    session_idle_timeout: int = 300
+    file_mapping: FileMappingMode = FileMappingMode.Copy
+    # Read proteins and probes from a node-local copy shared by all tasks on the same node
+    stage_shared_inputs: bool = False
+    # Append a timing breakdown of each processed shard to a JSONL file in this directory
+    telemetry_dir: Optional[Path] = None
+
+
+def clean_container_environment() -> Dict[str, str]:
+    """
+    Creates an environment for executing the container, without MPI/PMI/Slurm env. variables.
+    """
+    env = {}
+    if "PATH" in os.environ:
+        env["PATH"] = os.environ["PATH"]
+    return env
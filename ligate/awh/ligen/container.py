@@ -4,11 +4,24 @@ import os
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import ContextManager, List, Optional, Union
+from typing import ContextManager, Dict, List, Optional, Tuple, Union
 
-from ...utils.io import ensure_directory
+from .common import FileMappingMode, LigenTaskContext, clean_container_environment
+from .session import LigenSession, ligen_session_request
+from .staging import NodeStagingCache
+from .telemetry import ContainerTimings, ShardTelemetry
+from ...utils.io import (
+    delete_file,
+    ensure_directory,
+    is_compressed,
+    open_compressed,
+    partial_path,
+    uncompressed_name,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +37,102 @@ class MappedFile:
     # Path where the file will be mounted from into the container
     host_path: Path
     input: bool
+    # The target file is mounted into the container directly, instead of being copied
+    bound: bool = False
+    # The target file is compressed, and it is streamed through a named pipe at `host_path`
+    compressed: bool = False
+
+
+@dataclass
+class FileMappingStats:
+    copied_bytes: int = 0
+    copy_duration: float = 0
+    # Amount of data that did not have to be copied thanks to bind-mounting
+    avoided_bytes: int = 0
+
+    def copy(self, src: Path, dst: Path) -> float:
+        """
+        Copies `src` to `dst`, returns the duration of the copy.
+        """
+        start = time.time()
+        shutil.copy(src, dst)
+        duration = time.time() - start
+        self.copy_duration += duration
+        self.copied_bytes += dst.stat().st_size
+        return duration
+
+
+class CompressedFileStream:
+    """
+    (De)compresses a compressed mapped file on the fly in a background thread.
+    Input files are decompressed into their named pipe, and the data written by the container into
+    the named pipe of an output file is compressed into its partial path.
+    """
+
+    def __init__(self, file: MappedFile):
+        self.file = file
+        self.error: Optional[BaseException] = None
+        # The command did not open the named pipe
+        self.cancelled = False
+        self.opened = threading.Event()
+        self.thread = threading.Thread(target=self.stream, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stream(self):
+        try:
+            if self.file.input:
+                with open_compressed(self.file.target_path, "rb") as input:
+                    with open(self.file.host_path, "wb") as output:
+                        self.opened.set()
+                        shutil.copyfileobj(input, output, 1024 * 1024)
+            else:
+                with open(self.file.host_path, "rb") as input:
+                    self.opened.set()
+                    with open_compressed(partial_path(self.file.target_path), "wb") as output:
+                        shutil.copyfileobj(input, output, 1024 * 1024)
+        except BaseException as error:
+            self.error = error
+
+    def finish(self):
+        """
+        Waits until the stream ends. Must be called after the command has finished.
+        """
+        while self.thread.is_alive() and not self.opened.is_set():
+            # Opening a named pipe blocks until its other end is opened. If the command did not
+            # open the pipe, it is opened here instead, so that the thread does not block forever.
+            flags = os.O_RDONLY if self.file.input else os.O_WRONLY
+            try:
+                fd = os.open(self.file.host_path, flags | os.O_NONBLOCK)
+            except OSError:
+                # The thread does not wait for the writing end yet
+                self.thread.join(0.01)
+                continue
+            self.cancelled = True
+            try:
+                self.thread.join(0.1)
+            finally:
+                os.close(fd)
+        self.thread.join()
+
+    def check(self):
+        if self.cancelled:
+            if not self.file.input:
+                raise Exception(f"Output file `{self.file.target_path}` was not written")
+        elif self.error is not None:
+            raise Exception(f"Streaming of `{self.file.target_path}` has failed") from self.error
+
+
+def file_state(path: Path) -> Optional[Tuple[int, int]]:
+    """
+    Returns the size and modification time of a file, or None if it does not exist.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
 
 
 def detect_apptainer_binary() -> str:
@@ -38,70 +147,331 @@ def detect_apptainer_binary() -> str:
 
 
 @contextlib.contextmanager
-def ligen_container(container: GenericPath) -> ContextManager["LigenContainerContext"]:
+def ligen_container(
+    container: GenericPath,
+    persistent_session: bool = False,
+    session_idle_timeout: int = 300,
+    file_mapping: FileMappingMode = FileMappingMode.Copy,
+    bind_roots: Tuple[Path, ...] = (),
+    stage_shared_inputs: bool = False,
+) -> ContextManager["LigenContainerContext"]:
+    """
+    Prepares an environment for executing commands inside the LiGen container.
+
+    If `persistent_session` is True, the commands are executed inside a long-lived container
+    instance shared by all tasks on the current node (see `LigenSession`), instead of starting
+    a new container for each command.
+    In that case, files can only be bind-mounted if they are located within one of the
+    directories in `bind_roots`.
+
+    If `stage_shared_inputs` is True, inputs shared by many tasks are read from a node-local
+    staging cache (see `map_shared_input`).
+    """
+    start = time.time()
     apptainer = detect_apptainer_binary()
+    staging = NodeStagingCache.for_current_node() if stage_shared_inputs else None
 
     container = Path(container).absolute()
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-        ctx = LigenContainerContext(container, tmpdir, apptainer_bin=apptainer)
-        yield ctx
+    if persistent_session:
+        if file_mapping != FileMappingMode.Bind:
+            bind_roots = ()
+        with ligen_session_request(
+            container, apptainer, idle_timeout=session_idle_timeout, bind_roots=bind_roots
+        ) as (session, request_dir):
+            ctx = LigenSessionContext(
+                session, request_dir, file_mapping=file_mapping, staging=staging
+            )
+            ctx.timings.setup += time.time() - start
+            yield ctx
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            ctx = LigenContainerContext(
+                container,
+                tmpdir,
+                apptainer_bin=apptainer,
+                file_mapping=file_mapping,
+                staging=staging,
+            )
+            ctx.timings.setup += time.time() - start
+            yield ctx
+    ctx.log_stats()
+
+
+@contextlib.contextmanager
+def ligen_task_container(
+    ctx: LigenTaskContext, telemetry: Optional[ShardTelemetry] = None
+) -> ContextManager["LigenContainerContext"]:
+    """
+    Prepares a LiGen container environment configured by the given task context.
+    If `telemetry` is passed, the timings of the container are added to it (even if a command
+    fails).
+    """
+    with ligen_container(
+        ctx.container_path,
+        persistent_session=ctx.persistent_session,
+        session_idle_timeout=ctx.session_idle_timeout,
+        file_mapping=ctx.file_mapping,
+        bind_roots=(ctx.workdir.absolute(),),
+        stage_shared_inputs=ctx.stage_shared_inputs,
+    ) as ligen:
+        try:
+            yield ligen
+        finally:
+            if telemetry is not None:
+                telemetry.timings.add(ligen.timings)
 
 
 class LigenContainerContext:
-    def __init__(self, container: Path, directory: Path, apptainer_bin: str = "apptainer"):
+    # Name of a file in the mapped files directory, into which commands store the time when they
+    # started executing inside the container
+    STARTED_MARKER = ".started"
+
+    def __init__(
+        self,
+        container: Path,
+        directory: Path,
+        apptainer_bin: str = "apptainer",
+        files_container_dir: Path = Path("/files"),
+        file_mapping: FileMappingMode = FileMappingMode.Copy,
+        staging: Optional[NodeStagingCache] = None,
+    ):
         self.container = container
         self.apptainer_dir = ensure_directory(directory / "apptainer")
-        self.files_container_dir = Path("/files")
+        self.files_container_dir = files_container_dir
         self.files_host_dir = ensure_directory(directory / "files")
         self.mapped_files: List[MappedFile] = []
         self.file_names = set()
         self.apptainer_bin = apptainer_bin
+        self.file_mapping = file_mapping
+        self.stats = FileMappingStats()
+        self.timings = ContainerTimings()
+        self.staging = staging
 
     def map_file(self, path: Path, input: bool) -> Path:
         """
         Maps a file from the outside to the container.
         Returns a path to the file that will be accessible inside the container.
 
-        Currently, this is implemented by copying the file into a temporary directory, but eventually
-        it should be optimized so that apptainer overlays are used directly to access the input files.
+        With `FileMappingMode.Copy`, input files are copied into a temporary directory, and output
+        files are copied back from it once the container finishes.
+        With `FileMappingMode.Bind`, files are mounted directly into the container.
+        Compressed files (see `is_compressed`) are streamed through a named pipe in both modes.
         """
         path = path.absolute()
-        name = path.name
-        assert name not in self.file_names
+        if is_compressed(path):
+            return self.map_compressed_file(path, input=input)
+        name = self.unique_file_name(path.name)
         container_path = self.files_container_dir / name
         host_path = self.files_host_dir / name
 
-        if input:
+        bound = self.file_mapping == FileMappingMode.Bind and self.can_bind(path)
+        if bound:
+            container_path = self.bound_container_path(path, container_path, input=input)
+            logger.debug(f"Mounting {path} into the container ({container_path} in container)")
+            if input:
+                self.stats.avoided_bytes += path.stat().st_size
+            else:
+                # LiGen writes directly next to the target file, which is replaced once LiGen
+                # finishes successfully, so that incomplete outputs never appear at the target path
+                ensure_directory(path.parent)
+                partial_path(path).touch()
+        elif input:
             logger.debug(f"Copying {path} to {host_path} ({container_path} in container)")
-            shutil.copy(path, host_path)
+            self.timings.input_copy += self.stats.copy(path, host_path)
+            self.timings.copied_bytes += host_path.stat().st_size
         self.mapped_files.append(
             MappedFile(
                 target_path=path,
                 host_path=host_path,
                 container_path=container_path,
                 input=input,
+                bound=bound,
             )
         )
         return container_path
 
+    def map_compressed_file(self, path: Path, input: bool) -> Path:
+        """
+        Maps a compressed file through a named pipe, so that the container reads and writes the
+        uncompressed content, which is never stored on disk.
+        """
+        name = self.unique_file_name(uncompressed_name(path))
+        container_path = self.files_container_dir / name
+        host_path = self.files_host_dir / name
+        os.mkfifo(host_path)
+        if not input:
+            ensure_directory(path.parent)
+        self.mapped_files.append(
+            MappedFile(
+                target_path=path,
+                host_path=host_path,
+                container_path=container_path,
+                input=input,
+                compressed=True,
+            )
+        )
+        return container_path
+
+    def unique_file_name(self, name: str) -> str:
+        """
+        Reserves a name in the mapped files directory, so that files with the same name (from
+        different directories) can be mapped at the same time.
+        """
+        unique_name = name
+        index = 0
+        while unique_name in self.file_names:
+            index += 1
+            unique_name = f"{index}-{name}"
+        self.file_names.add(unique_name)
+        return unique_name
+
+    def can_bind(self, path: Path) -> bool:
+        return True
+
+    def bound_container_path(self, path: Path, container_path: Path, input: bool) -> Path:
+        """
+        Returns the path at which a bind-mounted file at `path` will be visible in the container.
+        """
+        # A placeholder is needed for the mount point inside the mounted files directory
+        (self.files_host_dir / container_path.name).touch()
+        return container_path
+
     def map_input(self, path: Path) -> Path:
         return self.map_file(path, input=True)
 
+    def map_scratch(self, name: str) -> Path:
+        """
+        Returns a path to a temporary file with the given `name`, which can be used to pass data
+        between commands executed within the container. The file is stored in node-local storage
+        and it is not copied anywhere.
+        """
+        assert name not in self.file_names
+        self.file_names.add(name)
+        return self.files_container_dir / name
+
+    def map_shared_input(self, path: Path) -> Path:
+        """
+        Maps an input file that is shared by many tasks, such as a protein or a probe.
+        If staging is enabled, the file is mapped from a node-local copy, which is created by the
+        first task on the node that needs it.
+        """
+        if self.staging is not None:
+            start = time.time()
+            path = self.staging.stage(path)
+            self.timings.input_copy += time.time() - start
+        return self.map_input(path)
+
     def map_output(self, path: Path) -> Path:
         return self.map_file(path, input=False)
 
     def run(self, command: str, input: Optional[bytes] = None):
-        # Clear the environment, to remove MPI/PMI/Slurm env. variables
-        env = {}
-        if "PATH" in os.environ:
-            env["PATH"] = os.environ["PATH"]
+        marker = self.files_host_dir / LigenContainerContext.STARTED_MARKER
+        if marker.exists():
+            marker.unlink()
+        # The command records when it started, so that the startup of the container can be
+        # distinguished from the execution of the command
+        command = (
+            f"date +%s.%N > {self.files_container_dir / LigenContainerContext.STARTED_MARKER}\n"
+            f"{command}"
+        )
+        outputs = [file for file in self.mapped_files if not file.input]
+        # Bound outputs are created before the command runs, so the command has to change them
+        unwritten = {
+            file.target_path: file_state(partial_path(file.target_path))
+            for file in outputs
+            if file.bound
+        }
+        launched = time.time()
+        try:
+            try:
+                with self.stream_compressed_files():
+                    self.execute(command, input=input)
+            finally:
+                self.record_execution(launched, time.time(), marker)
+            self.publish_outputs(outputs, unwritten)
+        except BaseException:
+            # Partial outputs are written next to their targets, which are usually on shared
+            # storage, so they are removed if the command does not finish successfully
+            for file in outputs:
+                partial = partial_path(file.target_path)
+                if partial.is_file():
+                    delete_file(partial)
+            raise
+
+    def publish_outputs(
+        self, outputs: List[MappedFile], unwritten: Dict[Path, Optional[Tuple[int, int]]]
+    ):
+        start = time.time()
+        # Copy output files from the tmpdir to their destination
+        # The files are first copied next to their destination and then atomically renamed, so
+        # that other tasks can rely on the fact that an existing output file is complete.
+        for file in outputs:
+            target = partial_path(file.target_path)
+            if file.compressed:
+                # The file was already compressed into `target` while the command was running
+                pass
+            elif file.bound:
+                state = file_state(target)
+                if state is None or state == unwritten[file.target_path]:
+                    raise Exception(f"Output file `{file.target_path}` was not written")
+                self.stats.avoided_bytes += target.stat().st_size
+            else:
+                host_path = file.host_path
+                if not host_path.is_file():
+                    raise Exception(f"Output file `{file.host_path}` not found")
+                self.stats.copy(host_path, target)
+                self.timings.copied_bytes += target.stat().st_size
+            os.replace(target, file.target_path)
+        self.timings.output_copy += time.time() - start
+
+    def record_execution(self, launched: float, finished: float, marker: Path):
+        started = launched
+        try:
+            started = min(max(float(marker.read_text()), launched), finished)
+        except (OSError, ValueError):
+            # The marker is missing, so the whole duration is attributed to the command
+            pass
+        self.timings.startup += started - launched
+        self.timings.compute += finished - started
+        self.timings.commands += 1
+
+    @contextlib.contextmanager
+    def stream_compressed_files(self):
+        streams = [CompressedFileStream(file) for file in self.mapped_files if file.compressed]
+        for stream in streams:
+            stream.start()
+        try:
+            yield
+        finally:
+            for stream in streams:
+                stream.finish()
+        for stream in streams:
+            stream.check()
+
+    def bind_args(self) -> List[str]:
+        args = []
+        for file in self.mapped_files:
+            if file.bound:
+                if file.input:
+                    mount = f"{file.target_path}:{file.container_path}:ro"
+                else:
+                    mount = f"{partial_path(file.target_path)}:{file.container_path}"
+                args.extend(["--bind", mount])
+        return args
+
+    def execute(self, command: str, input: Optional[bytes] = None):
+        """
+        Executes `command` inside a new container.
+        """
         with tempfile.TemporaryDirectory() as tmpdir:
             subprocess.check_output(
                 [
                     self.apptainer_bin,
                     "exec",
                     "--bind", f"{self.files_host_dir}:{self.files_container_dir}",
+                    # Individual files have to be mounted after the directory that contains them
+                    *self.bind_args(),
                     # Some processes inside the container can share /tmp, which doesn't end well
                     "--no-mount", "tmp",
                     "--bind", f"{tmpdir}:/tmp",
@@ -111,13 +481,69 @@ class LigenContainerContext:
                     command
                 ],
                 input=input,
-                env=env
+                env=clean_container_environment()
             )
-    
-            # Copy output files from the tmpdir to their destination
-            for file in self.mapped_files:
-                if not file.input:
-                    host_path = file.host_path
-                    if not host_path.is_file():
-                        raise Exception(f"Output file `{file.host_path}` not found")
-                    shutil.copy(host_path, file.target_path)
+
+    def log_stats(self):
+        logger.info(
+            f"Copied {self.stats.copied_bytes} B of LiGen files in "
+            f"{self.stats.copy_duration:.3f}s, avoided copying {self.stats.avoided_bytes} B"
+        )
+        if self.staging is not None:
+            logger.info(f"Node-local staging of shared inputs: {self.staging.stats}")
+
+
+class LigenSessionContext(LigenContainerContext):
+    """
+    Executes commands inside a running LiGen session.
+    The copied files are stored in a request directory inside the (node-local) session directory.
+    Files can only be bind-mounted if they are located within the bind roots of the session, which
+    are mounted when the session starts.
+    """
+
+    def __init__(
+        self,
+        session: LigenSession,
+        request_dir: Path,
+        file_mapping: FileMappingMode = FileMappingMode.Copy,
+        staging: Optional[NodeStagingCache] = None,
+    ):
+        super().__init__(
+            session.container,
+            request_dir,
+            apptainer_bin=session.apptainer_bin,
+            files_container_dir=session.container_path(request_dir / "files"),
+            file_mapping=file_mapping,
+            staging=staging,
+        )
+        self.session = session
+        self.request_dir = request_dir
+
+    def can_bind(self, path: Path) -> bool:
+        return self.session.is_bound(path)
+
+    def bound_container_path(self, path: Path, container_path: Path, input: bool) -> Path:
+        return path if input else partial_path(path)
+
+    def execute(self, command: str, input: Optional[bytes] = None):
+        # The /tmp directory is shared by the whole session, so at least try to make processes
+        # use a separate temporary directory for each request
+        tmpdir = ensure_directory(self.request_dir / "tmp")
+        start = time.time()
+        subprocess.check_output(
+            [
+                self.apptainer_bin,
+                "exec",
+                "--env", f"TMPDIR={self.session.container_path(tmpdir)}",
+                f"instance://{self.session.name}",
+                "bash",
+                "-c",
+                command
+            ],
+            input=input,
+            env=clean_container_environment()
+        )
+        logger.debug(
+            f"LiGen session {self.session.name} finished request {self.request_dir.name} "
+            f"in {time.time() - start:.3f}s"
+        )
@@ -0,0 +1,283 @@
+import contextlib
+import csv
+import heapq
+import logging
+import os
+import sqlite3
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from .cache import ligand_cache_key
+from .smi import iterate_smi_batches, parse_smi_line
+from ...utils.io import atomic_output
+
+logger = logging.getLogger(__name__)
+
+
+class LigandAliases:
+    """
+    On-disk (SQLite) mapping from the names of removed duplicate ligands (aliases) to the name of
+    the ligand that represents them in the deduplicated library.
+    """
+
+    # Maximum number of SQL parameters used in a single lookup query
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    @staticmethod
+    def create(path: Path) -> "LigandAliases":
+        """
+        Creates a new empty alias mapping at `path`, overwriting any existing mapping.
+        """
+        if path.exists():
+            os.unlink(path)
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute(
+            "CREATE TABLE aliases (alias TEXT PRIMARY KEY, representative TEXT NOT NULL)"
+            " WITHOUT ROWID"
+        )
+        return LigandAliases(connection)
+
+    @staticmethod
+    def open(path: Path) -> "LigandAliases":
+        """
+        Opens an existing alias mapping at `path` for reading.
+        """
+        if not path.is_file():
+            raise Exception(f"Ligand aliases {path} do not exist")
+        connection = sqlite3.connect(f"file:{path.absolute()}?mode=ro", uri=True)
+        return LigandAliases(connection)
+
+    def add(self, entries: Iterable[Tuple[str, str]]):
+        """
+        Adds (alias, representative) pairs to the mapping.
+        """
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO aliases (alias, representative) VALUES (?, ?)", entries
+        )
+
+    def create_lookup_index(self):
+        self.connection.execute(
+            "CREATE INDEX aliases_representative ON aliases (representative)"
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def aliases_of(self, representatives: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Finds the aliases of the given `representatives`.
+        Representatives without aliases are not included in the result.
+        """
+        representatives = list(dict.fromkeys(representatives))
+        aliases = {}
+        for start in range(0, len(representatives), LigandAliases.LOOKUP_CHUNK):
+            chunk = representatives[start:start + LigandAliases.LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                "SELECT representative, alias FROM aliases "
+                f"WHERE representative IN ({placeholders})",
+                chunk,
+            )
+            for (representative, alias) in rows:
+                aliases.setdefault(representative, []).append(alias)
+        return aliases
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self) -> "LigandAliases":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and self.connection.in_transaction:
+            self.commit()
+        self.close()
+
+
+@dataclass(frozen=True)
+class DeduplicationConfig:
+    """
+    Removes duplicate ligands (with the same canonical SMILES) from a SMI file.
+    The first occurrence of each ligand is kept and it represents all its duplicates.
+    """
+
+    input_smi: Path
+    """
+    SMI file with unique ligands, in their original order.
+    """
+    output_smi: Path
+    """
+    Mapping from the names of removed ligands to their representatives (see `LigandAliases`).
+    """
+    output_aliases: Path
+    """
+    Number of partitions into which the ligands are split by the hash of their canonical SMILES.
+    Only a single partition is loaded into memory at once.
+    """
+    partitions: int = 64
+    batch_size: int = 4096
+
+
+@dataclass
+class DeduplicationStats:
+    unique: int = 0
+    duplicates: int = 0
+
+
+def deduplicate_smi_file(config: DeduplicationConfig) -> DeduplicationStats:
+    """
+    Deduplicates the ligands of `config.input_smi` using disk-backed hash partitioning, so that
+    libraries larger than memory can be deduplicated:
+    1) Each ligand is assigned to a partition file by the hash of its canonical SMILES.
+    2) Duplicates are found separately in each partition, which yields a sorted list of the
+    positions of kept lines per partition.
+    3) The input file is streamed again, and the kept lines (found by merging the sorted lists)
+    are written to the output file.
+    The partition files are stored next to the output file, which is usually on a larger
+    filesystem than the temporary directory.
+    """
+    stats = DeduplicationStats()
+    with tempfile.TemporaryDirectory(dir=config.output_smi.parent) as tmpdir:
+        tmpdir = Path(tmpdir)
+        partitions = [tmpdir / f"partition-{index}.txt" for index in range(config.partitions)]
+        write_partitions(config, partitions)
+
+        kept_files = []
+        with LigandAliases.create(config.output_aliases) as aliases:
+            for partition in partitions:
+                kept = partition.with_suffix(".kept")
+                (unique, duplicates) = deduplicate_partition(partition, kept, aliases)
+                stats.unique += unique
+                stats.duplicates += duplicates
+                kept_files.append(kept)
+                os.unlink(partition)
+            aliases.create_lookup_index()
+
+        with contextlib.ExitStack() as stack:
+            kept_positions = heapq.merge(
+                *(iterate_positions(stack.enter_context(open(path))) for path in kept_files)
+            )
+            output_smi = stack.enter_context(atomic_output(config.output_smi))
+            output = stack.enter_context(open(output_smi, "wb"))
+            next_kept = next(kept_positions, None)
+            with open(config.input_smi, "rb") as input:
+                position = 0
+                for batch in iterate_smi_batches(input, config.batch_size):
+                    for (_, line) in batch:
+                        if position == next_kept:
+                            output.write(line)
+                            next_kept = next(kept_positions, None)
+                        position += 1
+
+    logger.info(
+        f"Deduplicated {config.input_smi}: {stats.unique} unique ligand(s), "
+        f"{stats.duplicates} duplicate(s) removed"
+    )
+    return stats
+
+
+def write_partitions(config: DeduplicationConfig, partitions: List[Path]):
+    """
+    Writes a (key, position, name) record of each ligand of the input file into the partition
+    selected by its key.
+    """
+    with contextlib.ExitStack() as stack:
+        outputs = [stack.enter_context(open(path, "w")) for path in partitions]
+        with open(config.input_smi, "rb") as input:
+            position = 0
+            for batch in iterate_smi_batches(input, config.batch_size):
+                for (_, line) in batch:
+                    key = ligand_cache_key(line.split(maxsplit=1)[0].decode())
+                    output = outputs[int(key[:16], 16) % len(outputs)]
+                    output.write(f"{key} {position} {parse_smi_line(line)}\n")
+                    position += 1
+
+
+def deduplicate_partition(
+    partition: Path, kept: Path, aliases: LigandAliases
+) -> Tuple[int, int]:
+    """
+    Finds duplicates in a single partition file, stores their aliases and writes the (sorted)
+    positions of the kept ligands into `kept`.
+    Returns the number of unique and duplicate ligands.
+    """
+    representatives: Dict[str, str] = {}
+    removed = []
+    duplicates = 0
+    with open(partition) as input, open(kept, "w") as output:
+        # Records are stored in the order of the input file, so the first occurrence of each
+        # ligand comes first
+        for record in input:
+            (key, position, name) = record.rstrip("\n").split(" ", maxsplit=2)
+            representative = representatives.get(key)
+            if representative is None:
+                representatives[key] = name
+                output.write(f"{position}\n")
+            else:
+                duplicates += 1
+                # Exact duplicates (with the same name) do not need an alias
+                if name != representative:
+                    removed.append((name, representative))
+    aliases.add(removed)
+    return (len(representatives), duplicates)
+
+
+def iterate_positions(file) -> Iterator[int]:
+    for line in file:
+        yield int(line)
+
+
+@dataclass(frozen=True)
+class AliasPropagationConfig:
+    """
+    Propagates the scores of representative ligands to all their aliases.
+    """
+
+    scores_csv: Path
+    aliases: Path
+    """
+    Contains the rows of `scores_csv`, and a copy of the row of each representative for each of
+    its aliases (with the NAME column replaced by the alias).
+    """
+    output_csv: Path
+    batch_size: int = 4096
+
+
+def propagate_alias_scores(config: AliasPropagationConfig):
+    with contextlib.ExitStack() as stack:
+        aliases = stack.enter_context(LigandAliases.open(config.aliases))
+        output_csv = stack.enter_context(atomic_output(config.output_csv))
+        output = stack.enter_context(open(output_csv, "w", newline=""))
+        input = stack.enter_context(open(config.scores_csv, newline=""))
+        reader = csv.reader(input)
+        writer = csv.writer(output, lineterminator="\n")
+        header = next(reader, None)
+        if header is None:
+            return
+        writer.writerow(header)
+        name_index = header.index("NAME")
+
+        def write_batch(rows: List[List[str]]):
+            found = aliases.aliases_of(row[name_index] for row in rows)
+            for row in rows:
+                writer.writerow(row)
+                for alias in found.get(row[name_index], ()):
+                    alias_row = list(row)
+                    alias_row[name_index] = alias
+                    writer.writerow(alias_row)
+
+        batch = []
+        for row in reader:
+            if row:
+                batch.append(row)
+                if len(batch) == config.batch_size:
+                    write_batch(batch)
+                    batch = []
+        write_batch(batch)
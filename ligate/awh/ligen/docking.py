@@ -1,9 +1,16 @@
 import json
+import logging
+import shutil
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List, Optional
 
-from .common import LigenTaskContext
-from .container import ligen_container
+from .common import D23RTMB_PREFIX, LigenTaskContext
+from .container import ligen_task_container
+from .target import PROBE_FILTER_RADIUS
+from ...utils.io import atomic_output
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass(frozen=True)
@@ -36,14 +43,28 @@ class DockingConfig:
     num_workers_unfold: int = 20
     num_workers_dock: int = 32
     num_workers_score: int = 32
+    """
+    Residues of the protein around the probe, prepared in advance by `prepare_target`. If set,
+    LiGen identifies the pocket from this file instead of from `input_protein_pdb`.
+    """
+    input_pocket_pdb: Optional[Path] = None
 
 
 def ligen_dock(ctx: LigenTaskContext, config: DockingConfig):
-    with ligen_container(container=ctx.container_path) as ligen:
+    if config.input_expanded_mol2.stat().st_size == 0:
+        # A docking shard can be empty if less ligands than shards were selected
+        logger.info(f"No ligands to dock in {config.input_expanded_mol2}")
+        config.output_poses_mol2.touch()
+        return
+
+    with ligen_task_container(ctx) as ligen:
         input_ligands_mol2 = ligen.map_input(config.input_expanded_mol2)
-        input_pdb = ligen.map_input(config.input_protein_pdb)
-        input_probe_mol2 = ligen.map_input(config.input_probe_mol2)
+        input_pdb = ligen.map_shared_input(config.input_protein_pdb)
+        input_probe_mol2 = ligen.map_shared_input(config.input_probe_mol2)
         output_mol2 = ligen.map_output(config.output_poses_mol2)
+        input_pocket_pdb = input_pdb
+        if config.input_pocket_pdb is not None:
+            input_pocket_pdb = ligen.map_shared_input(config.input_pocket_pdb)
 
         description = {
             "name": "docking",
@@ -85,7 +106,7 @@ def ligen_dock(ctx: LigenTaskContext, config: DockingConfig):
                     "name": "d23",
                     "protein_filepath": str(input_pdb),
                     "probe_filepath": str(input_probe_mol2),
-                    "prefix": "micromamba --name d23rtmb run -e BABEL_LIBDIR=/opt/micromamba/envs/d23rtmb/lib/openbabel/3.1.0",
+                    "prefix": D23RTMB_PREFIX,
                     "cuda": "0",
                 },
                 {
@@ -112,12 +133,12 @@ def ligen_dock(ctx: LigenTaskContext, config: DockingConfig):
                     "configuration": {
                         "input": {
                             "format": "protein",
-                            "protein_path": str(input_pdb),
+                            "protein_path": str(input_pocket_pdb),
                         },
                         "filtering": {
                             "algorithm": "probe",
                             "path": str(input_probe_mol2),
-                            "radius": "10",
+                            "radius": f"{PROBE_FILTER_RADIUS:g}",
                         },
                         "pocket_identification": {"algorithm": "caviar_like"},
                         "anchor_points": {
@@ -132,3 +153,20 @@ def ligen_dock(ctx: LigenTaskContext, config: DockingConfig):
             "ligen",
             input=json.dumps(description).encode("utf8"),
         )
+
+
+def merge_docked_poses(input_mol2s: List[Path], output_mol2: Path):
+    """
+    Concatenates the docked poses from `input_mol2s` into `output_mol2`.
+    The files are streamed, so that the poses do not have to fit into memory. The names of the
+    poses (which contain their `POSE_ID` and `D23RTMB_SCORE`) are kept intact.
+    """
+    with atomic_output(output_mol2) as output_path, open(output_path, "wb") as output:
+        for path in input_mol2s:
+            with open(path, "rb") as input:
+                shutil.copyfileobj(input, output)
+                # Make sure that the next file starts on a new line
+                if input.tell() > 0:
+                    input.seek(-1, 2)
+                    if input.read(1) != b"\n":
+                        output.write(b"\n")
@@ -1,11 +1,13 @@
 import logging
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Callable, List, Optional
 
+from .bisection import concatenate_files, read_smi_records, run_with_bisection
 from .common import LigenTaskContext
-from .container import ligen_container
-from ...utils.io import split_file_by_lines
+from .container import ligen_task_container
+from .smi import LigandCostModel, SmiIndex, SmiMeasurement, shard_smi_file
+from .telemetry import ShardTelemetry, count_ligands, shard_telemetry
 
 logger = logging.getLogger(__name__)
 
@@ -26,35 +28,87 @@ class ExpansionConfig:
     MOL2 file with the expanded output.
     """
     output_mol2: Path
+    """
+    If set, ligands that make the expansion fail are isolated by bisecting the shard (see
+    `run_with_bisection`) and stored into this SMI file, instead of failing the whole shard.
+    The shard still fails if more than about `MAX_REJECTED_LIGANDS` ligands would have to be
+    isolated.
+    """
+    rejects_smi: Optional[Path] = None
 
 
 def ligen_expand_smi(ctx: LigenTaskContext, config: ExpansionConfig):
+    if config.input_smi.stat().st_size == 0:
+        logger.info(f"No ligands to expand in {config.input_smi}")
+        config.output_mol2.touch()
+        return
+
     logger.info(f"Starting expansion of {config.input_smi}")
-    with ligen_container(container=ctx.container_path) as ligen:
-        input_smi = ligen.map_input(config.input_smi)
-        output_mol2 = ligen.map_output(config.output_mol2)
+    with shard_telemetry(ctx, "expansion", config.input_smi) as telemetry:
+        run_with_bisection(
+            lambda input, output: run_expansion(ctx, input, output, telemetry),
+            input=config.input_smi,
+            output=config.output_mol2,
+            read_records=read_smi_records,
+            merge=concatenate_files,
+            rejects=config.rejects_smi,
+        )
+        telemetry.ligands = count_ligands(config.input_smi, header=False)
+    logger.info(f"Finished expansion of {config.input_smi}")
+
+
+def run_expansion(
+    ctx: LigenTaskContext, input_smi: Path, output_mol2: Path, telemetry: ShardTelemetry
+):
+    with ligen_task_container(ctx, telemetry) as ligen:
+        input_smi = ligen.map_input(input_smi)
+        output_mol2 = ligen.map_output(output_mol2)
         ligen.run(
             f"ligen-coordgen < {input_smi} > {output_mol2}",
         )
-    logger.info(f"Finished expansion of {config.input_smi}")
 
 
 def create_expansion_configs_from_smi(
-    input_smi: Path, workdir_inputs: Path, workdir_outputs: Path, max_molecules: int
+    input_smi: Path,
+    workdir_inputs: Path,
+    workdir_outputs: Path,
+    max_molecules: int,
+    cost_model: Optional[LigandCostModel] = None,
+    index_path: Optional[Path] = None,
+    filter: Optional[Callable[[List[bytes]], List[bool]]] = None,
+    measurement: Optional[SmiMeasurement] = None,
 ) -> List[ExpansionConfig]:
     """
-    Splits a single SMI database into multiple files, so that each file has at most `max_molecules`
-    molecules.
+    Splits a single SMI database into multiple files, so that each file has on average
+    `max_molecules` molecules.
+    If `cost_model` is passed, the files are balanced by the estimated cost of their ligands
+    rather than by their line count (see `shard_smi_file`).
     The files will be stored into `workdir_inputs`.
+    If `index_path` is passed, an index of the ligands of `input_smi` (see `SmiIndex`) will be
+    stored into it.
+    Lines rejected by `filter` will not be included in any file (see `shard_smi_file`), unless
+    a precomputed `measurement` is passed.
     Returns a list of expansion configs for the created files.
     """
     configs = []
-    basename = input_smi.stem
-    for index, section in enumerate(split_file_by_lines(input_smi, max_lines=max_molecules)):
-        name = f"{basename}-{index}"
-        input_path = workdir_inputs / f"{name}.smi"
-        with open(input_path, "w") as f:
-            f.write(section)
+    index = SmiIndex.create(index_path) if index_path is not None else None
+    try:
+        shards = shard_smi_file(
+            input_smi,
+            output_dir=workdir_inputs,
+            max_molecules=max_molecules,
+            cost_model=cost_model,
+            index=index,
+            filter=filter,
+            measurement=measurement,
+        )
+        if index is not None:
+            index.commit()
+    finally:
+        if index is not None:
+            index.close()
+    for input_path in shards:
+        name = input_path.stem
         output_path = workdir_outputs / f"{name}.mol2"
         configs.append(ExpansionConfig(id=name, input_smi=input_path, output_mol2=output_path))
     return configs
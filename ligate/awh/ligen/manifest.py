@@ -0,0 +1,90 @@
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from ...utils.io import atomic_output, delete_file, hash_file
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ShardCompletion:
+    """
+    Completion marker of a single shard of a campaign, which allows a resumed campaign to skip
+    shards that were already computed.
+
+    The marker contains a hash of the inputs of the shard, so that outputs computed from different
+    inputs (or with a different pipeline) are considered to be stale.
+    """
+
+    id: str
+    """
+    Hash of the input files of the shard and of the fingerprint of the pipeline.
+    """
+    input_hash: str
+    outputs: Tuple[Path, ...]
+    marker: Path
+
+    def is_complete(self) -> bool:
+        if not self.marker.is_file() or self.marker.read_text() != self.input_hash:
+            return False
+        return all(output.is_file() for output in self.outputs)
+
+    def mark(self):
+        with atomic_output(self.marker) as path:
+            path.write_text(self.input_hash)
+
+    def reset(self):
+        """
+        Deletes the marker and the (stale) outputs of the shard, if they exist.
+        """
+        for path in (self.marker, *self.outputs):
+            if path.is_file():
+                delete_file(path)
+
+
+def create_shard_completion(
+    id: str, inputs: List[Path], outputs: List[Path], marker: Path, fingerprint: str
+) -> ShardCompletion:
+    hasher = hashlib.sha256(fingerprint.encode())
+    for input in inputs:
+        hasher.update(hash_file(input).encode())
+    return ShardCompletion(
+        id=id, input_hash=hasher.hexdigest(), outputs=tuple(outputs), marker=marker
+    )
+
+
+def run_shard(completion: ShardCompletion, function: Callable, *args):
+    """
+    Runs `function` with `args` and marks the shard as completed once it finishes successfully.
+    """
+    function(*args)
+    completion.mark()
+
+
+def write_manifest(path: Path, shards: List[Tuple[ShardCompletion, bool]]):
+    """
+    Stores a manifest of the shards of a campaign into a JSON file at `path`.
+    Each shard is stored together with a flag that says if it was already completed by a previous
+    run of the campaign.
+    """
+    with atomic_output(path) as output, open(output, "w") as f:
+        json.dump(
+            [
+                dict(
+                    id=completion.id,
+                    input_hash=completion.input_hash,
+                    outputs=[str(output) for output in completion.outputs],
+                    marker=str(completion.marker),
+                    completed=completed,
+                )
+                for (completion, completed) in shards
+            ],
+            f,
+            indent=2,
+        )
+    completed = sum(1 for (_, completed) in shards if completed)
+    logger.info(f"Campaign manifest {path}: {completed}/{len(shards)} shard(s) already completed")
@@ -0,0 +1,199 @@
+import collections
+import contextlib
+import csv
+import dataclasses
+import functools
+import logging
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Deque, List, Optional, Tuple
+
+from .smi import iterate_smi_batches, parse_smi_line
+from ...utils.io import atomic_output
+
+logger = logging.getLogger(__name__)
+
+# SMARTS patterns of reactive groups that are usually not wanted in drug candidates
+REACTIVE_GROUPS_SMARTS = (
+    # Acyl halide
+    "[CX3](=[OX1])[F,Cl,Br,I]",
+    # Aldehyde
+    "[CX3H1](=O)[#6]",
+    # Isocyanate, isothiocyanate
+    "N=C=[O,S]",
+    # Epoxide, aziridine
+    "C1[O,N]C1",
+    # Azide
+    "N=[N+]=[N-]",
+    # Sulfonyl halide
+    "S(=O)(=O)[F,Cl,Br,I]",
+    # Peroxide
+    "[OX2][OX2]",
+)
+
+
+@dataclass(frozen=True)
+class LigandFilterRules:
+    """
+    Physicochemical rules that each ligand has to satisfy in order to be screened.
+    Each limit can be disabled by setting it to None.
+    """
+
+    """
+    Maximum number of violated Lipinski's rule of five conditions (molecular weight over 500,
+    logP over 5, more than 5 H-bond donors or more than 10 H-bond acceptors).
+    """
+    max_lipinski_violations: Optional[int] = 1
+    max_heavy_atoms: Optional[int] = None
+    max_rotatable_bonds: Optional[int] = 10
+    """
+    Reject ligands that contain one of the `REACTIVE_GROUPS_SMARTS` groups.
+    """
+    exclude_reactive_groups: bool = False
+    """
+    Additional SMARTS patterns, ligands that match any of them are rejected.
+    """
+    excluded_smarts: List[str] = dataclasses.field(default_factory=list)
+
+    def exclusion_patterns(self) -> Tuple[str, ...]:
+        patterns = tuple(self.excluded_smarts)
+        if self.exclude_reactive_groups:
+            patterns = REACTIVE_GROUPS_SMARTS + patterns
+        return patterns
+
+
+@dataclass(frozen=True)
+class PrefilterConfig:
+    """
+    Filters a SMI file by `rules` before it is expanded and screened.
+    """
+
+    input_smi: Path
+    """
+    SMI file with the ligands that satisfy the rules, in their original order.
+    """
+    output_smi: Path
+    """
+    CSV file with the name, SMILES and rejection reason of each rejected ligand.
+    """
+    rejected_csv: Path
+    rules: LigandFilterRules = dataclasses.field(default_factory=LigandFilterRules)
+    """
+    How many lines are evaluated at once by a single worker process.
+    """
+    batch_size: int = 1024
+    """
+    Number of worker processes. If None, all available cores are used.
+    """
+    processes: Optional[int] = None
+
+
+@dataclass
+class PrefilterStats:
+    kept: int = 0
+    rejected: int = 0
+
+
+@functools.lru_cache
+def compile_smarts(patterns: Tuple[str, ...]) -> List[Tuple[str, object]]:
+    from rdkit import Chem
+
+    compiled = []
+    for pattern in patterns:
+        query = Chem.MolFromSmarts(pattern)
+        if query is None:
+            raise Exception(f"Invalid SMARTS pattern `{pattern}`")
+        compiled.append((pattern, query))
+    return compiled
+
+
+def evaluate_ligands(lines: List[bytes], rules: LigandFilterRules) -> List[Optional[str]]:
+    """
+    Evaluates `rules` for a batch of SMI lines.
+    Returns the reason of rejection for each line, or None if the line should be kept.
+    """
+    from rdkit import Chem, RDLogger
+    from rdkit.Chem import Crippen, Descriptors, Lipinski, rdMolDescriptors
+
+    RDLogger.DisableLog("rdApp.*")
+    exclusions = compile_smarts(rules.exclusion_patterns())
+
+    reasons = []
+    for line in lines:
+        molecule = Chem.MolFromSmiles(line.split(maxsplit=1)[0].decode())
+        if molecule is None:
+            reasons.append("invalid SMILES")
+            continue
+
+        violations = []
+        if rules.max_lipinski_violations is not None:
+            lipinski = [
+                ("molecular weight", Descriptors.MolWt(molecule) > 500),
+                ("logP", Crippen.MolLogP(molecule) > 5),
+                ("H-bond donors", Lipinski.NumHDonors(molecule) > 5),
+                ("H-bond acceptors", Lipinski.NumHAcceptors(molecule) > 10),
+            ]
+            failed = [name for (name, violated) in lipinski if violated]
+            if len(failed) > rules.max_lipinski_violations:
+                violations.append(f"Lipinski ({', '.join(failed)})")
+        if rules.max_heavy_atoms is not None:
+            if molecule.GetNumHeavyAtoms() > rules.max_heavy_atoms:
+                violations.append("heavy atoms")
+        if rules.max_rotatable_bonds is not None:
+            if rdMolDescriptors.CalcNumRotatableBonds(molecule) > rules.max_rotatable_bonds:
+                violations.append("rotatable bonds")
+        for (pattern, query) in exclusions:
+            if molecule.HasSubstructMatch(query):
+                violations.append(f"SMARTS {pattern}")
+                break
+        reasons.append("; ".join(violations) if violations else None)
+    return reasons
+
+
+def prefilter_smi_file(config: PrefilterConfig) -> PrefilterStats:
+    """
+    Evaluates the filter rules for batches of ligands in a pool of worker processes, and writes
+    the kept ligands and a report of the rejected ones.
+    Only a bounded number of batches is in flight at once, so that the memory usage does not
+    depend on the size of the input file.
+    """
+    stats = PrefilterStats()
+    processes = config.processes or os.cpu_count() or 1
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=processes))
+        output_smi = stack.enter_context(atomic_output(config.output_smi))
+        rejected_csv = stack.enter_context(atomic_output(config.rejected_csv))
+        input = stack.enter_context(open(config.input_smi, "rb"))
+        output = stack.enter_context(open(output_smi, "wb"))
+        rejected = stack.enter_context(open(rejected_csv, "w", newline=""))
+        writer = csv.writer(rejected, lineterminator="\n")
+        writer.writerow(["NAME", "SMILES", "REASON"])
+        max_pending = processes * 2
+        pending: Deque[Tuple[List[bytes], Future]] = collections.deque()
+
+        def write_results(lines: List[bytes], reasons: List[Optional[str]]):
+            for (line, reason) in zip(lines, reasons):
+                if reason is None:
+                    output.write(line)
+                    stats.kept += 1
+                else:
+                    smiles = line.split(maxsplit=1)[0].decode()
+                    writer.writerow([parse_smi_line(line), smiles, reason])
+                    stats.rejected += 1
+
+        for batch in iterate_smi_batches(input, config.batch_size):
+            lines = [line for (_, line) in batch]
+            pending.append((lines, executor.submit(evaluate_ligands, lines, config.rules)))
+            if len(pending) >= max_pending:
+                (lines, future) = pending.popleft()
+                write_results(lines, future.result())
+        while pending:
+            (lines, future) = pending.popleft()
+            write_results(lines, future.result())
+
+    logger.info(
+        f"Prefiltered {config.input_smi}: kept {stats.kept} ligand(s), rejected {stats.rejected}"
+    )
+    return stats
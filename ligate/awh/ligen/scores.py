@@ -0,0 +1,211 @@
+import contextlib
+import csv
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ...utils.io import atomic_output, open_compressed
+
+logger = logging.getLogger(__name__)
+
+Row = List[str]
+
+
+@dataclass(frozen=True)
+class ScoreReductionConfig:
+    """
+    Reduces per-shard LiGen score CSV files into a ranked file with the best N ligands for each
+    score column, and optionally into a single merged CSV file with all the scores.
+    """
+
+    input_csvs: List[Path]
+    """
+    Ranked output CSV file for each score column.
+    Higher scores are considered to be better.
+    """
+    top_csvs: Dict[str, Path]
+    n: int
+    """
+    CSV file that will contain all rows from all input files.
+    """
+    merged_csv: Optional[Path] = None
+    """
+    CSV file that will contain the union of the best N rows of each column in `partial_columns`.
+    Unlike `top_csvs`, it is not ranked, and it is meant to be used as an input of a further
+    reduction.
+    """
+    partial_csv: Optional[Path] = None
+    partial_columns: Tuple[str, ...] = ()
+    """
+    Process input files as soon as they appear on disk, instead of expecting that all of them
+    already exist.
+    """
+    wait_for_inputs: bool = False
+    poll_interval: float = 5
+    """
+    How long (in seconds) to wait for a new input file to appear, before the reduction fails.
+    A shard whose screening has failed never produces its file, so the reduction would otherwise
+    wait forever. None means wait indefinitely.
+    """
+    timeout: Optional[float] = 4 * 3600
+
+
+@dataclass
+class TopK:
+    """
+    Bounded min-heap that keeps the `n` rows with the highest score.
+    """
+
+    n: int
+    heap: List[Tuple[float, int, Row]] = field(default_factory=list)
+
+    def push(self, score: float, order: int, row: Row):
+        # `-order` makes sure that for equal scores, rows that were seen first are preferred
+        item = (score, -order, row)
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+    def ranked(self) -> List[Row]:
+        return [row for (_, _, row) in sorted(self.heap, reverse=True)]
+
+
+class ScoreReducer:
+    """
+    Incrementally consumes score CSV files, while keeping only a bounded number of rows in memory.
+    """
+
+    def __init__(self, score_columns: List[str], n: int, merged_output=None):
+        self.score_columns = score_columns
+        self.header: Optional[Row] = None
+        self.top = {column: TopK(n) for column in score_columns}
+        self.merged_output = merged_output
+        self.counter = itertools.count()
+
+    def add_csv(self, path: Path):
+        """
+        Adds the rows of the CSV file at `path`, which can be compressed (see `open_compressed`).
+        """
+        # Shards without any ligands produce empty (uncompressed) files
+        if path.stat().st_size == 0:
+            return
+        with open_compressed(path, "r", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return
+            self.check_header(path, header)
+            indices = {column: header.index(column) for column in self.score_columns}
+            for row in reader:
+                if not row:
+                    continue
+                order = next(self.counter)
+                for column, index in indices.items():
+                    # Rows without a score (e.g. for a target that the ligand could not be
+                    # docked into) are not ranked
+                    if row[index]:
+                        self.top[column].push(float(row[index]), order, row)
+                if self.merged_output is not None:
+                    self.merged_output.writerow(row)
+
+    def check_header(self, path: Path, header: Row):
+        if self.header is None:
+            missing = [column for column in self.score_columns if column not in header]
+            if missing:
+                raise Exception(f"Score column(s) {missing} not found in {path}")
+            self.header = header
+            if self.merged_output is not None:
+                self.merged_output.writerow(header)
+        elif header != self.header:
+            raise Exception(f"Header of {path} ({header}) does not match ({self.header})")
+
+    def write_top(self, column: str, path: Path):
+        self.write_rows(path, self.top[column].ranked())
+
+    def write_top_union(self, path: Path):
+        """
+        Writes the union of the top rows of all score columns, in the order in which the rows
+        were added to the reducer.
+        """
+        rows = {}
+        for top in self.top.values():
+            for (_, order, row) in top.heap:
+                rows[-order] = row
+        self.write_rows(path, [rows[order] for order in sorted(rows)])
+
+    def write_rows(self, path: Path, rows: List[Row]):
+        with atomic_output(path) as output, open(output, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            if self.header is not None:
+                writer.writerow(self.header)
+            writer.writerows(rows)
+
+
+def iterate_available_files(
+    paths: List[Path], poll_interval: float, timeout: Optional[float]
+) -> Iterator[Path]:
+    """
+    Yields the given `paths` in the order in which they appear on disk.
+    """
+    remaining = list(paths)
+    last_progress = time.time()
+    while remaining:
+        available = [path for path in remaining if path.is_file()]
+        for path in available:
+            remaining.remove(path)
+            yield path
+        if available:
+            last_progress = time.time()
+        elif remaining:
+            if timeout is not None and time.time() - last_progress > timeout:
+                raise Exception(
+                    f"No new score file has appeared for {timeout:.0f}s, {len(remaining)} score "
+                    f"file(s) are still missing (e.g. {remaining[0]}). Their screening tasks "
+                    "have probably failed."
+                )
+            time.sleep(poll_interval)
+
+
+def reduce_scores(config: ScoreReductionConfig):
+    """
+    Streams the input score files into a merged CSV file and ranked top-N files (see
+    `ScoreReductionConfig`).
+    """
+    if config.wait_for_inputs:
+        inputs = iterate_available_files(
+            config.input_csvs, poll_interval=config.poll_interval, timeout=config.timeout
+        )
+    else:
+        inputs = config.input_csvs
+
+    columns = list(dict.fromkeys([*config.top_csvs.keys(), *config.partial_columns]))
+    with contextlib.ExitStack() as stack:
+        merged_output = None
+        if config.merged_csv is not None:
+            merged_path = stack.enter_context(atomic_output(config.merged_csv))
+            merged_file = stack.enter_context(open(merged_path, "w", newline=""))
+            merged_output = csv.writer(merged_file, lineterminator="\n")
+        reducer = ScoreReducer(columns, config.n, merged_output)
+        for path in inputs:
+            logger.debug(f"Reducing scores from {path}")
+            reducer.add_csv(path)
+
+    for column, path in config.top_csvs.items():
+        reducer.write_top(column, path)
+    if config.partial_csv is not None:
+        reducer.write_top_union(config.partial_csv)
+
+
+def read_top_rows(path: Path, column: str, n: int) -> Tuple[Row, List[Row]]:
+    """
+    Returns the header and the `n` rows with the highest value of `column` from the CSV file at
+    `path`, without loading the whole file into memory.
+    """
+    reducer = ScoreReducer([column], n)
+    reducer.add_csv(path)
+    return (reducer.header, reducer.top[column].ranked())
@@ -0,0 +1,238 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import ContextManager, Tuple
+
+from .common import clean_container_environment
+from ...utils.io import delete_path, ensure_directory, file_lock
+
+logger = logging.getLogger(__name__)
+
+# Path where the session directory is mounted inside the container
+SESSION_CONTAINER_DIR = Path("/session")
+# File in each request directory that contains the PID of the process that owns the request
+REQUEST_OWNER_FILE = "owner"
+
+
+@dataclass(frozen=True)
+class LigenSession:
+    """
+    A long-lived apptainer instance of the LiGen container, shared by all LiGen tasks of the same
+    user (and container) on a single node.
+    Successive LiGen invocations are executed inside the running instance, so that the cost of
+    starting the container and mounting its image is paid only once per node.
+    """
+
+    # Name of the apptainer instance
+    name: str
+    # Node-local directory shared between the host and the instance
+    directory: Path
+    container: Path
+    apptainer_bin: str
+    # Host directories that are mounted into the instance at the same path
+    bind_roots: Tuple[Path, ...] = ()
+
+    @property
+    def requests_dir(self) -> Path:
+        return self.directory / "requests"
+
+    @property
+    def lock_file(self) -> Path:
+        return self.directory / "lock"
+
+    @property
+    def heartbeat_file(self) -> Path:
+        return self.directory / "heartbeat"
+
+    def container_path(self, host_path: Path) -> Path:
+        """
+        Translates a path inside the session directory to a path inside the container.
+        """
+        return SESSION_CONTAINER_DIR / host_path.relative_to(self.directory)
+
+    def touch(self):
+        self.heartbeat_file.touch()
+
+
+    def is_bound(self, path: Path) -> bool:
+        """
+        Returns True if `path` is accessible inside the instance at the same path.
+        """
+        return any(path.is_relative_to(root) for root in self.bind_roots)
+
+
+def session_for_container(
+    container: Path, apptainer_bin: str, bind_roots: Tuple[Path, ...] = ()
+) -> LigenSession:
+    roots = ":".join(str(root) for root in bind_roots)
+    key = hashlib.sha1(f"{os.getuid()}:{container}:{roots}".encode()).hexdigest()[:12]
+    name = f"ligen-{key}"
+    directory = Path(tempfile.gettempdir()) / f"ligen-session-{key}"
+    return LigenSession(
+        name=name,
+        directory=directory,
+        container=container,
+        apptainer_bin=apptainer_bin,
+        bind_roots=bind_roots,
+    )
+
+
+def is_session_running(session: LigenSession) -> bool:
+    result = subprocess.run(
+        [session.apptainer_bin, "instance", "list", "--json", session.name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if result.returncode != 0:
+        return False
+    instances = json.loads(result.stdout or "{}").get("instances") or []
+    return any(instance.get("instance") == session.name for instance in instances)
+
+
+@contextlib.contextmanager
+def ligen_session_request(
+    container: Path, apptainer_bin: str, idle_timeout: int, bind_roots: Tuple[Path, ...] = ()
+) -> ContextManager[Tuple[LigenSession, Path]]:
+    """
+    Registers a new request in the LiGen session of the given `container` on the current node, and
+    yields the session together with a (host) directory reserved for the request.
+
+    If no session is running yet, it is started, together with a watchdog that will stop it
+    after it has had no active requests for `idle_timeout` seconds.
+    Directories in `bind_roots` will be mounted into the session at their own paths.
+    """
+    session = session_for_container(container, apptainer_bin, bind_roots=bind_roots)
+    ensure_directory(session.directory)
+
+    with file_lock(session.lock_file):
+        session.touch()
+        if is_session_running(session):
+            logger.debug(f"Reusing LiGen session {session.name}")
+        else:
+            start_session(session, idle_timeout)
+        request_dir = ensure_directory(session.requests_dir / uuid.uuid4().hex)
+        (request_dir / REQUEST_OWNER_FILE).write_text(str(os.getpid()))
+
+    try:
+        yield (session, request_dir)
+    finally:
+        with file_lock(session.lock_file):
+            session.touch()
+            delete_path(request_dir)
+
+
+def start_session(session: LigenSession, idle_timeout: int):
+    start = time.time()
+    ensure_directory(session.requests_dir)
+    tmp_dir = ensure_directory(session.directory / "tmp")
+    binds = []
+    for root in session.bind_roots:
+        binds.extend(["--bind", f"{root}:{root}"])
+    subprocess.check_output(
+        [
+            session.apptainer_bin,
+            "instance",
+            "start",
+            "--bind", f"{session.directory}:{SESSION_CONTAINER_DIR}",
+            "--no-mount", "tmp",
+            "--bind", f"{tmp_dir}:/tmp",
+            *binds,
+            str(session.container),
+            session.name,
+        ],
+        env=clean_container_environment(),
+    )
+    logger.info(f"Started LiGen session {session.name} in {time.time() - start:.3f}s")
+
+    subprocess.Popen(
+        [
+            sys.executable,
+            "-m", __name__,
+            session.name,
+            str(session.directory),
+            str(session.container),
+            session.apptainer_bin,
+            str(idle_timeout),
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def has_active_requests(session: LigenSession) -> bool:
+    """
+    Returns True if the session has a request whose owner process is still running.
+    Requests of tasks that have crashed (or were killed by HQ) are removed, so that they do not
+    keep the session alive.
+    """
+    active = False
+    for request_dir in session.requests_dir.iterdir():
+        try:
+            pid = int((request_dir / REQUEST_OWNER_FILE).read_text())
+        except (OSError, ValueError):
+            pid = None
+        if pid is not None and is_process_alive(pid):
+            active = True
+        else:
+            logger.warning(f"Removing stale LiGen session request {request_dir.name}")
+            delete_path(request_dir)
+    return active
+
+
+def watch_session(session: LigenSession, idle_timeout: int, interval: int = 10):
+    """
+    Stops the session once it has no active requests (see `has_active_requests`) and its heartbeat
+    is older than `idle_timeout` seconds.
+    """
+    while True:
+        time.sleep(interval)
+        with file_lock(session.lock_file):
+            if not is_session_running(session):
+                return
+            if has_active_requests(session):
+                continue
+            idle = time.time() - session.heartbeat_file.stat().st_mtime
+            if idle < idle_timeout:
+                continue
+            subprocess.run(
+                [session.apptainer_bin, "instance", "stop", session.name],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            delete_path(session.requests_dir)
+            delete_path(session.directory / "tmp")
+            return
+
+
+if __name__ == "__main__":
+    name, directory, container, apptainer_bin, idle_timeout = sys.argv[1:]
+    watch_session(
+        LigenSession(
+            name=name,
+            directory=Path(directory),
+            container=Path(container),
+            apptainer_bin=apptainer_bin,
+        ),
+        idle_timeout=int(idle_timeout),
+    )
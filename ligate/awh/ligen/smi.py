@@ -0,0 +1,420 @@
+import dataclasses
+import logging
+import math
+import os
+import sqlite3
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Bytes that start an (organic subset) atom outside of brackets.
+# Two-letter atoms (Cl, Br) are counted through their first letter only.
+ALIPHATIC_ATOMS = b"BCNOPSFI"
+AROMATIC_ATOMS = b"bcnops"
+RING_CLOSURES = b"0123456789"
+
+
+@dataclasses.dataclass(frozen=True)
+class LigandCostModel:
+    """
+    Linear model that estimates the relative runtime cost of screening a single ligand from its
+    SMILES representation.
+    The cost is only used to balance shards against each other, so its unit is arbitrary.
+    """
+
+    base: float = 1.0
+    heavy_atom: float = 0.05
+    """
+    Approximated by the number of aliphatic chain atoms that are not closed in a ring.
+    """
+    rotatable_bond: float = 0.3
+    ring: float = 0.1
+    """
+    How many lines are processed at once by the vectorized estimator.
+    """
+    batch_size: int = 4096
+
+
+def estimate_ligand_costs(lines: List[bytes], model: LigandCostModel) -> List[float]:
+    """
+    Estimates the cost of each SMILES line in `lines` using `model`.
+
+    The descriptors (heavy atoms, rotatable bonds, rings) are approximated directly from the SMILES
+    characters, without building the molecular graph, so that the estimate stays cheap even for
+    libraries with millions of ligands.
+    """
+    import numpy as np
+
+    if not lines:
+        return []
+
+    smiles = [line.split(maxsplit=1)[0] if line.strip() else b"" for line in lines]
+    width = max(len(s) for s in smiles) or 1
+    buffer = b"".join(s.ljust(width) for s in smiles)
+    chars = np.frombuffer(buffer, dtype=np.uint8).reshape((len(smiles), width))
+
+    def mask_of(table: bytes) -> "np.ndarray":
+        return np.isin(chars, np.frombuffer(table, dtype=np.uint8))
+
+    # Everything inside [...] describes a single atom
+    opened = np.cumsum(chars == ord("["), axis=1)
+    closed = np.cumsum(chars == ord("]"), axis=1)
+    outside = (opened - closed) == 0
+
+    bracket_atoms = (chars == ord("[")).sum(axis=1)
+    aliphatic = (mask_of(ALIPHATIC_ATOMS) & outside).sum(axis=1)
+    aromatic = (mask_of(AROMATIC_ATOMS) & outside).sum(axis=1)
+    heavy_atoms = aliphatic + aromatic + bracket_atoms
+
+    # Each ring closure appears twice in the SMILES, `%nn` closures use two digits
+    percent = (chars == ord("%")).sum(axis=1)
+    digits = (mask_of(RING_CLOSURES) & outside).sum(axis=1) - percent
+    rings = digits // 2
+    rotatable = np.clip(aliphatic - rings, 0, None)
+
+    costs = (
+        model.base
+        + model.heavy_atom * heavy_atoms
+        + model.rotatable_bond * rotatable
+        + model.ring * rings
+    )
+    return costs.tolist()
+
+
+def parse_smi_line(line: bytes) -> str:
+    """
+    Returns the name of the ligand described by a single SMI line.
+    The name is the second column of the line, or the SMILES itself if the line has no name.
+    """
+    columns = line.split(maxsplit=2)
+    return (columns[1] if len(columns) > 1 else columns[0]).decode()
+
+
+def iterate_smi_batches(file: BinaryIO, batch_size: int) -> Iterator[List[Tuple[int, bytes]]]:
+    """
+    Lazily reads non-empty lines of a SMI file in batches of (at most) `batch_size` lines.
+    Each line is returned together with its byte offset in the file.
+    """
+    batch = []
+    offset = 0
+    for line in file:
+        line_offset = offset
+        offset += len(line)
+        if not line.strip():
+            continue
+        batch.append((line_offset, line if line.endswith(b"\n") else line + b"\n"))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iterate_smi_costs(
+    path: Path, model: Optional[LigandCostModel]
+) -> Iterator[Iterable[Tuple[int, bytes, float]]]:
+    """
+    Iterates batches of (offset, line, cost) triples of the SMI file at `path`.
+    If `model` is None, each ligand has a unit cost.
+    """
+    batch_size = model.batch_size if model is not None else 4096
+    with open(path, "rb") as f:
+        for batch in iterate_smi_batches(f, batch_size):
+            if model is None:
+                costs = [1] * len(batch)
+            else:
+                costs = estimate_ligand_costs([line for (_, line) in batch], model)
+            yield ((offset, line, cost) for ((offset, line), cost) in zip(batch, costs))
+
+
+def write_smi_sample(input_smi: Path, output_smi: Path, count: int) -> int:
+    """
+    Writes (at most) the first `count` ligands of `input_smi` into `output_smi`.
+    Returns the number of written ligands.
+    """
+    written = 0
+    with open(input_smi, "rb") as input, open(output_smi, "wb") as output:
+        for batch in iterate_smi_batches(input, batch_size=count):
+            output.writelines(line for (_, line) in batch)
+            written = len(batch)
+            break
+    return written
+
+
+@dataclasses.dataclass(frozen=True)
+class SmiLocation:
+    file: Path
+    offset: int
+    # Length of the line in bytes, without the line terminator
+    length: int
+
+
+class SmiIndex:
+    """
+    On-disk (SQLite) index that maps ligand names to the location of their line in a SMI file.
+    It allows reading a few specific ligands without scanning the whole (potentially huge) SMI
+    file.
+
+    If a name appears multiple times, only its first occurrence is indexed.
+    """
+
+    # Maximum number of SQL parameters used in a single lookup query
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, path: Path, connection: sqlite3.Connection):
+        self.path = path
+        self.connection = connection
+        self.file_ids: Dict[Path, int] = {}
+
+    @staticmethod
+    def create(path: Path) -> "SmiIndex":
+        """
+        Creates a new empty index at `path`, overwriting any existing index.
+        """
+        if path.exists():
+            os.unlink(path)
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT UNIQUE)")
+        connection.execute(
+            """CREATE TABLE ligands (
+                name TEXT PRIMARY KEY,
+                file INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            ) WITHOUT ROWID"""
+        )
+        return SmiIndex(path, connection)
+
+    @staticmethod
+    def open(path: Path) -> "SmiIndex":
+        """
+        Opens an existing index at `path` for reading.
+        """
+        if not path.is_file():
+            raise Exception(f"SMI index {path} does not exist")
+        connection = sqlite3.connect(f"file:{path.absolute()}?mode=ro", uri=True)
+        return SmiIndex(path, connection)
+
+    def add(self, file: Path, entries: Iterable[Tuple[int, bytes]]):
+        """
+        Adds (offset, line) entries of the SMI file at `file` to the index.
+        """
+        file = file.absolute()
+        file_id = self.file_ids.get(file)
+        if file_id is None:
+            cursor = self.connection.execute("INSERT INTO files (path) VALUES (?)", (str(file),))
+            file_id = cursor.lastrowid
+            self.file_ids[file] = file_id
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO ligands (name, file, offset, length) VALUES (?, ?, ?, ?)",
+            (
+                (parse_smi_line(line), file_id, offset, len(line.rstrip(b"\r\n")))
+                for (offset, line) in entries
+            ),
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def locate(self, names: Iterable[str]) -> Dict[str, SmiLocation]:
+        """
+        Finds the locations of the given ligand `names`.
+        Names that are not present in the index are not included in the result.
+        """
+        files = {
+            file_id: Path(path)
+            for (file_id, path) in self.connection.execute("SELECT id, path FROM files")
+        }
+        names = list(dict.fromkeys(names))
+        locations = {}
+        for start in range(0, len(names), SmiIndex.LOOKUP_CHUNK):
+            chunk = names[start:start + SmiIndex.LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT name, file, offset, length FROM ligands WHERE name IN ({placeholders})",
+                chunk,
+            )
+            for (name, file_id, offset, length) in rows:
+                locations[name] = SmiLocation(file=files[file_id], offset=offset, length=length)
+        return locations
+
+    def read_lines(self, names: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+        """
+        Reads the SMI lines (without line terminators) of the given ligand `names`.
+        Yields (name, line) pairs in the order in which the ligands appear in the indexed files.
+        """
+        locations = sorted(
+            self.locate(names).items(), key=lambda item: (str(item[1].file), item[1].offset)
+        )
+        file: Optional[BinaryIO] = None
+        try:
+            for (name, location) in locations:
+                if file is None or file.name != str(location.file):
+                    if file is not None:
+                        file.close()
+                    file = open(location.file, "rb")
+                file.seek(location.offset)
+                yield (name, file.read(location.length))
+        finally:
+            if file is not None:
+                file.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self) -> "SmiIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and self.connection.in_transaction:
+            self.commit()
+        self.close()
+
+
+@dataclasses.dataclass
+class SmiMeasurement:
+    # Number of kept ligands
+    count: int
+    # Total estimated cost of kept ligands
+    total_cost: float
+    # Flag for each (non-empty) line of the file, says if the line was kept
+    kept: bytearray
+
+
+def measure_smi_file(
+    input_smi: Path,
+    cost_model: Optional[LigandCostModel],
+    filter: Optional[Callable[[List[bytes]], List[bool]]] = None,
+) -> SmiMeasurement:
+    measurement = SmiMeasurement(count=0, total_cost=0.0, kept=bytearray())
+    for batch in iterate_smi_costs(input_smi, cost_model):
+        batch = list(batch)
+        flags = filter([line for (_, line, _) in batch]) if filter is not None else None
+        for (index_in_batch, (_, _, cost)) in enumerate(batch):
+            keep = flags is None or flags[index_in_batch]
+            # One byte per line, this is negligible compared to the size of the lines themselves
+            measurement.kept.append(keep)
+            if keep:
+                measurement.count += 1
+                measurement.total_cost += cost
+    return measurement
+
+
+def shard_smi_file(
+    input_smi: Path,
+    output_dir: Path,
+    max_molecules: int,
+    cost_model: Optional[LigandCostModel] = None,
+    index: Optional[SmiIndex] = None,
+    filter: Optional[Callable[[List[bytes]], List[bool]]] = None,
+    measurement: Optional[SmiMeasurement] = None,
+) -> List[Path]:
+    """
+    Splits the SMI file at `input_smi` into shards stored in `output_dir`, and returns their paths.
+
+    The number of shards is chosen so that on average, each shard has `max_molecules` ligands.
+    If `cost_model` is None, each shard (except for the last one) will have exactly `max_molecules`
+    ligands. Otherwise, the shards are balanced so that they have roughly the same estimated cost,
+    which means that shards with cheap ligands will contain more lines than shards with expensive
+    ones.
+
+    The shards are streamed directly to disk, so the memory usage does not depend on the size of
+    the input file.
+
+    If `index` is passed, the locations of all ligands in `input_smi` are added to it.
+
+    If `filter` is passed, it is called (exactly once) with batches of lines, and it should return
+    a flag for each line that says whether the line should be kept. Lines that are not kept are not
+    written into any shard (but they are still indexed).
+
+    If `measurement` of `input_smi` (see `measure_smi_file`) was already computed, it is used
+    instead of reading the file twice, and `filter` is ignored.
+    """
+    if measurement is None:
+        measurement = measure_smi_file(input_smi, cost_model, filter=filter)
+    if measurement.count == 0 and index is None:
+        return []
+
+    shard_count = math.ceil(measurement.count / max_molecules)
+    if cost_model is None or shard_count == 0:
+        target_cost = max_molecules
+    else:
+        target_cost = measurement.total_cost / shard_count
+    shards = [output_dir / f"{input_smi.stem}-{shard}.smi" for shard in range(shard_count)]
+    write_smi_shards(input_smi, shards, measurement, cost_model, target_cost, index=index)
+    return shards
+
+
+def split_smi_file(
+    input_smi: Path, output_smis: List[Path], cost_model: Optional[LigandCostModel] = None
+):
+    """
+    Splits the SMI file at `input_smi` into exactly `len(output_smis)` shards.
+    The shards are balanced either by their line count or by their estimated cost (see
+    `shard_smi_file`). If there are less ligands than shards, some of the shards will be empty.
+    """
+    measurement = measure_smi_file(input_smi, cost_model)
+    if cost_model is None:
+        target_cost = math.ceil(measurement.count / len(output_smis))
+    else:
+        target_cost = measurement.total_cost / len(output_smis)
+    write_smi_shards(input_smi, output_smis, measurement, cost_model, target_cost)
+    for path in output_smis:
+        path.touch()
+
+
+def write_smi_shards(
+    input_smi: Path,
+    shards: List[Path],
+    measurement: SmiMeasurement,
+    cost_model: Optional[LigandCostModel],
+    target_cost: float,
+    index: Optional[SmiIndex] = None,
+):
+    """
+    Streams the kept lines of `input_smi` into `shards`, so that each shard has (roughly)
+    `target_cost` cost.
+    """
+    logger.debug(
+        f"Splitting {input_smi} ({measurement.count} ligand(s), estimated cost "
+        f"{measurement.total_cost:.2f}) into {len(shards)} shard(s) with target cost "
+        f"{target_cost:.2f}"
+    )
+
+    shard_count = len(shards)
+    opened = 0
+    output: Optional[BinaryIO] = None
+    cumulative_cost = 0.0
+    remaining = measurement.count
+    position = 0
+
+    try:
+        for batch in iterate_smi_costs(input_smi, cost_model):
+            indexed = []
+            for (offset, line, cost) in batch:
+                indexed.append((offset, line))
+                position += 1
+                if not measurement.kept[position - 1]:
+                    continue
+                boundary = target_cost * opened
+                # Close the current shard if it has reached its cost boundary, or if each of the
+                # remaining shards needs one of the remaining lines.
+                if output is not None and opened < shard_count and (
+                    cumulative_cost >= boundary or remaining == shard_count - opened
+                ):
+                    output.close()
+                    output = None
+                if output is None:
+                    output = open(shards[opened], "wb")
+                    opened += 1
+                output.write(line)
+                cumulative_cost += cost
+                remaining -= 1
+            if index is not None:
+                index.add(input_smi, indexed)
+    finally:
+        if output is not None:
+            output.close()
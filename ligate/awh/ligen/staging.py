@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from ...utils.io import atomic_output, ensure_directory, file_lock
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StagingStats:
+    hits: int = 0
+    misses: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.hits} hit(s), {self.misses} miss(es)"
+
+
+class NodeStagingCache:
+    """
+    Node-local copies of input files that are shared by many tasks (e.g. proteins and probes).
+    The first task on a node that needs a file copies it from shared storage, other tasks on the
+    same node then reuse the local copy, so that the shared filesystem is not hit by thousands of
+    reads of the same small files.
+
+    Files are stored under the hash of their content. They are found by their path, size and
+    modification time, so a reused file only costs a single `stat` call on the shared filesystem,
+    and a modified file is staged again.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.stats = StagingStats()
+
+    @staticmethod
+    def for_current_node() -> "NodeStagingCache":
+        directory = Path(tempfile.gettempdir()) / f"ligen-staging-{os.getuid()}"
+        return NodeStagingCache(directory)
+
+    @property
+    def files_dir(self) -> Path:
+        return self.directory / "files"
+
+    @property
+    def entries_dir(self) -> Path:
+        return self.directory / "entries"
+
+    @property
+    def lock_file(self) -> Path:
+        return self.directory / "lock"
+
+    def stage(self, path: Path) -> Path:
+        """
+        Returns the path of a node-local copy of the file at `path`. The staged file has the same
+        name as the original file.
+        """
+        path = path.absolute()
+        stat = path.stat()
+        key = hashlib.sha1(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+        entry = self.entries_dir / key
+
+        # Staged files are never modified, so they can be looked up without the lock
+        staged = self.lookup(entry)
+        if staged is None:
+            ensure_directory(self.directory)
+            with file_lock(self.lock_file):
+                # Another task might have staged the file in the meantime
+                staged = self.lookup(entry)
+                if staged is None:
+                    self.stats.misses += 1
+                    return self.copy(path, entry)
+        self.stats.hits += 1
+        return staged
+
+    def lookup(self, entry: Path) -> Optional[Path]:
+        if not entry.is_file():
+            return None
+        staged = self.files_dir / entry.read_text()
+        return staged if staged.is_file() else None
+
+    def copy(self, path: Path, entry: Path) -> Path:
+        logger.debug(f"Staging {path} into {self.directory}")
+        ensure_directory(self.files_dir)
+        ensure_directory(self.entries_dir)
+        hasher = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.files_dir, delete=False) as output:
+            try:
+                with open(path, "rb") as input:
+                    while chunk := input.read(1024 * 1024):
+                        hasher.update(chunk)
+                        output.write(chunk)
+            except BaseException:
+                os.unlink(output.name)
+                raise
+        # The file keeps its original name, because some tools might depend on it
+        relative_path = Path(hasher.hexdigest()) / path.name
+        staged = self.files_dir / relative_path
+        ensure_directory(staged.parent)
+        os.replace(output.name, staged)
+        shutil.copymode(path, staged)
+        with atomic_output(entry) as partial:
+            partial.write_text(str(relative_path))
+        return staged
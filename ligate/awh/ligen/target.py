@@ -0,0 +1,111 @@
+import logging
+import math
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Set, Tuple
+
+from ...utils.io import atomic_output
+
+logger = logging.getLogger(__name__)
+
+Coordinates = Tuple[float, float, float]
+
+# Radius of the probe filtering performed by LiGen during target preparation
+PROBE_FILTER_RADIUS = 10.0
+# Version of the pocket trimming performed by `prepare_target`, it has to be increased whenever
+# the trimming changes which atoms are kept, so that scores cached for older pockets are not used
+POCKET_TRIMMING_VERSION = 1
+
+PDB_ATOM_RECORDS = ("ATOM  ", "HETATM", "ANISOU")
+
+
+@dataclass(frozen=True)
+class TargetPreparationConfig:
+    """
+    Prepares a screening target once for all shards of a campaign.
+
+    LiGen filters the protein atoms around the probe before it identifies the pocket and its
+    anchor points. The protein is trimmed in advance to the residues that can pass this filter, so
+    that the target preparation of each shard only processes the pocket region, and only a small
+    file has to be copied into each LiGen container.
+    """
+
+    input_protein_pdb: Path
+    """
+    MOL2 crystal structure, serves as a probe for the protein PDB.
+    """
+    input_probe_mol2: Path
+    """
+    PDB file with the residues of the protein around the probe.
+    """
+    output_pocket_pdb: Path
+    radius: float = PROBE_FILTER_RADIUS
+
+
+def read_mol2_coordinates(path: Path) -> List[Coordinates]:
+    coordinates = []
+    in_atoms = False
+    with open(path) as f:
+        for line in f:
+            if line.startswith("@<TRIPOS>"):
+                in_atoms = line.strip() == "@<TRIPOS>ATOM"
+            elif in_atoms and line.strip():
+                fields = line.split()
+                coordinates.append((float(fields[2]), float(fields[3]), float(fields[4])))
+    return coordinates
+
+
+def pdb_residue_key(line: str) -> str:
+    # Residue name, chain, sequence number and insertion code
+    return line[17:27]
+
+
+def pdb_coordinates(line: str) -> Coordinates:
+    return (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+
+
+def prepare_target(config: TargetPreparationConfig):
+    probe = read_mol2_coordinates(config.input_probe_mol2)
+    if not probe:
+        raise Exception(f"Probe {config.input_probe_mol2} does not contain any atoms")
+
+    # The margin makes sure that the kept residues are a superset of the atoms filtered by LiGen,
+    # regardless of whether it measures the distance to the nearest probe atom or to the center
+    # of the probe
+    center = tuple(sum(atom[axis] for atom in probe) / len(probe) for axis in range(3))
+    margin = max(math.dist(center, atom) for atom in probe)
+    cutoff = (config.radius + margin) ** 2
+
+    with open(config.input_protein_pdb) as f:
+        lines = f.readlines()
+    kept_residues: Set[str] = set()
+    for line in lines:
+        if line.startswith(("ATOM  ", "HETATM")):
+            position = pdb_coordinates(line)
+            if any(
+                sum((position[axis] - atom[axis]) ** 2 for axis in range(3)) <= cutoff
+                for atom in probe
+            ):
+                kept_residues.add(pdb_residue_key(line))
+    if not kept_residues:
+        raise Exception(
+            f"No residues of {config.input_protein_pdb} are located near the probe "
+            f"{config.input_probe_mol2}"
+        )
+
+    kept_atoms = 0
+    with atomic_output(config.output_pocket_pdb) as output, open(output, "w") as f:
+        for line in lines:
+            if line.startswith(PDB_ATOM_RECORDS):
+                if pdb_residue_key(line) not in kept_residues:
+                    continue
+                if not line.startswith("ANISOU"):
+                    kept_atoms += 1
+            elif line.startswith("CONECT"):
+                # Connections might refer to removed atoms
+                continue
+            f.write(line)
+    logger.info(
+        f"Prepared target {config.input_protein_pdb}: kept {len(kept_residues)} residue(s) "
+        f"({kept_atoms} atom(s)) around the probe"
+    )
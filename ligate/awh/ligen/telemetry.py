@@ -0,0 +1,213 @@
+import contextlib
+import dataclasses
+import json
+import logging
+import socket
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List
+
+from .common import LigenTaskContext
+from ...utils.io import ensure_directory, open_compressed
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ContainerTimings:
+    """
+    Durations (in seconds) of the individual phases of commands executed inside a LiGen container.
+    """
+
+    # Preparation of the container environment (e.g. connecting to a persistent session)
+    setup: float = 0
+    # Staging and copying of input files into the container
+    input_copy: float = 0
+    # Time between launching a command and the start of its execution inside the container
+    startup: float = 0
+    # Execution of the command inside the container
+    compute: float = 0
+    # Copying of output files out of the container
+    output_copy: float = 0
+    copied_bytes: int = 0
+    # Number of executed commands
+    commands: int = 0
+
+    def add(self, other: "ContainerTimings"):
+        for field in dataclasses.fields(self):
+            setattr(self, field.name, getattr(self, field.name) + getattr(other, field.name))
+
+
+PHASES = ("setup", "input_copy", "startup", "compute", "output_copy")
+
+
+@dataclass
+class ShardTelemetry:
+    """
+    Timing breakdown of the processing of a single shard by a LiGen task.
+    """
+
+    # Kind of the task (e.g. "screening")
+    kind: str
+    # Name of the shard, derived from the name of its input file
+    shard: str
+    timings: ContainerTimings = dataclasses.field(default_factory=ContainerTimings)
+    # Number of ligands processed by the task, it is set by the task
+    ligands: int = 0
+
+    def to_record(self, start: float, duration: float, failed: bool) -> Dict:
+        record = dict(
+            kind=self.kind,
+            shard=self.shard,
+            hostname=socket.gethostname(),
+            start=start,
+            duration=duration,
+            failed=failed,
+            ligands=self.ligands,
+            ligands_per_second=self.ligands / duration if duration > 0 else 0,
+        )
+        record.update(dataclasses.asdict(self.timings))
+        return record
+
+
+@contextlib.contextmanager
+def shard_telemetry(ctx: LigenTaskContext, kind: str, input: Path) -> Iterator[ShardTelemetry]:
+    """
+    Measures the processing of the shard with the given `input` file. The timings of LiGen
+    containers are collected by passing the yielded object to `ligen_task_container`.
+    If `ctx.telemetry_dir` is set, a record is appended to a JSONL file of the task in that
+    directory once the shard is processed (even if it fails).
+    """
+    telemetry = ShardTelemetry(kind=kind, shard=input.name.partition(".")[0])
+    start = time.time()
+    failed = True
+    try:
+        yield telemetry
+        failed = False
+    finally:
+        if ctx.telemetry_dir is not None:
+            record = telemetry.to_record(start, time.time() - start, failed=failed)
+            path = ensure_directory(ctx.telemetry_dir) / f"{kind}-{telemetry.shard}.jsonl"
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def count_ligands(path: Path, header: bool) -> int:
+    """
+    Counts the ligands of a SMI file or of a scores CSV file (with a `header`).
+    """
+    count = 0
+    with open_compressed(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                count += 1
+    return max(0, count - 1) if header else count
+
+
+def read_telemetry_records(paths: Iterable[Path]) -> List[Dict]:
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+@dataclass
+class TelemetrySummary:
+    """
+    Campaign-level throughput of a single kind of LiGen tasks.
+    """
+
+    kind: str
+    shards: int = 0
+    failed: int = 0
+    ligands: int = 0
+    # Sum of the durations of all tasks
+    duration: float = 0
+    # Sum of the durations of each phase (see `PHASES`) over all tasks
+    phases: Dict[str, float] = dataclasses.field(
+        default_factory=lambda: {phase: 0.0 for phase in PHASES}
+    )
+    copied_bytes: int = 0
+    first_start: float = float("inf")
+    last_end: float = 0
+
+    @property
+    def wall_time(self) -> float:
+        return max(0.0, self.last_end - self.first_start)
+
+    @property
+    def other(self) -> float:
+        """
+        Time spent in the tasks outside of LiGen containers (e.g. post-processing of scores).
+        """
+        return max(0.0, self.duration - sum(self.phases.values()))
+
+    @property
+    def overhead_fraction(self) -> float:
+        """
+        Fraction of the task time that was not spent by computing inside the containers.
+        """
+        if self.duration == 0:
+            return 0
+        return 1 - self.phases["compute"] / self.duration
+
+    def to_dict(self) -> Dict:
+        wall_time = self.wall_time
+        return dict(
+            kind=self.kind,
+            shards=self.shards,
+            failed=self.failed,
+            ligands=self.ligands,
+            task_time=self.duration,
+            wall_time=wall_time,
+            ligands_per_second=self.ligands / wall_time if wall_time > 0 else 0,
+            ligands_per_task_second=self.ligands / self.duration if self.duration > 0 else 0,
+            overhead_fraction=self.overhead_fraction,
+            copied_bytes=self.copied_bytes,
+            **self.phases,
+            other=self.other,
+        )
+
+
+def aggregate_telemetry(records: Iterable[Dict]) -> List[TelemetrySummary]:
+    """
+    Aggregates shard records (see `ShardTelemetry`) into a summary per kind of task.
+    """
+    summaries: Dict[str, TelemetrySummary] = {}
+    for record in records:
+        summary = summaries.setdefault(record["kind"], TelemetrySummary(kind=record["kind"]))
+        summary.shards += 1
+        summary.failed += int(record["failed"])
+        summary.ligands += record["ligands"]
+        summary.duration += record["duration"]
+        for phase in PHASES:
+            summary.phases[phase] += record[phase]
+        summary.copied_bytes += record["copied_bytes"]
+        summary.first_start = min(summary.first_start, record["start"])
+        summary.last_end = max(summary.last_end, record["start"] + record["duration"])
+    return sorted(summaries.values(), key=lambda summary: summary.kind)
+
+
+def format_telemetry_report(summaries: List[TelemetrySummary]) -> str:
+    lines = []
+    for summary in summaries:
+        values = summary.to_dict()
+        lines.append(
+            f"{summary.kind}: {summary.shards} shard(s) ({summary.failed} failed), "
+            f"{summary.ligands} ligand(s)"
+        )
+        lines.append(
+            f"  throughput: {values['ligands_per_second']:.2f} ligands/s over "
+            f"{values['wall_time']:.1f}s of wall time, "
+            f"{values['ligands_per_task_second']:.2f} ligands/s per task"
+        )
+        lines.append(
+            f"  overhead: {100 * summary.overhead_fraction:.1f}% of {summary.duration:.1f}s "
+            f"of task time, copied {summary.copied_bytes} B"
+        )
+        for (phase, duration) in (*summary.phases.items(), ("other", summary.other)):
+            share = 100 * duration / summary.duration if summary.duration > 0 else 0
+            lines.append(f"    {phase:<12} {duration:10.1f}s {share:5.1f}%")
+    return "\n".join(lines)
@@ -1,136 +1,407 @@
+import csv
+import dataclasses
 import json
 import logging
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
-from .common import LigenTaskContext
-from .container import ligen_container
+from .bisection import concatenate_csvs, read_mol2_records, read_smi_records, run_with_bisection
+from .common import D23RTMB_PREFIX, LigenTaskContext
+from .container import LigenContainerContext, ligen_task_container
+from .expansion import ExpansionConfig
+from .target import PROBE_FILTER_RADIUS
+from .telemetry import ShardTelemetry, count_ligands, shard_telemetry
+from ...utils.io import atomic_output, delete_file, open_compressed
 
 logger = logging.getLogger(__name__)
 
+# Column of the output CSV that contains the screening score of each ligand
+SCREENING_SCORE_COLUMN = "D22_SCORE"
+# Column of the output CSV that contains the (more expensive) rescoring score of each ligand
+RESCORING_SCORE_COLUMN = "D23RTMB_SCORE"
+
 
 @dataclass(frozen=True)
-class ScreeningConfig:
+class ScreeningTarget:
     """
-    Performs virtual screening on a set of ligands, outputs a CSV with scores per each ligand.
+    Protein against which ligands are screened.
     """
 
     """
-    MOL2 crystal structure, serves as a probe for the protein PDB.
+    Name of the target, it is used to label the scores of the target in output CSV files.
     """
-    input_probe_mol2: Path
+    name: str
     """
     Input protein in PDB format.
     """
-    input_protein_pdb: Path
+    protein_pdb: Path
+    """
+    MOL2 crystal structure, serves as a probe for the protein PDB.
+    """
+    probe_mol2: Path
+    """
+    Residues of the protein around the probe, prepared in advance by `prepare_target`. If set,
+    LiGen identifies the pocket of the target from this file instead of from `protein_pdb`.
+    """
+    pocket_pdb: Optional[Path] = None
+    """
+    Radius around the probe with which `pocket_pdb` was trimmed by `prepare_target`, None if the
+    pocket was provided as an input.
+    """
+    pocket_radius: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class ScreeningConfig:
+    """
+    Performs virtual screening on a set of ligands, outputs a CSV with scores per each ligand.
+    """
+
+    """
+    Targets against which the ligands are screened.
+    All targets are screened by a single LiGen pipeline, so that the ligands are parsed and
+    unfolded only once.
+    """
+    targets: Tuple[ScreeningTarget, ...]
     """
     Expanded SMILES file in MOL2 format.
     """
     input_expanded_mol2: Path
     """
     Scores for input ligands in CSV format.
+    If there are multiple targets, the CSV file contains a score column per target (see
+    `screening_score_columns`).
     """
     output_scores_csv: Path
 
-    input_protein_name: str
-
     cores: int
     num_parser: int = 20
     num_workers_unfold: int = 20
     num_workers_docknscore: int = 100
+    """
+    Rescore the best pose of each ligand with the D23RTMB scoring function, which is much more
+    expensive than D22. Only a single target is supported.
+    """
+    rescore: bool = False
+    """
+    If set, ligands that make the screening fail are isolated by bisecting the shard (see
+    `run_with_bisection`) and stored into this MOL2 file, instead of failing the whole shard.
+    The shard still fails if more than about `MAX_REJECTED_LIGANDS` ligands would have to be
+    isolated.
+    """
+    rejects_mol2: Optional[Path] = None
 
 
-def ligen_screen_ligands(ctx: LigenTaskContext, config: ScreeningConfig):
-    logger.info(f"Starting virtual screening of {config.input_expanded_mol2}")
-    with ligen_container(container=ctx.container_path) as ligen:
-        input_smi = ligen.map_input(config.input_expanded_mol2)
-        input_pdb = ligen.map_input(config.input_protein_pdb)
-        input_mol2 = ligen.map_input(config.input_probe_mol2)
-        output_csv = ligen.map_output(config.output_scores_csv)
-
-        description = {
-            "name": "vscreen",
-            "pipeline": [
-                {
-                    "kind": "reader_mol2",
-                    "name": "reader",
-                    "input_filepath": str(input_smi),
-                },
-                {
-                    "kind": "parser_mol2",
-                    "name": "parser",
-                    "number_of_workers": config.num_parser,
-                },
-                {"kind": "bucketizer_ligand", "name": "bucketizer_dock"},
-                {"kind": "unfold", "cpp_workers": config.num_workers_unfold},
-                {
-                    "kind": "dock",
-                    "name": "dock",
-                    "number_of_restart": "256",
-                    "clipping_factor": "256",
-                    "cpp_workers": config.num_workers_docknscore,
-                },
-                {"kind": "bucketizer_ligand", "name": "bucketizer_score"},
+def screening_score_columns(
+    targets: Tuple[ScreeningTarget, ...], rescore: bool = False
+) -> List[str]:
+    """
+    Returns the names of the score columns of a screening output CSV file.
+    With a single target, the file contains the score column(s) produced by LiGen. With multiple
+    targets, it contains a separate score column for each target.
+    """
+    if len(targets) == 1:
+        if rescore:
+            return [SCREENING_SCORE_COLUMN, RESCORING_SCORE_COLUMN]
+        return [SCREENING_SCORE_COLUMN]
+    if rescore:
+        raise Exception("D23RTMB rescoring is only supported with a single screening target")
+    return [f"{SCREENING_SCORE_COLUMN}_{target.name}" for target in targets]
+
+
+def create_screening_description(
+    config: ScreeningConfig,
+    input_ligands: Path,
+    input_targets: List[ScreeningTarget],
+    output_csv: Path,
+) -> Dict[str, Any]:
+    """
+    Creates a LiGen pipeline description for virtual screening.
+    The paths (including the paths of `input_targets`) have to be accessible inside the LiGen
+    container.
+    """
+    pipeline = [
+        {
+            "kind": "reader_mol2",
+            "name": "reader",
+            "input_filepath": str(input_ligands),
+        },
+        {
+            "kind": "parser_mol2",
+            "name": "parser",
+            "number_of_workers": config.num_parser,
+        },
+        {"kind": "bucketizer_ligand", "name": "bucketizer_dock"},
+        {"kind": "unfold", "cpp_workers": config.num_workers_unfold},
+        {
+            "kind": "dock",
+            "name": "dock",
+            "number_of_restart": "256",
+            "clipping_factor": "256",
+            "cpp_workers": config.num_workers_docknscore,
+        },
+        {"kind": "bucketizer_ligand", "name": "bucketizer_score"},
+        {
+            "kind": "score",
+            "name": "score",
+            "scoring_functions": ["d22"],
+            "cpp_workers": config.num_workers_docknscore,
+        },
+        {
+            "kind": "filter_bucket",
+            "name": "ps",
+            "property_name": SCREENING_SCORE_COLUMN,
+            "keep_top": "1",
+        },
+    ]
+    if config.rescore:
+        target = input_targets[0]
+        pipeline.extend(
+            [
                 {
-                    "kind": "score",
-                    "name": "score",
-                    "scoring_functions": ["d22"],
-                    "cpp_workers": config.num_workers_docknscore,
+                    "kind": "d23rtmb_ligand",
+                    "name": "d23",
+                    "protein_filepath": str(target.protein_pdb),
+                    "probe_filepath": str(target.probe_mol2),
+                    "prefix": D23RTMB_PREFIX,
+                    "cuda": "0",
                 },
                 {
-                    "kind": "filter_bucket",
-                    "name": "ps",
-                    "property_name": "D22_SCORE",
+                    "kind": "filter_ligand",
+                    "name": "ranker",
+                    "property_name": RESCORING_SCORE_COLUMN,
                     "keep_top": "1",
                 },
-                # {
-                #     "kind": "d23rtmb_ligand",
-                #     "name": "d23",
-                #     "protein_filepath": str(input_pdb),
-                #     "probe_filepath": str(input_mol2),
-                #     "prefix": "micromamba --name d23rtmb run -e BABEL_LIBDIR=/opt/micromamba/envs/d23rtmb/lib/openbabel/3.1.0",
-                #     "cuda": "0",
-                # },
-                # {
-                #     "kind": "filter_ligand",
-                #     "name": "ranker",
-                #     "property_name": "D23RTMB_SCORE",
-                #     "keep_top": "1",
-                # },
-                {
-                    "kind": "writer_csv_ligand",
-                    "name": "writer",
-                    "wait_setup": "reader",
-                    "output_filepath": str(output_csv),
-                    "print_preamble": "1",
-                    "csv_fields": ["SCORE_PROTEIN_NAME", "D22_SCORE"],
-                    "separator": ",",
-                },
-            ],
-            "targets": [
-                {
-                    "name": config.input_protein_name,
-                    "configuration": {
-                        "input": {
-                            "format": "protein",
-                            "protein_path": str(input_pdb),
-                        },
-                        "filtering": {
-                            "algorithm": "probe",
-                            "path": str(input_mol2),
-                            "radius": "10",
-                        },
-                        "pocket_identification": {"algorithm": "caviar_like"},
-                        "anchor_points": {
-                            "algorithms": "maximum_points",
-                            "separation_radius": "4",
-                        },
-                    },
-                }
-            ],
+            ]
+        )
+    csv_fields = ["SCORE_PROTEIN_NAME", SCREENING_SCORE_COLUMN]
+    if config.rescore:
+        csv_fields.append(RESCORING_SCORE_COLUMN)
+    pipeline.append(
+        {
+            "kind": "writer_csv_ligand",
+            "name": "writer",
+            "wait_setup": "reader",
+            "output_filepath": str(output_csv),
+            "print_preamble": "1",
+            "csv_fields": csv_fields,
+            "separator": ",",
         }
+    )
+
+    return {
+        "name": "vscreen",
+        "pipeline": pipeline,
+        "targets": [
+            {
+                "name": target.name,
+                "configuration": {
+                    "input": {
+                        "format": "protein",
+                        "protein_path": str(target.pocket_pdb or target.protein_pdb),
+                    },
+                    "filtering": {
+                        "algorithm": "probe",
+                        "path": str(target.probe_mol2),
+                        "radius": f"{PROBE_FILTER_RADIUS:g}",
+                    },
+                    "pocket_identification": {"algorithm": "caviar_like"},
+                    "anchor_points": {
+                        "algorithms": "maximum_points",
+                        "separation_radius": "4",
+                    },
+                },
+            }
+            for target in input_targets
+        ],
+    }
+
+
+def map_screening_targets(
+    ligen: LigenContainerContext, targets: Tuple[ScreeningTarget, ...], rescore: bool = False
+) -> List[ScreeningTarget]:
+    """
+    Maps the files of `targets` into the container. If a target has a prepared pocket, its whole
+    protein is only needed for rescoring.
+    """
+    mapped = []
+    for target in targets:
+        protein_pdb = target.protein_pdb
+        if target.pocket_pdb is None or rescore:
+            protein_pdb = ligen.map_shared_input(protein_pdb)
+        pocket_pdb = target.pocket_pdb
+        if pocket_pdb is not None:
+            pocket_pdb = ligen.map_shared_input(pocket_pdb)
+        mapped.append(
+            dataclasses.replace(
+                target,
+                protein_pdb=protein_pdb,
+                probe_mol2=ligen.map_shared_input(target.probe_mol2),
+                pocket_pdb=pocket_pdb,
+            )
+        )
+    return mapped
+
+
+def ligen_output_scores_csv(config: ScreeningConfig) -> Path:
+    """
+    Returns the path where LiGen stores the scores of `config`.
+    With multiple targets, LiGen outputs a row per each (ligand, target) pair, which is then
+    converted to the output scores file by `pivot_target_scores`.
+    """
+    if len(config.targets) == 1:
+        return config.output_scores_csv
+    # Keep the (compression) suffixes of the output file
+    name = config.output_scores_csv.name
+    (stem, separator, suffixes) = name.partition(".")
+    return config.output_scores_csv.with_name(f"{stem}-targets{separator}{suffixes}")
+
+
+def pivot_target_scores(config: ScreeningConfig):
+    """
+    Converts the LiGen output with a row per each (ligand, target) pair into a file with a single
+    row per ligand, which contains a score column for each target.
+    Scores of targets that were not produced for a ligand are left empty.
+    """
+    input_csv = ligen_output_scores_csv(config)
+    if input_csv == config.output_scores_csv:
+        return
 
+    columns = {
+        target.name: column
+        for (target, column) in zip(config.targets, screening_score_columns(config.targets))
+    }
+    scores: Dict[str, Dict[str, str]] = {}
+    with open_compressed(input_csv, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is not None:
+            name_index = header.index("NAME")
+            target_index = header.index("SCORE_PROTEIN_NAME")
+            score_index = header.index(SCREENING_SCORE_COLUMN)
+            for row in reader:
+                if row:
+                    ligand_scores = scores.setdefault(row[name_index], {})
+                    ligand_scores[columns[row[target_index]]] = row[score_index]
+
+    with atomic_output(config.output_scores_csv) as output:
+        with open_compressed(output, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["NAME", *columns.values()])
+            for (name, ligand_scores) in scores.items():
+                writer.writerow(
+                    [name, *(ligand_scores.get(column, "") for column in columns.values())]
+                )
+    delete_file(input_csv)
+
+
+def ligen_screen_ligands(ctx: LigenTaskContext, config: ScreeningConfig):
+    if config.input_expanded_mol2.stat().st_size == 0:
+        # A shard can be empty if the input ligands were split at runtime
+        logger.info(f"No ligands to screen in {config.input_expanded_mol2}")
+        config.output_scores_csv.touch()
+        return
+
+    logger.info(f"Starting virtual screening of {config.input_expanded_mol2}")
+    with shard_telemetry(ctx, "screening", config.input_expanded_mol2) as telemetry:
+        run_with_bisection(
+            lambda input, output: run_screening(ctx, config, input, output, telemetry),
+            input=config.input_expanded_mol2,
+            output=ligen_output_scores_csv(config),
+            read_records=read_mol2_records,
+            merge=concatenate_csvs,
+            rejects=config.rejects_mol2,
+        )
+        pivot_target_scores(config)
+        telemetry.ligands = count_ligands(config.output_scores_csv, header=True)
+
+
+def run_screening(
+    ctx: LigenTaskContext,
+    config: ScreeningConfig,
+    input_mol2: Path,
+    output_csv: Path,
+    telemetry: ShardTelemetry,
+):
+    with ligen_task_container(ctx, telemetry) as ligen:
+        input_ligands = ligen.map_input(input_mol2)
+        input_targets = map_screening_targets(ligen, config.targets, rescore=config.rescore)
+        output_csv = ligen.map_output(output_csv)
+
+        description = create_screening_description(
+            config, input_ligands=input_ligands, input_targets=input_targets,
+            output_csv=output_csv
+        )
         ligen.run(
             "ligen",
             input=json.dumps(description).encode("utf8"),
         )
+
+
+def ligen_expand_and_screen(
+    ctx: LigenTaskContext,
+    expansion: ExpansionConfig,
+    config: ScreeningConfig,
+    stream: bool = False,
+):
+    """
+    Expands the SMI file from `expansion` and screens the expanded ligands in a single container
+    invocation. The expanded MOL2 file is kept in node-local scratch space (or, if `stream` is True,
+    it is passed from `ligen-coordgen` to `ligen` through a named pipe) and is never written to
+    `expansion.output_mol2`; only the scores CSV is stored.
+    """
+    if expansion.input_smi.stat().st_size == 0:
+        logger.info(f"No ligands to screen in {expansion.input_smi}")
+        config.output_scores_csv.touch()
+        return
+
+    logger.info(f"Starting fused expansion and virtual screening of {expansion.input_smi}")
+    with shard_telemetry(ctx, "expand-and-screen", expansion.input_smi) as telemetry:
+        run_with_bisection(
+            lambda input, output: run_expand_and_screen(
+                ctx, expansion, config, input, output, stream=stream, telemetry=telemetry
+            ),
+            input=expansion.input_smi,
+            output=ligen_output_scores_csv(config),
+            read_records=read_smi_records,
+            merge=concatenate_csvs,
+            rejects=expansion.rejects_smi,
+        )
+        pivot_target_scores(config)
+        telemetry.ligands = count_ligands(config.output_scores_csv, header=True)
+    logger.info(f"Finished fused expansion and virtual screening of {expansion.input_smi}")
+
+
+def run_expand_and_screen(
+    ctx: LigenTaskContext,
+    expansion: ExpansionConfig,
+    config: ScreeningConfig,
+    input_smi: Path,
+    output_csv: Path,
+    stream: bool,
+    telemetry: ShardTelemetry,
+):
+    with ligen_task_container(ctx, telemetry) as ligen:
+        input_smi = ligen.map_input(input_smi)
+        input_targets = map_screening_targets(ligen, config.targets, rescore=config.rescore)
+        output_csv = ligen.map_output(output_csv)
+        expanded_mol2 = ligen.map_scratch(expansion.output_mol2.name)
+
+        description = create_screening_description(
+            config, input_ligands=expanded_mol2, input_targets=input_targets,
+            output_csv=output_csv
+        )
+        if stream:
+            # If ligen fails before it opens the pipe, coordgen would block forever
+            command = f"""mkfifo {expanded_mol2}
+ligen-coordgen < {input_smi} > {expanded_mol2} &
+coordgen=$!
+ligen
+status=$?
+if [ $status -ne 0 ]; then kill $coordgen; exit $status; fi
+wait $coordgen"""
+        else:
+            command = f"ligen-coordgen < {input_smi} > {expanded_mol2} && ligen"
+        # The description is passed to ligen through the standard input of the shell
+        ligen.run(command, input=json.dumps(description).encode("utf8"))
@@ -0,0 +1,106 @@
+import dataclasses
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+from hyperqueue import Job
+from hyperqueue.ffi.protocol import ResourceRequest
+from hyperqueue.task.task import Task
+
+from .expansion import hq_submit_expansion
+from ..ligen.calibration import (
+    CalibrationProbeConfig,
+    candidate_thread_layouts,
+    ligen_calibration_probe,
+    select_thread_layout,
+)
+from ..ligen.common import LigenTaskContext
+from ..ligen.expansion import ExpansionConfig
+from ..ligen.smi import write_smi_sample
+from ..ligen.virtual_screening import ScreeningConfig, ScreeningTarget
+from ...utils.io import ensure_directory
+
+
+@dataclasses.dataclass
+class CalibrationPipelineConfig:
+    input_smi: Path
+    input_probe_mol2: Path
+    input_protein: Path
+
+    # How many ligands (from the start of `input_smi`) are screened by each calibration probe
+    sample_size: int = 50
+    # Maximum number of cores that can be requested by a single LiGen task
+    max_cores: int = 8
+
+
+@dataclass
+class SubmittedCalibration:
+    tasks: List[Task]
+    # JSON file with the selected thread layout (see `load_thread_layout`)
+    output_layout_json: Path
+
+
+def hq_submit_ligen_calibration(
+    ctx: LigenTaskContext,
+    workdir: Path,
+    config: CalibrationPipelineConfig,
+    job: Job,
+    deps: List[Task],
+) -> SubmittedCalibration:
+    """
+    Submits tasks that screen a sample of the input ligands with several thread layouts, and
+    select the layout with the best throughput per core.
+
+    The probes are executed one after another, so that they do not compete for resources and skew
+    the measurements.
+    """
+    workdir_inputs = ensure_directory(workdir / "inputs")
+    workdir_outputs = ensure_directory(workdir / "outputs")
+    output_layout_json = workdir_outputs / "layout.json"
+
+    sample_smi = workdir_inputs / "sample.smi"
+    ligand_count = write_smi_sample(config.input_smi, sample_smi, config.sample_size)
+    if ligand_count == 0:
+        raise Exception(f"Cannot calibrate LiGen using an empty SMI file {config.input_smi}")
+
+    expansion = ExpansionConfig(
+        id="calibration", input_smi=sample_smi, output_mol2=workdir_outputs / "sample.mol2"
+    )
+    previous = hq_submit_expansion(ctx, expansion, deps, job).task
+
+    probe_jsons = []
+    for (index, layout) in enumerate(candidate_thread_layouts(config.max_cores)):
+        screening = ScreeningConfig(
+            targets=(
+                ScreeningTarget(
+                    name="10gs",
+                    protein_pdb=config.input_protein,
+                    probe_mol2=config.input_probe_mol2,
+                ),
+            ),
+            input_expanded_mol2=expansion.output_mol2,
+            output_scores_csv=workdir_outputs / f"probe-{index}.csv",
+            cores=layout.cores,
+        )
+        probe_config = CalibrationProbeConfig(
+            layout=layout,
+            screening=screening,
+            ligand_count=ligand_count,
+            output_json=workdir_outputs / f"probe-{index}.json",
+        )
+        previous = job.function(
+            ligen_calibration_probe,
+            args=(ctx, probe_config),
+            deps=(previous,),
+            name=f"calibration-probe-{index}",
+            resources=ResourceRequest(cpus=layout.cores),
+        )
+        probe_jsons.append(probe_config.output_json)
+
+    select_task = job.function(
+        select_thread_layout,
+        args=(probe_jsons, output_layout_json),
+        deps=(previous,),
+        name="calibration-select",
+    )
+    return SubmittedCalibration(tasks=[select_task], output_layout_json=output_layout_json)
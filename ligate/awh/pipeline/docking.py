@@ -1,16 +1,19 @@
 import dataclasses
+import math
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 from hyperqueue import Job
 from hyperqueue.ffi.protocol import ResourceRequest
 from hyperqueue.task.task import Task
 
 from .expansion import SubmittedExpansion, hq_submit_expansion
+from ..ligen.calibration import ThreadLayout
 from ..ligen.common import LigenTaskContext
-from ..ligen.docking import DockingConfig, ligen_dock
+from ..ligen.docking import DockingConfig, ligen_dock, merge_docked_poses
 from ..ligen.expansion import ExpansionConfig
+from ..ligen.smi import LigandCostModel, measure_smi_file, split_smi_file
 from ...utils.io import ensure_directory
 
 
@@ -46,6 +49,23 @@ class DockingPipelineConfig:
     input_protein: Path
 
     max_molecules_per_smi: int = 10
+    """
+    (Maximum) number of ligands in `input_smi`, which determines the number of docking shards.
+    It has to be specified if `input_smi` is produced by a task of the same job, otherwise the
+    ligands of `input_smi` are counted when the workflow is being built.
+    """
+    ligand_count: Optional[int] = None
+    """
+    Model used to balance the docking shards by the estimated cost of their ligands.
+    If None, the ligands are split by line count.
+    """
+    cost_model: Optional[LigandCostModel] = dataclasses.field(default_factory=LigandCostModel)
+    # Number of cores used to dock a single shard
+    cores: int = 8
+    # Threading settings of LiGen and HQ resources of the docking tasks (see `ThreadLayout`)
+    thread_layout: Optional[ThreadLayout] = None
+    # Residues of the protein around the probe, prepared in advance (see `prepare_target`)
+    input_pocket_pdb: Optional[Path] = None
 
 
 @dataclasses.dataclass
@@ -61,22 +81,58 @@ def hq_submit_ligen_docking_workflow(
     job: Job,
     deps: List[Task],
 ) -> SubmittedDockingPipeline:
+    """
+    Splits the input ligands into shards, expands and docks each shard in separate tasks, and
+    merges the docked poses of all shards into a single MOL2 file.
+
+    The input SMI file can be produced by a task in `deps`, because it is split by a separate task
+    at runtime. Only the number of shards has to be known in advance (see `ligand_count`).
+    """
+    workdir_inputs = ensure_directory(workdir / "inputs")
     workdir_outputs = ensure_directory(workdir / "outputs")
-    expanded_ligands_mol2 = workdir_outputs / "ligands.mol2"
     docked_mol2 = workdir_outputs / "docked.mol2"
 
-    expansion_config = ExpansionConfig(
-        id="expand-dock", input_smi=config.input_smi, output_mol2=expanded_ligands_mol2
+    ligand_count = config.ligand_count
+    if ligand_count is None:
+        ligand_count = measure_smi_file(config.input_smi, cost_model=None).count
+    shard_count = max(1, math.ceil(ligand_count / config.max_molecules_per_smi))
+
+    shards = [workdir_inputs / f"ligands-{shard}.smi" for shard in range(shard_count)]
+    split_task = job.function(
+        split_smi_file,
+        args=(config.input_smi, shards, config.cost_model),
+        deps=deps,
+        name="split-docking-ligands",
     )
-    expand_task = hq_submit_expansion(ctx, expansion_config, deps, job)
-
-    docking_config = DockingConfig(
-        input_probe_mol2=config.input_probe_mol2,
-        input_protein_pdb=config.input_protein,
-        input_expanded_mol2=expanded_ligands_mol2,
-        input_protein_name="1CVU",
-        output_poses_mol2=docked_mol2,
-        cores=8,
+
+    docking_tasks = []
+    docked_shards = []
+    for (shard, input_smi) in enumerate(shards):
+        expansion_config = ExpansionConfig(
+            id=f"expand-dock-{shard}",
+            input_smi=input_smi,
+            output_mol2=workdir_outputs / f"ligands-{shard}.mol2",
+        )
+        expand_task = hq_submit_expansion(ctx, expansion_config, [split_task], job)
+
+        docking_config = DockingConfig(
+            input_probe_mol2=config.input_probe_mol2,
+            input_protein_pdb=config.input_protein,
+            input_expanded_mol2=expansion_config.output_mol2,
+            input_protein_name="1CVU",
+            input_pocket_pdb=config.input_pocket_pdb,
+            output_poses_mol2=workdir_outputs / f"docked-{shard}.mol2",
+            cores=config.cores,
+        )
+        if config.thread_layout is not None:
+            docking_config = config.thread_layout.apply_to_docking(docking_config)
+        docking_tasks.append(hq_submit_ligand_docking(ctx, docking_config, expand_task, job).task)
+        docked_shards.append(docking_config.output_poses_mol2)
+
+    merge_task = job.function(
+        merge_docked_poses,
+        args=(docked_shards, docked_mol2),
+        deps=docking_tasks,
+        name="merge-docked-poses",
     )
-    task = hq_submit_ligand_docking(ctx, docking_config, expand_task, job).task
-    return SubmittedDockingPipeline(docked_mol2=docked_mol2, tasks=[task])
+    return SubmittedDockingPipeline(docked_mol2=docked_mol2, tasks=[merge_task])
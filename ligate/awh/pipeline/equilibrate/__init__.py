@@ -1,6 +1,8 @@
 import dataclasses
 from pathlib import Path
+from typing import Optional
 
+from ..resources import CoreScalingModel
 from ...common import ComplexOrLigand
 from ...scripts import PREPARE_EQUILIBRATION_SCRIPT, SCRIPTS_DIR
 from ....mdp import generate_eq_nvt_l0_mdp
@@ -12,7 +14,10 @@ from ....wrapper.gromacs import Gromacs
 @dataclasses.dataclass
 class EquilibrateParams:
     steps: int
+    # Maximum number of cores of a single equilibration
     cores: int
+    # If set, the cores of each item are derived from the size of its system
+    scaling: Optional[CoreScalingModel] = None
 
 
 @trace_fn()
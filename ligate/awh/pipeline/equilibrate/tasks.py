@@ -1,8 +1,11 @@
+import dataclasses
+
 from hyperqueue.ffi.protocol import ResourceRequest
 from hyperqueue.task.task import Task
 
 from . import EquilibrateParams, equilibrate
 from ..hq import HqCtx
+from ..resources import item_cores
 from ...common import ComplexOrLigand
 from ....wrapper.gromacs import Gromacs
 
@@ -13,6 +16,8 @@ def hq_submit_equilibrate(
         gmx: Gromacs,
         hq: HqCtx,
 ) -> Task:
+    cores = item_cores(item, params.cores, params.scaling)
+    params = dataclasses.replace(params, cores=cores)
     return hq.job.function(
         equilibrate,
         args=(
@@ -21,6 +26,6 @@ def hq_submit_equilibrate(
             gmx,
         ),
         name=f"equilibrate-{item.edge}-{item.pose}-{item.kind}",
-        resources=ResourceRequest(cpus=params.cores),
+        resources=ResourceRequest(cpus=cores),
         deps=hq.deps
     )
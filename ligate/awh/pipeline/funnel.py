@@ -0,0 +1,156 @@
+import dataclasses
+from pathlib import Path
+from typing import List, Optional
+
+from hyperqueue import Job
+from hyperqueue.task.task import Task
+
+from .docking import (
+    DockingPipelineConfig,
+    SubmittedDockingPipeline,
+    hq_submit_ligen_docking_workflow,
+)
+from .select_ligands import LigandSelectionConfig, hq_submit_select_ligands
+from .virtual_screening import (
+    SubmittedVirtualScreeningPipeline,
+    VirtualScreeningPipelineConfig,
+    hq_submit_ligen_virtual_screening_workflow,
+)
+from ..ligen.common import LigenTaskContext
+from ...utils.io import ensure_directory
+
+
+@dataclasses.dataclass
+class ScreeningFunnelConfig:
+    """
+    Screens the whole ligand library with the cheap D22 scoring function, rescores only the best
+    fraction of the ligands with the expensive D23RTMB scoring function, and docks the best ligands
+    of the rescoring.
+    """
+
+    """
+    Screening of the whole library.
+    """
+    screening: VirtualScreeningPipelineConfig
+    """
+    Fraction of the screened ligands (ranked by their screening score) that are rescored.
+    At least `screening.top_n` ligands are rescored. If None, rescoring is skipped and the ligands
+    are docked based on their screening score.
+    Rescoring only uses the primary target of `screening`.
+    """
+    rescore_fraction: Optional[float] = None
+    """
+    Number of best ligands that are docked. If None, docking is skipped.
+    """
+    dock_count: Optional[int] = 10
+
+
+@dataclasses.dataclass
+class SubmittedScreeningFunnel:
+    screening: SubmittedVirtualScreeningPipeline
+    # Only available if rescoring was enabled
+    rescoring: Optional[SubmittedVirtualScreeningPipeline]
+    # Only available if docking was enabled
+    docking: Optional[SubmittedDockingPipeline]
+    tasks: List[Task]
+
+
+def hq_submit_select_best_ligands(
+    input_smi: Path,
+    scores: SubmittedVirtualScreeningPipeline,
+    n_ligands: int,
+    output_smi: Path,
+    job: Job,
+) -> Task:
+    config = LigandSelectionConfig(
+        input_smi=input_smi,
+        scores_csv=scores.output_top_csv,
+        output_smi=output_smi,
+        n_ligands=n_ligands,
+        score_column=scores.score_column,
+        smi_index=scores.smi_index,
+    )
+    return hq_submit_select_ligands(config, job, scores.tasks)
+
+
+def hq_submit_screening_funnel(
+    ctx: LigenTaskContext,
+    workdir: Path,
+    config: ScreeningFunnelConfig,
+    job: Job,
+    deps: List[Task],
+    ligen_cores: int = 4,
+) -> SubmittedScreeningFunnel:
+    """
+    Submits the stages of the screening funnel, each stage only processes the ligands selected
+    (from the streaming top-K reduction) by the previous stage.
+    The number of ligands that pass each stage is known when the job is built, so the subsequent
+    stages can be submitted in advance and their shards are split at runtime.
+    """
+    ensure_directory(workdir)
+
+    screening_config = config.screening
+    if config.rescore_fraction is not None:
+        screening_config = dataclasses.replace(
+            screening_config, top_fraction=config.rescore_fraction
+        )
+    screening = hq_submit_ligen_virtual_screening_workflow(
+        ctx, workdir / "vscreening", config=screening_config, job=job, deps=deps,
+        ligen_cores=ligen_cores,
+    )
+    ranked = screening
+    ranked_smi = screening_config.input_smi
+    tasks = screening.tasks
+
+    rescoring = None
+    if config.rescore_fraction is not None:
+        rescoring_smi = workdir / "rescoring-ligands.smi"
+        select_task = hq_submit_select_best_ligands(
+            ranked_smi, ranked, screening.top_n, rescoring_smi, job
+        )
+        rescoring_config = dataclasses.replace(
+            config.screening,
+            input_smi=rescoring_smi,
+            ligand_count=screening.top_n,
+            additional_targets=[],
+            top_n=config.dock_count or config.screening.top_n,
+            top_fraction=None,
+            rescore=True,
+            index_ligands=False,
+            deduplicate=False,
+            prefilter=None,
+            cache=None,
+            # Reuse the pocket prepared for the screening
+            prepare_targets=False,
+            input_pocket_pdb=screening.pocket_pdb,
+        )
+        rescoring = hq_submit_ligen_virtual_screening_workflow(
+            ctx, workdir / "rescoring", config=rescoring_config, job=job, deps=[select_task],
+            ligen_cores=ligen_cores,
+        )
+        ranked = rescoring
+        ranked_smi = rescoring_smi
+        tasks = rescoring.tasks
+
+    docking = None
+    if config.dock_count is not None:
+        docking_smi = workdir / "selected-ligands.smi"
+        select_task = hq_submit_select_best_ligands(
+            ranked_smi, ranked, config.dock_count, docking_smi, job
+        )
+        docking_config = DockingPipelineConfig(
+            input_smi=docking_smi,
+            input_probe_mol2=config.screening.input_probe_mol2,
+            input_protein=config.screening.input_protein,
+            ligand_count=config.dock_count,
+            thread_layout=config.screening.thread_layout,
+            input_pocket_pdb=screening.pocket_pdb,
+        )
+        docking = hq_submit_ligen_docking_workflow(
+            ctx, workdir / "docking", docking_config, job, deps=[select_task]
+        )
+        tasks = docking.tasks
+
+    return SubmittedScreeningFunnel(
+        screening=screening, rescoring=rescoring, docking=docking, tasks=tasks
+    )
@@ -1,14 +1,28 @@
 import dataclasses
-from typing import List, Optional
+import json
+import logging
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
 
+import cloudpickle
 from hyperqueue import Job
+from hyperqueue.ffi.protocol import ResourceRequest
 from hyperqueue.task.task import Task
 
+from ...utils.io import atomic_output, ensure_directory
+
+logger = logging.getLogger(__name__)
+
 
 @dataclasses.dataclass
 class HqCtx:
     job: Job
     deps: List[Task] = dataclasses.field(default_factory=list)
+    # If set, short tasks are grouped into batch tasks (see `TaskBatcher`)
+    batcher: Optional["TaskBatcher"] = None
 
     def with_dep(self, task: Optional[Task]) -> "HqCtx":
         if task is None:
@@ -18,5 +32,133 @@ class HqCtx:
     def with_deps(self, deps: List[Task]) -> "HqCtx":
         return HqCtx(
             job=self.job,
-            deps=deps
+            deps=deps,
+            batcher=self.batcher
+        )
+
+    def short_function(self, fn: Callable, args: Tuple, name: str) -> Task:
+        """
+        Submits a short task that runs `fn` on a single core.
+        If the context has a batcher, the task is added to a batch task, which is returned.
+        """
+        if self.batcher is not None:
+            return self.batcher.submit(fn, args=args, name=name, deps=self.deps)
+        return self.job.function(fn, args=args, name=name, deps=self.deps)
+
+
+@dataclasses.dataclass(frozen=True)
+class BatchItem:
+    name: str
+    fn: Callable
+    args: Tuple
+
+
+@dataclasses.dataclass(frozen=True)
+class BatchItemResult:
+    name: str
+    duration: float
+    # Formatted traceback of the exception raised by the item, None if it has succeeded
+    error: Optional[str] = None
+
+
+def run_batch_item(payload: bytes) -> BatchItemResult:
+    item: BatchItem = cloudpickle.loads(payload)
+    start = time.time()
+    error = None
+    try:
+        item.fn(*item.args)
+    except BaseException:
+        error = traceback.format_exc()
+    return BatchItemResult(name=item.name, duration=time.time() - start, error=error)
+
+
+def run_task_batch(items: List[BatchItem], workers: int, report: Optional[Path]):
+    """
+    Runs the items of a batch task on a local pool of `workers` processes.
+    All items are executed even if some of them fail. The result of each item is written to
+    `report` (JSON lines), and the batch fails if any of its items has failed.
+    """
+    # The items are serialized by cloudpickle, because they might contain closures
+    payloads = [cloudpickle.dumps(item) for item in items]
+    if workers > 1 and len(payloads) > 1:
+        with ProcessPoolExecutor(min(workers, len(payloads))) as pool:
+            results = list(pool.map(run_batch_item, payloads))
+    else:
+        results = [run_batch_item(payload) for payload in payloads]
+
+    if report is not None:
+        ensure_directory(report.parent)
+        with atomic_output(report) as output, open(output, "w") as f:
+            for result in results:
+                print(json.dumps(dataclasses.asdict(result)), file=f)
+
+    failed = [result for result in results if result.error is not None]
+    for result in failed:
+        logger.error(f"Item {result.name} of the batch has failed:\n{result.error}")
+    if failed:
+        raise Exception(
+            f"{len(failed)}/{len(results)} item(s) of the batch have failed: "
+            f"{', '.join(result.name for result in failed)}"
+        )
+
+
+@dataclasses.dataclass
+class TaskBatch:
+    task: Task
+    items: List[BatchItem]
+
+
+class TaskBatcher:
+    """
+    Groups short tasks into batch tasks, so that the cost of starting a HQ task (a new Python
+    interpreter with all its imports) is paid once per batch instead of once per item.
+
+    Only tasks with the same function and the same dependencies are grouped together, so that
+    batching does not delay any task behind unrelated dependencies. Each batch contains at most
+    `max_size` items. All tasks that depend on an item depend on its whole batch, so if a single
+    item fails, the batch task fails and the dependents of all its other items are blocked as well.
+
+    Each batch runs its items on at most `workers` cores, but a batch with fewer items only
+    requests a core per item.
+    """
+
+    def __init__(
+        self,
+        job: Job,
+        max_size: int = 32,
+        workers: int = 4,
+        report_dir: Optional[Path] = None,
+    ):
+        self.job = job
+        self.max_size = max_size
+        self.workers = workers
+        # Directory that stores the per-item results of each batch
+        self.report_dir = report_dir
+        self.open_batches: Dict[Tuple[str, FrozenSet[int]], TaskBatch] = {}
+        self.batch_count = 0
+
+    def submit(self, fn: Callable, args: Any, name: str, deps: List[Task]) -> Task:
+        key = (fn.__name__, frozenset(dep.task_id for dep in deps))
+        batch = self.open_batches.get(key)
+        if batch is None or len(batch.items) >= self.max_size:
+            batch = self.create_batch(fn.__name__, deps)
+            self.open_batches[key] = batch
+        batch.items.append(BatchItem(name=name, fn=fn, args=tuple(args)))
+        # The batch is only submitted once the job is built, so its resources can still change
+        batch.task.resources = ResourceRequest(cpus=min(self.workers, len(batch.items)))
+        return batch.task
+
+    def create_batch(self, kind: str, deps: List[Task]) -> TaskBatch:
+        name = f"{kind}-batch-{self.batch_count}"
+        self.batch_count += 1
+        report = self.report_dir / f"{name}.jsonl" if self.report_dir is not None else None
+        # The items are added to the list after the task is created, it is only serialized
+        # once the job is submitted
+        items = []
+        task = self.job.function(
+            run_task_batch,
+            args=(items, self.workers, report),
+            name=name,
+            deps=list(deps),
         )
+        return TaskBatch(task=task, items=items)
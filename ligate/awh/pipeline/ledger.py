@@ -0,0 +1,397 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from hyperqueue import Job
+from hyperqueue.task.task import Task
+
+from .common import EdgeSet
+from ...utils.io import atomic_output, delete_path, ensure_directory, hash_file
+from ...utils.snapshot import ContentStore
+
+logger = logging.getLogger(__name__)
+
+# Stage that represents the initial content of an item, copied from the input directory
+STAGE_INPUT = "input"
+
+
+def hash_tree(directory: Path) -> Dict[str, str]:
+    """
+    Returns the content hashes of all files in `directory`, keyed by their relative paths.
+    """
+    hashes = {}
+    for (root, dirs, files) in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = Path(root) / name
+            hashes[path.relative_to(directory).as_posix()] = hash_file(path)
+    return hashes
+
+
+def tree_content_hash(hashes: Dict[str, str]) -> str:
+    hasher = hashlib.sha256()
+    for (path, file_hash) in sorted(hashes.items()):
+        hasher.update(f"{path}\0{file_hash}\n".encode())
+    return hasher.hexdigest()
+
+
+def stage_fingerprint(stage: str, params: Any, inputs: List[str]) -> str:
+    """
+    Returns a fingerprint of everything that determines the outputs of a stage of an item: the
+    stage itself, its parameters and the content of its inputs (`inputs`).
+    """
+    hasher = hashlib.sha256(f"{stage}\0{params!r}\n".encode())
+    for input in inputs:
+        hasher.update(f"{input}\n".encode())
+    return hasher.hexdigest()
+
+
+@dataclass(frozen=True)
+class StageEntry:
+    """
+    Record of a stage computed for a single item (a pose directory of an edge).
+    """
+
+    stage: str
+    item: str
+    """
+    Fingerprint of the inputs of the stage (see `stage_fingerprint`).
+    """
+    fingerprint: str
+    """
+    Content hashes of the files of the item after the stage, keyed by their relative paths.
+    """
+    outputs: Dict[str, str]
+
+    @property
+    def content(self) -> str:
+        return tree_content_hash(self.outputs)
+
+
+class StageLedger:
+    """
+    Per-item records of the computed stages of a workflow, which allow an incremental run of the
+    workflow to skip items whose inputs have not changed.
+
+    Each (stage, item) pair has its own record file, so that tasks of different items can record
+    their stages concurrently. The files of each recorded item state are stored in a
+    content-addressed object store, so that an item can be restored to the state after any of its
+    recorded stages. The ledger also tracks the current state (head) of each item directory.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    @property
+    def objects_dir(self) -> Path:
+        return self.directory / "objects"
+
+    def entry_path(self, stage: str, item: str) -> Path:
+        return self.directory / "stages" / stage / f"{item}.json"
+
+    def head_path(self, item: str) -> Path:
+        return self.directory / "heads" / f"{item}.json"
+
+    @property
+    def objects(self) -> ContentStore:
+        return ContentStore(self.objects_dir)
+
+    def load(self, stage: str, item: str) -> Optional[StageEntry]:
+        path = self.entry_path(stage, item)
+        if not path.is_file():
+            return None
+        return StageEntry(**json.loads(path.read_text()))
+
+    def store(self, entry: StageEntry):
+        path = self.entry_path(entry.stage, entry.item)
+        ensure_directory(path.parent)
+        with atomic_output(path) as output:
+            output.write_text(json.dumps(dataclasses.asdict(entry)))
+
+    def head(self, item: str) -> Optional[str]:
+        """
+        Returns the content hash of the current state of the directory of `item`.
+        """
+        path = self.head_path(item)
+        return path.read_text() if path.is_file() else None
+
+    def set_head(self, item: str, content: Optional[str]):
+        path = self.head_path(item)
+        if content is None:
+            if path.is_file():
+                os.unlink(path)
+            return
+        ensure_directory(path.parent)
+        with atomic_output(path) as output:
+            output.write_text(content)
+
+    def record(self, stage: str, item: str, fingerprint: str, directory: Path) -> StageEntry:
+        """
+        Records the current content of the `directory` of `item` as the output of `stage`.
+        """
+        outputs = hash_tree(directory) if directory.is_dir() else {}
+        objects = self.objects
+        for (path, file_hash) in outputs.items():
+            objects.add(directory / path, file_hash)
+        entry = StageEntry(stage=stage, item=item, fingerprint=fingerprint, outputs=outputs)
+        self.store(entry)
+        self.set_head(item, entry.content)
+        return entry
+
+    def restore(self, entry: StageEntry, directory: Path):
+        """
+        Restores the `directory` of an item to its state after the stage of `entry`.
+        """
+        logger.debug(f"Restoring {directory} to its state after stage {entry.stage}")
+        # The head is invalid while the directory is being restored
+        self.set_head(entry.item, None)
+        delete_path(directory)
+        ensure_directory(directory)
+        objects = self.objects
+        for (path, file_hash) in entry.outputs.items():
+            target = directory / path
+            ensure_directory(target.parent)
+            # The restored files are modified by the following stages
+            objects.materialize(file_hash, target)
+        self.set_head(entry.item, entry.content)
+
+
+def record_stage(
+    ledger_dir: Path,
+    stage: str,
+    params: str,
+    upstream_stage: str,
+    items: List[Tuple[str, Path]],
+    shared: bool,
+):
+    """
+    Records the outputs of `stage` for the given (item, directory) pairs, once the stage has
+    finished. The fingerprints are computed from the recorded outputs of `upstream_stage`, which
+    might not have been known when the stage was submitted.
+    If `shared` is True, the stage processed all `items` at once, even the items whose inputs have
+    not changed. Such items are restored to their previously recorded outputs, because the
+    following stages of these items might have been skipped based on them.
+    """
+    ledger = StageLedger(ledger_dir)
+    upstream = {item: ledger.load(upstream_stage, item) for (item, _) in items}
+    missing = [item for (item, entry) in upstream.items() if entry is None]
+    if missing:
+        raise Exception(f"Stage {upstream_stage} was not recorded for items {missing}")
+    for (item, directory) in items:
+        fingerprint = stage_fingerprint(stage, params, [upstream[item].content])
+        entry = ledger.load(stage, item) if shared else None
+        if entry is not None and entry.fingerprint == fingerprint:
+            ledger.restore(entry, directory)
+        else:
+            ledger.record(stage, item, fingerprint, directory)
+
+
+def restore_stage(ledger_dir: Path, stage: str, item: str, directory: Path):
+    """
+    Restores the `directory` of `item` to its recorded state after `stage`.
+    """
+    ledger = StageLedger(ledger_dir)
+    ledger.restore(ledger.load(stage, item), directory)
+
+
+@dataclass
+class ItemState:
+    """
+    State of a single item while an incremental workflow is being built.
+    """
+
+    item: str
+    directory: Path
+    # Last stage of the item in the workflow
+    stage: str
+    # Content of the item after `stage`, None if it is computed by the submitted tasks
+    content: Optional[str]
+    # Tasks that have to finish before the next stage of the item can start
+    deps: List[Task] = dataclasses.field(default_factory=list)
+    # Content of the directory once `deps` finish, if the directory is modified by the submitted
+    # tasks even though `content` is known (see `IncrementalStages.submit_shared`)
+    runtime_content: Optional[str] = None
+
+
+class IncrementalStages:
+    """
+    Submits the stages of items of a workflow, skipping items whose stage was already computed
+    from the same inputs (see `StageLedger`).
+
+    Whether a stage can be skipped is decided when the job is built, so it is only possible if
+    the content of the inputs of the stage is already known. Once a stage of an item is
+    submitted, all its following per-item stages are submitted as well. A shared stage processes
+    all items, but the items whose inputs have not changed keep their previous outputs (see
+    `record_stage`), so their following stages can still be skipped.
+    """
+
+    def __init__(self, ledger: StageLedger, job: Job, items: List[ItemState]):
+        self.ledger = ledger
+        self.job = job
+        self.items = items
+
+    def submit_per_item(
+        self, stage: str, params: Any, submit: Callable[[ItemState], List[Task]]
+    ):
+        """
+        Submits `stage` separately for each item that needs to be recomputed.
+        `submit` should submit the tasks of a single item, which depend on `ItemState.deps`.
+        """
+        params = repr(params)
+        skipped = 0
+        for state in self.items:
+            entry = self.ledger.load(stage, state.item)
+            if state.content is not None and entry is not None:
+                fingerprint = stage_fingerprint(stage, params, [state.content])
+                if entry.fingerprint == fingerprint:
+                    state.stage = stage
+                    state.content = entry.content
+                    skipped += 1
+                    continue
+            self.prepare(state)
+            tasks = submit(state)
+            self.advance([state], stage, params, tasks, shared=False)
+        self.log_stage(stage, skipped)
+
+    def submit_shared(self, stage: str, params: Any, submit: Callable[[List[Task]], Task]):
+        """
+        Submits `stage`, which processes all items at once by a single task, if any item needs
+        to be recomputed.
+        `submit` should submit the task, which depends on the given tasks.
+        """
+        params = repr(params)
+        unchanged: Dict[str, StageEntry] = {}
+        for state in self.items:
+            if state.content is None:
+                continue
+            entry = self.ledger.load(stage, state.item)
+            fingerprint = stage_fingerprint(stage, params, [state.content])
+            if entry is not None and entry.fingerprint == fingerprint:
+                unchanged[state.item] = entry
+        if len(unchanged) == len(self.items):
+            for state in self.items:
+                state.stage = stage
+                state.content = unchanged[state.item].content
+            self.log_stage(stage, len(self.items))
+            return
+        for state in self.items:
+            self.prepare(state)
+        # Items computed by a shared stage depend on the same task
+        deps = list(dict.fromkeys(dep for state in self.items for dep in state.deps))
+        task = submit(deps)
+        self.advance(self.items, stage, params, [task], shared=True)
+        for state in self.items:
+            # The task also modifies unchanged items, but their previous outputs are restored once
+            # it finishes
+            entry = unchanged.get(state.item)
+            if entry is not None:
+                state.content = entry.content
+                state.runtime_content = entry.content
+        self.log_stage(stage, len(unchanged))
+
+    def prepare(self, state: ItemState):
+        """
+        Makes sure that the directory of an item is in the state after its last stage, before a
+        following stage is submitted.
+
+        If the directory is modified by the submitted tasks, it is restored by a task once they
+        finish, otherwise it is restored right away.
+        """
+        if state.content is None:
+            return
+        if state.runtime_content is not None:
+            if state.runtime_content != state.content:
+                restore = self.job.function(
+                    restore_stage,
+                    args=(self.ledger.directory, state.stage, state.item, state.directory),
+                    deps=state.deps,
+                    name=f"restore-{state.stage}-{state.item}",
+                )
+                state.deps = [restore]
+                state.runtime_content = state.content
+            return
+        if self.ledger.head(state.item) == state.content:
+            return
+        entry = self.ledger.load(state.stage, state.item)
+        self.ledger.restore(entry, state.directory)
+
+    def finish(self):
+        """
+        Makes sure that the directories of items whose last stages were all skipped are in the
+        state after these stages. Should be called after the last stage is submitted.
+
+        Directories are restored when the job is built, so a previous build that was not executed
+        might have left them in an older state.
+        """
+        for state in self.items:
+            self.prepare(state)
+
+    def advance(
+        self, states: List[ItemState], stage: str, params: str, tasks: List[Task], shared: bool
+    ):
+        upstream_stage = states[0].stage
+        name = states[0].item if not shared else "all"
+        record = self.job.function(
+            record_stage,
+            args=(
+                self.ledger.directory,
+                stage,
+                params,
+                upstream_stage,
+                [(state.item, state.directory) for state in states],
+                shared,
+            ),
+            deps=tasks,
+            name=f"record-{stage}-{name}",
+        )
+        for state in states:
+            state.stage = stage
+            state.content = None
+            state.runtime_content = None
+            state.deps = [record]
+
+    def log_stage(self, stage: str, skipped: int):
+        logger.info(
+            f"Stage {stage}: {skipped} item(s) unchanged, "
+            f"{len(self.items) - skipped} item(s) submitted"
+        )
+
+
+def sync_input_items(
+    ledger: StageLedger, input_dir: Path, workdir: Path, edge_set: EdgeSet
+) -> List[ItemState]:
+    """
+    Registers the pose directories of `edge_set` (located in `input_dir`) as the items of an
+    incremental workflow that runs in `workdir`. Items whose input content has changed (or that
+    are not present in `workdir`) are copied into `workdir`.
+    Files outside pose directories are copied into `workdir` as they are.
+    """
+    for path in input_dir.iterdir():
+        if path.is_file():
+            shutil.copyfile(path, workdir / path.name)
+
+    items = []
+    for (edge, pose) in edge_set.iterate_poses():
+        edge_dir = ensure_directory(workdir / edge.name())
+        for path in edge.directory.iterdir():
+            if path.is_file():
+                shutil.copyfile(path, edge_dir / path.name)
+
+        item = f"{edge.name()}/{pose}"
+        outputs = hash_tree(edge.pose_dir(pose))
+        content = tree_content_hash(outputs)
+        entry = ledger.load(STAGE_INPUT, item)
+        if entry is None or entry.content != content:
+            entry = ledger.record(STAGE_INPUT, item, content, edge.pose_dir(pose))
+            # The pose was recorded from the input directory
+            ledger.set_head(item, None)
+        items.append(
+            ItemState(item=item, directory=edge_dir / pose, stage=STAGE_INPUT, content=content)
+        )
+    return items
@@ -1,7 +1,13 @@
 import dataclasses
+from typing import Optional
+
+from ..resources import CoreScalingModel
 
 
 @dataclasses.dataclass
 class MinimizationParams:
     steps: int
+    # Maximum number of cores of a single minimization
     cores: int
+    # If set, the cores of each item are derived from the size of its system
+    scaling: Optional[CoreScalingModel] = None
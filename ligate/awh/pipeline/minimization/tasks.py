@@ -1,3 +1,5 @@
+import dataclasses
+
 from hyperqueue.ffi.protocol import ResourceRequest
 from hyperqueue.task.task import Task
 
@@ -6,6 +8,7 @@ from .add_ions import add_ions
 from .minimization import energy_minimize
 from .solvate import solvate
 from ..hq import HqCtx
+from ..resources import item_cores
 from ...common import ComplexOrLigand
 from ....utils.tracing import trace_fn
 from ....wrapper.gromacs import Gromacs
@@ -24,10 +27,12 @@ def hq_submit_minimization(
         gmx: Gromacs,
         hq: HqCtx,
 ) -> Task:
+    cores = item_cores(item, params.cores, params.scaling)
+    params = dataclasses.replace(params, cores=cores)
     return hq.job.function(
         minimize,
         args=(item, params, gmx),
         name=f"minimize-{item.edge}-{item.pose}-{item.kind}",
-        resources=ResourceRequest(cpus=params.cores),
+        resources=ResourceRequest(cpus=cores),
         deps=hq.deps
     )
@@ -12,7 +12,8 @@ def hq_submit_prepare_production_simulation(
         gmx: Gromacs,
         hq: HqCtx,
 ) -> Task:
-    return hq.job.function(
+    # A single grompp call, which is cheaper than starting a HQ task
+    return hq.short_function(
         prepare_production_simulation,
         args=(
             item,
@@ -20,5 +21,4 @@ def hq_submit_prepare_production_simulation(
             gmx,
         ),
         name=f"prepare-production-simulation-{item.edge}-{item.pose}-{item.kind}",
-        deps=hq.deps
     )
@@ -0,0 +1,152 @@
+import dataclasses
+import functools
+import json
+import logging
+import re
+import statistics
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from hyperqueue import Job
+from hyperqueue.task.function import PythonFunction, cloud_wrap
+from hyperqueue.task.task import Task
+
+from ...utils.io import atomic_output, ensure_directory
+
+logger = logging.getLogger(__name__)
+
+# Rough durations (in seconds) of tasks of the workflows, keyed by the name of the task function.
+# They are only used for tasks that do not have a recorded duration from a previous run.
+DEFAULT_TASK_DURATIONS = {
+    "minimize": 600,
+    "prepare_equilibrate": 60,
+    "equilibrate": 1800,
+    "prepare_production_simulation": 30,
+    "run_awh_until_convergence": 24 * 3600,
+    "ligen_expand_smi": 60,
+    "ligen_screen_ligands": 600,
+    "ligen_expand_and_screen": 660,
+    "ligen_dock": 600,
+}
+
+# HQ task priorities are 32-bit signed integers
+MAX_PRIORITY = 2 ** 31 - 1
+
+
+def task_kind(task: Task) -> str:
+    """
+    Returns the kind of a task, which is shared by all tasks that execute the same function.
+    """
+    fn = getattr(task, "fn", None)
+    name = getattr(fn, "__name__", None)
+    if name is None or name == "<lambda>":
+        # Strip the item-specific suffix of the task name
+        name = re.split(r"[-_/]", task.label)[0]
+    return name
+
+
+@dataclasses.dataclass(frozen=True)
+class TaskTrace:
+    name: str
+    kind: str
+    duration: float
+
+
+def read_task_traces(trace_dir: Path) -> List[TaskTrace]:
+    traces = []
+    for path in sorted(trace_dir.glob("*.json")):
+        with open(path) as f:
+            traces.append(TaskTrace(**json.load(f)))
+    return traces
+
+
+class TaskDurationModel:
+    """
+    Estimates the duration of tasks.
+
+    A task that ran in a previous run of the workflow (with the same name) is expected to take as
+    long as it did then. Other tasks are expected to take as long as the traced tasks of the same
+    kind on average, or a duration from `defaults`.
+    """
+
+    def __init__(
+        self,
+        traces: List[TaskTrace] = (),
+        defaults: Optional[Dict[str, float]] = None,
+        default: float = 1.0,
+    ):
+        self.by_name = {trace.name: trace.duration for trace in traces}
+        durations = defaultdict(list)
+        for trace in traces:
+            durations[trace.kind].append(trace.duration)
+        self.by_kind = {kind: statistics.mean(values) for (kind, values) in durations.items()}
+        self.defaults = DEFAULT_TASK_DURATIONS if defaults is None else defaults
+        self.default = default
+
+    @staticmethod
+    def from_traces(trace_dir: Path) -> "TaskDurationModel":
+        traces = read_task_traces(trace_dir) if trace_dir.is_dir() else []
+        return TaskDurationModel(traces)
+
+    def duration(self, task: Task) -> float:
+        duration = self.by_name.get(task.label)
+        if duration is not None:
+            return duration
+        kind = task_kind(task)
+        duration = self.by_kind.get(kind)
+        if duration is not None:
+            return duration
+        return self.defaults.get(kind, self.default)
+
+
+def assign_critical_path_priorities(job: Job, model: TaskDurationModel) -> Dict[int, float]:
+    """
+    Sets the priority of each task of `job` to the (estimated) length of the longest chain of tasks
+    that starts with it, so that HQ starts the tasks on the critical path of the job first.
+    Returns the estimated remaining path length (in seconds) of each task, keyed by its ID.
+    """
+    dependents = defaultdict(list)
+    for task in job.tasks:
+        for dep in task.dependencies:
+            dependents[dep.task_id].append(task)
+
+    # Dependencies are always created before the tasks that depend on them
+    remaining: Dict[int, float] = {}
+    for task in reversed(job.tasks):
+        downstream = max(
+            (remaining[dependent.task_id] for dependent in dependents[task.task_id]), default=0
+        )
+        remaining[task.task_id] = model.duration(task) + downstream
+        task.priority = min(int(round(remaining[task.task_id])), MAX_PRIORITY)
+
+    if remaining:
+        logger.info(f"Estimated critical path of the job: {max(remaining.values()):.0f}s")
+    return remaining
+
+
+def run_traced(fn: Callable, trace: Path, name: str, kind: str, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    record = TaskTrace(name=name, kind=kind, duration=time.time() - start)
+    with atomic_output(trace) as output:
+        output.write_text(json.dumps(dataclasses.asdict(record)))
+    return result
+
+
+def trace_task_durations(job: Job, trace_dir: Path):
+    """
+    Makes the tasks of `job` record their durations into `trace_dir` once they succeed, so that
+    the priorities of a following run of the workflow can be based on them (see
+    `TaskDurationModel.from_traces`).
+    """
+    ensure_directory(trace_dir)
+    for task in job.tasks:
+        if not isinstance(task, PythonFunction):
+            continue
+        # Each task has its own trace file, so that concurrent tasks do not share a file
+        path = trace_dir / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', task.label)}.json"
+        task.fn = cloud_wrap(
+            functools.partial(run_traced, task.fn.fn, path, task.label, task_kind(task))
+        )
@@ -0,0 +1,98 @@
+import dataclasses
+import logging
+import math
+from pathlib import Path
+from typing import Optional
+
+from ..common import ComplexOrLigand
+
+logger = logging.getLogger(__name__)
+
+# Distance between the solute and the edges of the box, set by `solvate`
+SOLVATION_BOX_DISTANCE = 1.5
+# Ratio of the volume of a rhombic dodecahedron to the cube of its box vector length
+DODECAHEDRON_VOLUME_RATIO = math.sqrt(2) / 2
+# Number of atoms in a cubic nanometer of (three-site) water
+WATER_ATOMS_PER_NM3 = 100.0
+
+
+@dataclasses.dataclass(frozen=True)
+class CoreScalingModel:
+    """
+    Assigns cores to a MD simulation based on the number of atoms of the simulated system, so that
+    small systems (e.g. a ligand in water) do not occupy as many cores as large complexes, and
+    they can run alongside them on the same node.
+    """
+
+    """
+    Number of atoms per core, below which adding more cores does not pay off.
+    """
+    atoms_per_core: int = 5000
+    min_cores: int = 1
+    """
+    Upper bound of the number of cores. If None, the cores of the stage parameters are used.
+    """
+    max_cores: Optional[int] = None
+
+    def cores(self, atoms: int, max_cores: int) -> int:
+        if self.max_cores is not None:
+            max_cores = self.max_cores
+        cores = math.ceil(atoms / self.atoms_per_core)
+        return max(self.min_cores, min(cores, max_cores))
+
+
+def read_gro_atom_count(path: Path) -> int:
+    with open(path) as f:
+        f.readline()
+        return int(f.readline())
+
+
+def estimate_solvated_atoms(solute_gro: Path) -> int:
+    """
+    Estimates the number of atoms of the solute from `solute_gro` after it is solvated in a
+    rhombic dodecahedron (see `solvate`).
+    """
+    with open(solute_gro) as f:
+        f.readline()
+        atoms = int(f.readline())
+        lower = [math.inf] * 3
+        upper = [-math.inf] * 3
+        for _ in range(atoms):
+            line = f.readline()
+            position = (float(line[20:28]), float(line[28:36]), float(line[36:44]))
+            for axis in range(3):
+                lower[axis] = min(lower[axis], position[axis])
+                upper[axis] = max(upper[axis], position[axis])
+    diameter = max(upper[axis] - lower[axis] for axis in range(3)) if atoms else 0
+    box = diameter + 2 * SOLVATION_BOX_DISTANCE
+    volume = DODECAHEDRON_VOLUME_RATIO * box ** 3
+    # The solute displaces some of the water, so the estimate is slightly pessimistic
+    return atoms + int(volume * WATER_ATOMS_PER_NM3)
+
+
+def system_atom_count(item: ComplexOrLigand) -> int:
+    """
+    Returns the number of atoms of the solvated system of `item`.
+    If the system has not been solvated yet (e.g. when the whole workflow is submitted at once),
+    its size is estimated from the solute.
+    """
+    for path in (item.ions_output, item.solvated_gro):
+        if path.is_file():
+            return read_gro_atom_count(path)
+    return estimate_solvated_atoms(item.editconf_input_gro)
+
+
+def item_cores(item: ComplexOrLigand, cores: int, scaling: Optional[CoreScalingModel]) -> int:
+    """
+    Returns the number of cores that should be used for a simulation of `item`.
+    Without a scaling model, all `cores` are used.
+    """
+    if scaling is None:
+        return cores
+    if not item.editconf_input_gro.is_file() and not item.solvated_gro.is_file():
+        logger.warning(f"Structure of {item.path} was not found, its size cannot be estimated")
+        return cores
+    atoms = system_atom_count(item)
+    item_cores = scaling.cores(atoms, cores)
+    logger.debug(f"{item.kind} of {item.edge}/{item.pose}: {atoms} atom(s), {item_cores} core(s)")
+    return item_cores
@@ -0,0 +1,102 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from hyperqueue import Job
+from hyperqueue.task.task import Task
+
+from ..ligen.scores import ScoreReductionConfig, reduce_scores
+from ...utils.io import ensure_directory
+
+
+@dataclass
+class SubmittedScores:
+    csv: Path
+    # Task that produces the CSV file, None if the file already exists
+    task: Optional[Task]
+
+
+def hq_submit_score_reduction(
+    inputs: List[SubmittedScores],
+    top_csvs: Dict[str, Path],
+    n: int,
+    merged_csv: Optional[Path],
+    workdir: Path,
+    job: Job,
+    deps: List[Task],
+    arity: Optional[int] = None,
+    stream: bool = False,
+    max_streaming: int = 4,
+    name: str = "reduce-scores",
+) -> Task:
+    """
+    Submits a tree of reduction tasks (see `reduce_scores`) that combines the score files in
+    `inputs` into ranked `top_csvs` (and optionally into `merged_csv`).
+
+    Each task of the tree reduces at most `arity` files, so that partial reductions can start as
+    soon as their own inputs are ready, while screening of other shards is still in progress.
+    If `arity` is None, a single task reduces all the inputs.
+
+    If `stream` is True, at most `max_streaming` tasks of the first level of the tree only depend
+    on `deps`, and they wait for their input files to appear on disk (see
+    `ScoreReductionConfig.wait_for_inputs`). Each of them occupies a CPU while it waits, so the
+    remaining tasks depend on the tasks that produce their inputs, otherwise the waiting tasks
+    could occupy all CPUs and starve the screening tasks that they wait for.
+    Returns the task that produces the final outputs.
+    """
+
+    streaming = 0
+
+    def submit(config: ScoreReductionConfig, inputs: List[SubmittedScores], name: str) -> Task:
+        nonlocal streaming
+        if config.wait_for_inputs:
+            streaming += 1
+            task_deps = deps
+        else:
+            task_deps = [input.task for input in inputs if input.task is not None]
+        return job.function(reduce_scores, args=(config,), deps=task_deps, name=name)
+
+    def stream_level(level: int) -> bool:
+        # Only tasks that reduce the screening outputs stream their inputs
+        return stream and level == 0 and streaming < max_streaming
+
+    level = 0
+    while arity is not None and len(inputs) > arity:
+        ensure_directory(workdir)
+        reduced = []
+        for (index, start) in enumerate(range(0, len(inputs), arity)):
+            group = inputs[start:start + arity]
+            output = workdir / f"{name}-{level}-{index}.csv"
+            # If all scores are merged, the intermediate merged files are needed anyway, and they
+            # can also be used to compute the best rows. Otherwise, only the best rows of each
+            # group are passed to the next level.
+            if merged_csv is not None:
+                config = ScoreReductionConfig(
+                    input_csvs=[input.csv for input in group],
+                    top_csvs={},
+                    n=n,
+                    merged_csv=output,
+                    wait_for_inputs=stream_level(level),
+                )
+            else:
+                config = ScoreReductionConfig(
+                    input_csvs=[input.csv for input in group],
+                    top_csvs={},
+                    n=n,
+                    partial_csv=output,
+                    partial_columns=tuple(top_csvs.keys()),
+                    wait_for_inputs=stream_level(level),
+                )
+            task = submit(config, group, name=f"{name}-{level}-{index}")
+            reduced.append(SubmittedScores(csv=output, task=task))
+        inputs = reduced
+        level += 1
+
+    config = ScoreReductionConfig(
+        input_csvs=[input.csv for input in inputs],
+        top_csvs=top_csvs,
+        n=n,
+        merged_csv=merged_csv,
+        wait_for_inputs=stream_level(level),
+    )
+    return submit(config, inputs, name=name)
@@ -1,10 +1,13 @@
 import dataclasses
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 from hyperqueue import Job
 from hyperqueue.task.task import Task
 
+from ..ligen.scores import read_top_rows
+from ..ligen.smi import SmiIndex, parse_smi_line
+
 
 @dataclasses.dataclass
 class LigandSelectionConfig:
@@ -12,23 +15,30 @@ class LigandSelectionConfig:
     scores_csv: Path
     output_smi: Path
     n_ligands: int
+    score_column: str = "D23RTMB_SCORE"
+    # Index of `input_smi`. If available, only the selected lines are read from the input file.
+    smi_index: Optional[Path] = None
 
 
 def select_ligands(config: LigandSelectionConfig):
     """
     Selects N ligands from a SMILES file, based on scores in the provided CSV file.
     """
-    import pandas as pd
-
-    df = pd.read_csv(config.scores_csv)
-    df = df.sort_values(by="D23RTMB_SCORE", ascending=False)
-    selected = frozenset(df.iloc[: config.n_ligands]["NAME"])
+    header, rows = read_top_rows(config.scores_csv, config.score_column, config.n_ligands)
+    selected = frozenset()
+    if header is not None:
+        name_index = header.index("NAME")
+        selected = frozenset(row[name_index] for row in rows)
     with open(config.output_smi, "w") as output:
-        with open(config.input_smi) as input:
-            for line in input:
-                line = line.strip()
-                if line in selected:
-                    print(line, file=output)
+        if config.smi_index is not None:
+            with SmiIndex.open(config.smi_index) as index:
+                for (_, line) in index.read_lines(selected):
+                    print(line.decode().strip(), file=output)
+        else:
+            with open(config.input_smi, "rb") as input:
+                for line in input:
+                    if line.strip() and parse_smi_line(line) in selected:
+                        print(line.decode().strip(), file=output)
 
 
 def hq_submit_select_ligands(
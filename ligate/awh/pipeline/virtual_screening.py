@@ -1,19 +1,100 @@
+import csv
 import dataclasses
+import logging
+import math
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 
 from hyperqueue import Job
 from hyperqueue.ffi.protocol import ResourceRequest
 from hyperqueue.task.task import Task
 
 from .expansion import SubmittedExpansion, hq_submit_expansion
+from .scores import SubmittedScores, hq_submit_score_reduction
+from ..ligen.cache import (
+    ScreeningCache,
+    ScreeningCacheConfig,
+    ScreeningCacheLookup,
+    ScreeningCacheStoreConfig,
+    screening_context_key,
+    store_screening_scores,
+)
+from ..ligen.calibration import ThreadLayout
 from ..ligen.common import LigenTaskContext
+from ..ligen.dedup import (
+    AliasPropagationConfig,
+    DeduplicationConfig,
+    deduplicate_smi_file,
+    propagate_alias_scores,
+)
 from ..ligen.expansion import (
+    ExpansionConfig,
     create_expansion_configs_from_smi,
 )
-from ..ligen.virtual_screening import ScreeningConfig, ligen_screen_ligands
-from ...utils.io import ensure_directory
+from ..ligen.manifest import (
+    ShardCompletion,
+    create_shard_completion,
+    run_shard,
+    write_manifest,
+)
+from ..ligen.prefilter import LigandFilterRules, PrefilterConfig, prefilter_smi_file
+from ..ligen.smi import LigandCostModel, measure_smi_file, split_smi_file
+from ..ligen.target import TargetPreparationConfig, prepare_target
+from ..ligen.virtual_screening import (
+    RESCORING_SCORE_COLUMN,
+    ScreeningConfig,
+    ScreeningTarget,
+    ligen_expand_and_screen,
+    ligen_screen_ligands,
+    screening_score_columns,
+)
+from ...utils.io import compressed_path, ensure_directory
+
+logger = logging.getLogger(__name__)
+
+
+def shard_function(
+    completion: Optional[ShardCompletion], function: Callable, *args
+) -> Tuple[Callable, Tuple]:
+    """
+    Returns the function and arguments of a task that computes a single shard, and (if
+    `completion` is set) marks the shard as completed afterwards.
+    """
+    if completion is None:
+        return (function, args)
+    return (run_shard, (completion, function, *args))
+
+
+def hq_submit_target_preparation(
+    targets: Tuple[ScreeningTarget, ...], workdir: Path, job: Job, deps: List[Task]
+) -> Tuple[Tuple[ScreeningTarget, ...], List[Task]]:
+    """
+    Submits a task that prepares the pocket of each target without a prepared pocket.
+    Returns the targets with their (future) pockets and the submitted tasks.
+    """
+    prepared = []
+    tasks = []
+    for target in targets:
+        if target.pocket_pdb is None:
+            config = TargetPreparationConfig(
+                input_protein_pdb=target.protein_pdb,
+                input_probe_mol2=target.probe_mol2,
+                output_pocket_pdb=workdir / f"pocket-{target.name}.pdb",
+            )
+            tasks.append(
+                job.function(
+                    prepare_target,
+                    args=(config,),
+                    deps=deps,
+                    name=f"prepare-target-{target.name}",
+                )
+            )
+            target = dataclasses.replace(
+                target, pocket_pdb=config.output_pocket_pdb, pocket_radius=config.radius
+            )
+        prepared.append(target)
+    return (tuple(prepared), tasks)
 
 
 @dataclass
@@ -27,13 +108,12 @@ def hq_submit_screening(
     config: ScreeningConfig,
     expansion_submit: SubmittedExpansion,
     job: Job,
+    completion: Optional[ShardCompletion] = None,
 ) -> SubmittedScreening:
+    (function, args) = shard_function(completion, ligen_screen_ligands, ctx, config)
     task = job.function(
-        ligen_screen_ligands,
-        args=(
-            ctx,
-            config,
-        ),
+        function,
+        args=args,
         deps=(expansion_submit.task,),
         name=f"screening-{config.output_scores_csv.name}",
         resources=ResourceRequest(cpus=config.cores),
@@ -41,6 +121,32 @@ def hq_submit_screening(
     return SubmittedScreening(config=config, task=task)
 
 
+def hq_submit_expand_and_screen(
+    ctx: LigenTaskContext,
+    expansion: ExpansionConfig,
+    config: ScreeningConfig,
+    stream: bool,
+    deps: List[Task],
+    job: Job,
+    completion: Optional[ShardCompletion] = None,
+) -> SubmittedScreening:
+    """
+    Submits a single task that performs both expansion and screening of a single SMI file, without
+    storing the expanded MOL2 file on shared storage.
+    """
+    (function, args) = shard_function(
+        completion, ligen_expand_and_screen, ctx, expansion, config, stream
+    )
+    task = job.function(
+        function,
+        args=args,
+        deps=deps,
+        name=f"expand-screening-{config.output_scores_csv.name}",
+        resources=ResourceRequest(cpus=config.cores),
+    )
+    return SubmittedScreening(config=config, task=task)
+
+
 @dataclasses.dataclass
 class VirtualScreeningPipelineConfig:
     input_smi: Path
@@ -48,19 +154,146 @@ class VirtualScreeningPipelineConfig:
     input_protein: Path
 
     max_molecules_per_smi: int = 10
+    """
+    (Maximum) number of ligands in `input_smi`. It has to be specified if `input_smi` is produced
+    by a task of the same job. The file is then split into shards at runtime, and it cannot be
+    indexed nor looked up in the screening cache.
+    """
+    ligand_count: Optional[int] = None
+    """
+    Other targets that the ligands are screened against (in the same LiGen pipeline as
+    `input_protein`). With additional targets, the output CSV files contain a score column for
+    each target.
+    """
+    additional_targets: List[ScreeningTarget] = dataclasses.field(default_factory=list)
+    """
+    Model used to balance the SMI shards by the estimated cost of their ligands.
+    If None, each shard will have exactly `max_molecules_per_smi` ligands.
+    """
+    cost_model: Optional[LigandCostModel] = dataclasses.field(default_factory=LigandCostModel)
+    """
+    Perform expansion and screening of each SMI file in a single task, and keep the expanded
+    MOL2 files in node-local storage instead of writing them to the workdir.
+    """
+    fuse_expansion: bool = False
+    """
+    When expansion is fused, stream the expanded ligands from `ligen-coordgen` to `ligen`
+    through a named pipe instead of a node-local file.
+    """
+    fused_expansion_stream: bool = False
+    """
+    Compression format ("gzip" or "zstd") of the expanded MOL2 files and of the scores of the
+    individual shards. The files are (de)compressed on the fly while they are streamed into and out
+    of the LiGen container (see `LigenContainerContext.map_compressed_file`).
+    """
+    compression: Optional[str] = None
+    """
+    How many best ligands (per score column) should be stored in the ranked scores file.
+    """
+    top_n: int = 100
+    """
+    If set, the ranked scores files contain at least this fraction of all input ligands.
+    """
+    top_fraction: Optional[float] = None
+    """
+    Rescore the best pose of each ligand with the expensive D23RTMB scoring function, and rank the
+    ligands by the rescored value.
+    """
+    rescore: bool = False
+    """
+    Store the scores of all ligands into a single merged CSV file.
+    """
+    merge_scores: bool = True
+    """
+    Start reducing the scores right away and process each shard's scores as soon as its screening
+    finishes, instead of waiting for all screening tasks. Only a few reduction tasks of the first
+    level stream (see `hq_submit_score_reduction`), each of them occupies a CPU while it waits.
+    """
+    stream_reduction: bool = False
+    """
+    Reduce the scores using a tree of tasks, where each task reduces at most this many files.
+    If None, a single task reduces the scores of all shards.
+    """
+    reduction_arity: Optional[int] = 16
+    """
+    Build an index of the input ligands while sharding the SMI file, so that specific ligands can
+    later be read without scanning the whole input file (see `SmiIndex`).
+    """
+    index_ligands: bool = True
+    """
+    Only screen a single copy of ligands with the same canonical SMILES (see
+    `deduplicate_smi_file`). The merged scores file contains the scores of all the copies.
+    The duplicates are found on the submit node when the workflow is being built (the shards are
+    created from the unique ligands), so RDKit should be available there.
+    """
+    deduplicate: bool = False
+    """
+    Rules that the input ligands have to satisfy in order to be screened (see `prefilter_smi_file`).
+    The rules are evaluated on the submit node when the workflow is being built, not by a HQ task,
+    because the shards (their number, costs and completion fingerprints) and the cache lookup are
+    computed from the filtered ligands at build time. RDKit thus has to be available on the submit
+    node, and the whole library is processed there before any task is submitted.
+    """
+    prefilter: Optional[LigandFilterRules] = None
+    """
+    Reuse scores of ligands that were already screened (against the same targets, with the same
+    pipeline) in previous campaigns, and store the newly computed scores into the cache.
+    """
+    cache: Optional[ScreeningCacheConfig] = None
+    """
+    Threading settings of LiGen and HQ resources of the screening tasks, usually determined by
+    calibration (see `hq_submit_ligen_calibration`). If None, `ligen_cores` is used for everything.
+    """
+    thread_layout: Optional[ThreadLayout] = None
+    """
+    Do not submit shards that were already completed by a previous run of the campaign in the same
+    workdir (see `ShardCompletion`). The scores of all shards are reduced again.
+    """
+    resume: bool = False
+    """
+    Isolate ligands that crash LiGen by bisecting their failed shard, instead of failing the whole
+    shard (see `run_with_bisection`). The isolated ligands are stored into `rejected-<shard>.smi`
+    (or `.mol2`) files in the outputs directory.
+    The bisection runs inside the task of the failed shard. It gives up (and the shard fails) after
+    the number of LiGen runs needed to isolate about `MAX_REJECTED_LIGANDS` (4) ligands, which also
+    bounds the time spent on failures that are not caused by the ligands (e.g. a missing container
+    or lack of memory), since those make every part of the shard fail.
+    """
+    bisect_failures: bool = False
+    """
+    Prepare each target once for all shards (see `prepare_target`), so that LiGen only processes
+    the region of the protein around the probe in each shard.
+    """
+    prepare_targets: bool = False
+    """
+    Residues of `input_protein` around `input_probe_mol2`, prepared in advance (e.g. by a previous
+    stage of the workflow).
+    """
+    input_pocket_pdb: Optional[Path] = None
 
 
 @dataclasses.dataclass
 class SubmittedVirtualScreeningPipeline:
     tasks: List[Task]
-    output_scores_csv: Path
-
-
-def merge_csvs(csv_paths: List[Path], output: Path):
-    import pandas as pd
-
-    df = pd.concat((pd.read_csv(csv) for csv in csv_paths))
-    df.to_csv(output, index=False)
+    # Index of the input ligands, only available if `index_ligands` was enabled
+    smi_index: Optional[Path]
+    # Merged scores of all ligands, only available if `merge_scores` was enabled
+    output_scores_csv: Optional[Path]
+    # Best ligands ranked by `score_column`
+    output_top_csv: Path
+    # Best ligands ranked by each score column
+    output_top_csvs: Dict[str, Path]
+    # Main score column, the rescoring score if rescoring was enabled, otherwise the screening
+    # score of the first target
+    score_column: str
+    # Ligands rejected by the prefilter, only available if `prefilter` was enabled
+    rejected_csv: Optional[Path]
+    # Number of input ligands left after deduplication and prefiltering
+    ligand_count: int
+    # Number of ligands in each ranked file
+    top_n: int
+    # Prepared pocket of the primary target, only available if it was prepared
+    pocket_pdb: Optional[Path]
 
 
 def hq_submit_ligen_virtual_screening_workflow(
@@ -74,14 +307,33 @@ def hq_submit_ligen_virtual_screening_workflow(
     workdir_inputs = ensure_directory(workdir / "inputs")
     workdir_outputs = ensure_directory(workdir / "outputs")
     output_csv = workdir_outputs / "scores.csv"
+    targets = (
+        ScreeningTarget(
+            name="10gs",
+            protein_pdb=config.input_protein,
+            probe_mol2=config.input_probe_mol2,
+            pocket_pdb=config.input_pocket_pdb,
+        ),
+        *config.additional_targets,
+    )
+    if len(set(target.name for target in targets)) != len(targets):
+        raise Exception(f"Screening target names are not unique: {[t.name for t in targets]}")
+    target_tasks = []
+    if config.prepare_targets:
+        (targets, target_tasks) = hq_submit_target_preparation(targets, workdir_inputs, job, deps)
+    score_columns = screening_score_columns(targets, rescore=config.rescore)
+    output_top_csvs = {column: workdir_outputs / f"top-{column}.csv" for column in score_columns}
+    # Rescoring is more precise, so it is preferred for ranking the ligands
+    score_column = RESCORING_SCORE_COLUMN if config.rescore else score_columns[0]
+    smi_index = workdir_inputs / "ligands.index" if config.index_ligands else None
 
-    def create_screening_config(task: SubmittedExpansion) -> ScreeningConfig:
-        return ScreeningConfig(
-            input_probe_mol2=config.input_probe_mol2,
-            input_protein_pdb=config.input_protein,
-            input_expanded_mol2=task.config.output_mol2,
-            input_protein_name="10gs",
-            output_scores_csv=workdir_outputs / f"screening-{task.config.id}.csv",
+    def create_screening_config(id: str, expanded_mol2: Path) -> ScreeningConfig:
+        screening_config = ScreeningConfig(
+            targets=targets,
+            input_expanded_mol2=expanded_mol2,
+            output_scores_csv=compressed_path(
+                workdir_outputs / f"screening-{id}.csv", config.compression
+            ),
             # Use at most <ligen_cores> threads for each SMI file.
             # If each SMI file contains less ligands than <ligen_cores>, we should tell HQ that we
             # don't even use so many cores.
@@ -89,29 +341,237 @@ def hq_submit_ligen_virtual_screening_workflow(
             num_parser=ligen_cores,
             num_workers_unfold=ligen_cores,
             num_workers_docknscore=ligen_cores,
+            rescore=config.rescore,
+            rejects_mol2=(
+                workdir_outputs / f"rejected-{id}.mol2" if config.bisect_failures else None
+            ),
         )
+        if config.thread_layout is not None:
+            screening_config = config.thread_layout.apply_to_screening(
+                screening_config, max_cores=config.max_molecules_per_smi
+            )
+        return screening_config
 
-    expansion_configs = create_expansion_configs_from_smi(
-        input_smi=config.input_smi,
-        workdir_inputs=workdir_inputs,
-        workdir_outputs=workdir_outputs,
-        max_molecules=config.max_molecules_per_smi,
-    )
+    cached_csvs = []
+    rejected_csv = None
+    aliases = None
+    if config.ligand_count is not None:
+        # The input SMI file might not exist yet, so it is split by a task at runtime into a fixed
+        # number of shards
+        if config.cache is not None or config.prefilter is not None or config.deduplicate:
+            raise Exception(
+                "Screening cache, prefilter and deduplication cannot be used if the input ligands "
+                "are not known"
+            )
+        smi_index = None
+        ligand_count = config.ligand_count
+        shard_count = max(1, math.ceil(ligand_count / config.max_molecules_per_smi))
+        expansion_configs = []
+        for shard in range(shard_count):
+            name = f"{config.input_smi.stem}-{shard}"
+            expansion_configs.append(
+                ExpansionConfig(
+                    id=name,
+                    input_smi=workdir_inputs / f"{name}.smi",
+                    output_mol2=workdir_outputs / f"{name}.mol2",
+                )
+            )
+        split_task = job.function(
+            split_smi_file,
+            args=(config.input_smi, [c.input_smi for c in expansion_configs], config.cost_model),
+            deps=deps,
+            name=f"split-{config.input_smi.stem}",
+        )
+        shard_deps = [split_task, *target_tasks]
+    else:
+        input_smi = config.input_smi
+        if config.deduplicate:
+            # Each molecule is only screened once, its scores are then copied to its duplicates.
+            # This runs on the submit node, because the shards are created from its output below.
+            input_smi = workdir_inputs / f"{config.input_smi.stem}-unique.smi"
+            aliases = workdir_inputs / "aliases.sqlite"
+            deduplicate_smi_file(
+                DeduplicationConfig(
+                    input_smi=config.input_smi, output_smi=input_smi, output_aliases=aliases
+                )
+            )
+        if config.prefilter is not None:
+            # Ligands that would be discarded anyway are not expanded nor screened. This runs on
+            # the submit node, because the shards are created from its output below.
+            filtered_smi = workdir_inputs / f"{config.input_smi.stem}-filtered.smi"
+            rejected_csv = workdir_outputs / "rejected-ligands.csv"
+            prefilter_smi_file(
+                PrefilterConfig(
+                    input_smi=input_smi,
+                    output_smi=filtered_smi,
+                    rejected_csv=rejected_csv,
+                    rules=config.prefilter,
+                )
+            )
+            input_smi = filtered_smi
+
+        if config.cache is not None:
+            # Ligands with cached scores are not screened again, their scores are stored into a
+            # separate CSV file that is merged with the other scores.
+            cache_context = screening_context_key(
+                create_screening_config("cached", workdir_outputs / "cached.mol2")
+            )
+            cached_csv = workdir_outputs / "screening-cached.csv"
+            with ScreeningCache.open(config.cache.path) as cache:
+                with open(cached_csv, "w", newline="") as f:
+                    writer = csv.writer(f, lineterminator="\n")
+                    lookup = ScreeningCacheLookup(cache, cache_context, writer)
+                    measurement = measure_smi_file(input_smi, config.cost_model, filter=lookup)
+                cache.add_stats(lookup.stats)
+            logger.info(f"Screening cache lookup: {lookup.stats}")
+            cached_csvs.append(cached_csv)
+        else:
+            measurement = measure_smi_file(input_smi, config.cost_model)
+
+        ligand_count = len(measurement.kept)
+        expansion_configs = create_expansion_configs_from_smi(
+            input_smi=input_smi,
+            workdir_inputs=workdir_inputs,
+            workdir_outputs=workdir_outputs,
+            max_molecules=config.max_molecules_per_smi,
+            cost_model=config.cost_model,
+            index_path=smi_index,
+            measurement=measurement,
+        )
+        shard_deps = [*deps, *target_tasks]
+
+    if config.compression is not None and not config.fuse_expansion:
+        expansion_configs = [
+            dataclasses.replace(c, output_mol2=compressed_path(c.output_mol2, config.compression))
+            for c in expansion_configs
+        ]
+    if config.bisect_failures:
+        expansion_configs = [
+            dataclasses.replace(c, rejects_smi=workdir_outputs / f"rejected-{c.id}.smi")
+            for c in expansion_configs
+        ]
 
-    expand_tasks = []
-    for c in expansion_configs:
-        expand_tasks.append(hq_submit_expansion(ctx, c, deps, job))
+    top_n = config.top_n
+    if config.top_fraction is not None:
+        top_n = max(top_n, math.ceil(ligand_count * config.top_fraction))
 
-    screening_configs = [create_screening_config(task) for task in expand_tasks]
-    screen_tasks = [
-        hq_submit_screening(ctx, c, task, job).task
-        for (c, task) in zip(screening_configs, expand_tasks)
+    screening_configs = [create_screening_config(c.id, c.output_mol2) for c in expansion_configs]
+
+    completions: List[Optional[ShardCompletion]] = [None] * len(expansion_configs)
+    if config.ligand_count is None:
+        # Completed shards are marked, so that a resumed campaign can skip them. The markers
+        # become stale if the shard or anything that affects its scores changes.
+        fingerprint = screening_context_key(
+            create_screening_config("manifest", workdir_outputs / "manifest.mol2")
+        )
+        completions = [
+            create_shard_completion(
+                e.id,
+                inputs=[e.input_smi],
+                outputs=[c.output_scores_csv],
+                marker=workdir_outputs / f"{e.id}.done",
+                fingerprint=fingerprint,
+            )
+            for (e, c) in zip(expansion_configs, screening_configs)
+        ]
+    completed = [
+        config.resume and completion is not None and completion.is_complete()
+        for completion in completions
+    ]
+    if config.ligand_count is None:
+        write_manifest(workdir / "manifest.json", list(zip(completions, completed)))
+
+    screen_tasks: List[Optional[Task]] = []
+    for (e, c, completion, done) in zip(
+        expansion_configs, screening_configs, completions, completed
+    ):
+        if done:
+            screen_tasks.append(None)
+            continue
+        if completion is not None:
+            # Outputs of a previous run are stale, and streamed reductions could read them before
+            # the shard is computed again
+            completion.reset()
+        if config.fuse_expansion:
+            screen_tasks.append(
+                hq_submit_expand_and_screen(
+                    ctx,
+                    e,
+                    c,
+                    stream=config.fused_expansion_stream,
+                    deps=shard_deps,
+                    job=job,
+                    completion=completion,
+                ).task
+            )
+        else:
+            expand_task = hq_submit_expansion(ctx, e, shard_deps, job)
+            screen_tasks.append(
+                hq_submit_screening(ctx, c, expand_task, job, completion=completion).task
+            )
+
+    if config.cache is not None:
+        # Shards completed by a previous run are stored as well, because that run might have been
+        # interrupted before it stored them. Storing the same scores again is harmless.
+        store_config = ScreeningCacheStoreConfig(
+            cache=config.cache,
+            context=cache_context,
+            inputs=[
+                (e.input_smi, c.output_scores_csv)
+                for (e, c) in zip(expansion_configs, screening_configs)
+            ],
+        )
+        job.function(
+            store_screening_scores,
+            args=(store_config,),
+            deps=[task for task in screen_tasks if task is not None],
+            name="store-cached-scores",
+        )
+
+    score_inputs = [SubmittedScores(csv=csv, task=None) for csv in cached_csvs] + [
+        SubmittedScores(csv=c.output_scores_csv, task=task)
+        for (c, task) in zip(screening_configs, screen_tasks)
     ]
-    csv_paths = [config.output_scores_csv for config in screening_configs]
-    merge_csv_task = job.function(
-        merge_csvs, args=(csv_paths, output_csv), deps=screen_tasks
+    merged_csv = output_csv if config.merge_scores else None
+    if merged_csv is not None and aliases is not None:
+        merged_csv = workdir_outputs / "scores-unique.csv"
+    reduce_task = hq_submit_score_reduction(
+        score_inputs,
+        top_csvs=output_top_csvs,
+        n=top_n,
+        merged_csv=merged_csv,
+        workdir=workdir / "reduction",
+        job=job,
+        deps=deps,
+        arity=config.reduction_arity,
+        stream=config.stream_reduction,
     )
 
+    tasks = [reduce_task]
+    if merged_csv is not None and aliases is not None:
+        # The ranked files only contain the representatives, so that the same molecule is not
+        # selected multiple times
+        propagate_task = job.function(
+            propagate_alias_scores,
+            args=(
+                AliasPropagationConfig(
+                    scores_csv=merged_csv, aliases=aliases, output_csv=output_csv
+                ),
+            ),
+            deps=[reduce_task],
+            name="propagate-alias-scores",
+        )
+        tasks.append(propagate_task)
+
     return SubmittedVirtualScreeningPipeline(
-        output_scores_csv=output_csv, tasks=[merge_csv_task]
+        output_scores_csv=output_csv if config.merge_scores else None,
+        output_top_csv=output_top_csvs[score_column],
+        output_top_csvs=output_top_csvs,
+        score_column=score_column,
+        smi_index=smi_index,
+        rejected_csv=rejected_csv,
+        ligand_count=ligand_count,
+        top_n=top_n,
+        pocket_pdb=targets[0].pocket_pdb,
+        tasks=tasks,
     )
@@ -1,3 +1,6 @@
+import contextlib
+import fcntl
+import hashlib
 import logging
 import os
 import shutil
@@ -59,6 +62,24 @@ def move_files(files: Iterable[GenericPath], dst: GenericPath):
         move_file(file, dst)
 
 
+# ioctl request that shares the data blocks of two files (reflink), see `ioctl_ficlone(2)`
+FICLONE = 0x40049409
+
+
+def clone_file(src: GenericPath, dst: GenericPath):
+    """
+    Copies `src` to `dst` as a reflink (copy-on-write clone) if the filesystem supports it,
+    otherwise the data is copied.
+    """
+    try:
+        with open(src, "rb") as input, open(dst, "wb") as output:
+            fcntl.ioctl(output.fileno(), FICLONE, input.fileno())
+        return
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+
+
 def copy_directory(src: GenericPath, dst: GenericPath):
     logging.debug(f"Copying directory {src} to {dst}")
     shutil.copytree(
@@ -113,23 +134,100 @@ def replace_in_place(path: GenericPath, replacements: List[Tuple[str, str]]):
         f.write(data)
 
 
-def split_file_by_lines(file: Path, max_lines: int) -> Iterator[str]:
+def partial_path(path: Path) -> Path:
     """
-    Splits the input file into sections, so that each section has at most `max_lines` lines.
-    Returns a lazy iterator of these sections.
+    Returns a path where an output file is stored before it is complete.
     """
-    buffer = ""
-    line_count = 0
-    with open(file) as f:
-        for line in f:
-            buffer += line
-            line_count += 1
-            if line_count == max_lines:
-                yield buffer
-                buffer = ""
-                line_count = 0
-    if buffer:
-        yield buffer
+    return path.with_name(f"{path.name}.partial")
+
+
+@contextlib.contextmanager
+def atomic_output(path: Path) -> Iterator[Path]:
+    """
+    Yields a path that should be used to write the file at `path`.
+    The file is moved to `path` only after the block finishes successfully, so that readers never
+    observe an incomplete file.
+    """
+    partial = partial_path(path)
+    try:
+        yield partial
+    except BaseException:
+        if partial.exists():
+            os.unlink(partial)
+        raise
+    os.replace(partial, path)
+
+
+# Compression
+# Compression formats of intermediate files, identified by their suffix
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def compressed_path(path: Path, compression: Optional[str]) -> Path:
+    """
+    Returns `path` with the suffix of the given `compression` format ("gzip" or "zstd").
+    If `compression` is None, `path` is returned unchanged.
+    """
+    if compression is None:
+        return path
+    suffix = COMPRESSION_SUFFIXES.get(compression)
+    if suffix is None:
+        raise Exception(f"Unknown compression format `{compression}`")
+    return path.with_name(f"{path.name}{suffix}")
+
+
+def is_compressed(path: GenericPath) -> bool:
+    return Path(path).suffix in COMPRESSION_SUFFIXES.values()
+
+
+def uncompressed_name(path: GenericPath) -> str:
+    """
+    Returns the name of the file at `path` without its compression suffix.
+    """
+    path = Path(path)
+    return path.stem if is_compressed(path) else path.name
+
+
+def open_compressed(path: GenericPath, mode: str = "rb", newline: Optional[str] = None):
+    """
+    Opens the file at `path`, which is transparently (de)compressed if it has a compression suffix
+    (see `COMPRESSION_SUFFIXES`). The data is (de)compressed on the fly, so the uncompressed
+    content is never stored on disk.
+    Partial files (see `partial_path`) are compressed according to the suffix of their final path.
+    """
+    path = Path(path)
+    suffix = path.suffix
+    if suffix == ".partial":
+        suffix = Path(path.stem).suffix
+    if suffix == COMPRESSION_SUFFIXES["gzip"]:
+        import gzip
+
+        if "b" in mode:
+            return gzip.open(path, mode, compresslevel=3)
+        return gzip.open(path, f"{mode}t", compresslevel=3, newline=newline)
+    elif suffix == COMPRESSION_SUFFIXES["zstd"]:
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(f"The `zstandard` package is required to open {path}")
+        return zstandard.open(path, mode, newline=None if "b" in mode else newline)
+    return open(path, mode, newline=None if "b" in mode else newline)
+
+
+# Synchronization
+@contextlib.contextmanager
+def file_lock(path: GenericPath):
+    """
+    Holds an exclusive lock on the file at `path` (which is created if it does not exist) while
+    the context manager is active.
+    The lock can be used to synchronize multiple processes running on the same node.
+    """
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 # File iteration
@@ -196,6 +294,17 @@ def check_file_nonempty(path: GenericPath):
         raise Exception("Expected {path} to be a non-empty file, but it is empty")
 
 
+def hash_file(path: GenericPath, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Returns a SHA-256 hex digest of the content of the file at `path`.
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
 # General utility
 def remap_paths_to_dir(paths: List[GenericPath], dir: Path) -> List[Path]:
     """
@@ -0,0 +1,158 @@
+import dataclasses
+import errno
+import json
+import logging
+import os
+import stat
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+from .io import atomic_output, clone_file, delete_path, ensure_directory, hash_file
+from .paths import GenericPath
+
+logger = logging.getLogger(__name__)
+
+# File that stores the manifest of a snapshot inside the snapshot directory
+SNAPSHOT_MANIFEST = ".snapshot.json"
+
+
+class ContentStore:
+    """
+    Stores files by the hash of their content, so that each distinct content is stored only once.
+
+    Stored objects are read-only and they are never modified, so they can be hardlinked into
+    immutable directories (see `snapshot_directory`). Files that might be modified later are
+    materialized as reflinks or copies instead.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def object_path(self, file_hash: str) -> Path:
+        return self.directory / file_hash[:2] / file_hash
+
+    def contains(self, file_hash: str) -> bool:
+        return self.object_path(file_hash).is_file()
+
+    def add(self, path: GenericPath, file_hash: Optional[str] = None) -> str:
+        """
+        Stores the content of the file at `path` (unless it is already stored) and returns its
+        hash.
+        """
+        if file_hash is None:
+            file_hash = hash_file(path)
+        target = self.object_path(file_hash)
+        if not target.is_file():
+            ensure_directory(target.parent)
+            # Concurrent tasks often store the same content, so each writer uses its own
+            # temporary file, and the object is published by a link, which fails if it exists
+            (fd, partial) = tempfile.mkstemp(dir=target.parent, prefix=f".{file_hash}.")
+            os.close(fd)
+            try:
+                clone_file(path, partial)
+                os.chmod(partial, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                try:
+                    os.link(partial, target)
+                except FileExistsError:
+                    pass
+                except OSError:
+                    # Hardlinks are not supported, the complete file replaces any other writer's
+                    os.replace(partial, target)
+            finally:
+                if os.path.exists(partial):
+                    os.unlink(partial)
+        return file_hash
+
+    def link(self, file_hash: str, target: Path):
+        """
+        Creates a read-only file at `target` with the content of the object, hardlinked if
+        possible. The file must never be modified in place.
+        """
+        try:
+            os.link(self.object_path(file_hash), target)
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+            clone_file(self.object_path(file_hash), target)
+
+    def materialize(self, file_hash: str, target: Path):
+        """
+        Creates a writable file at `target` with the content of the object.
+        """
+        clone_file(self.object_path(file_hash), target)
+
+
+@dataclass(frozen=True)
+class SnapshotFile:
+    hash: str
+    size: int
+    mtime_ns: int
+
+
+@dataclass
+class SnapshotStats:
+    files: int = 0
+    # Files whose content had to be hashed, because they changed since the previous snapshot
+    hashed_bytes: int = 0
+    # Data that was added to the content store
+    stored_bytes: int = 0
+
+
+def load_snapshot_manifest(snapshot: Path) -> Dict[str, SnapshotFile]:
+    path = snapshot / SNAPSHOT_MANIFEST
+    if not path.is_file():
+        return {}
+    with open(path) as f:
+        return {name: SnapshotFile(**file) for (name, file) in json.load(f).items()}
+
+
+def snapshot_directory(
+    source: Path, target: Path, store: ContentStore, previous: Optional[Path] = None
+) -> SnapshotStats:
+    """
+    Stores a snapshot of `source` into `target`, which is replaced if it exists.
+
+    The files of the snapshot are hardlinks to objects of `store`, so a file whose content is
+    already stored (e.g. because it did not change since a previous snapshot) costs only a
+    hardlink. Files whose size and modification time match the `previous` snapshot of the same
+    directory are not even read again.
+    """
+    previous_files = load_snapshot_manifest(previous) if previous is not None else {}
+    stats = SnapshotStats()
+    files: Dict[str, SnapshotFile] = {}
+
+    delete_path(target)
+    ensure_directory(target)
+    for (root, dirs, names) in os.walk(source):
+        dirs.sort()
+        directory = Path(root)
+        relative_dir = directory.relative_to(source)
+        ensure_directory(target / relative_dir)
+        for name in sorted(names):
+            path = directory / name
+            relative = (relative_dir / name).as_posix()
+            info = path.stat()
+            file = previous_files.get(relative)
+            if file is None or (file.size, file.mtime_ns) != (info.st_size, info.st_mtime_ns):
+                stats.hashed_bytes += info.st_size
+                file_hash = hash_file(path)
+                if not store.contains(file_hash):
+                    stats.stored_bytes += info.st_size
+                    store.add(path, file_hash)
+                file = SnapshotFile(hash=file_hash, size=info.st_size, mtime_ns=info.st_mtime_ns)
+            elif not store.contains(file.hash):
+                stats.stored_bytes += info.st_size
+                store.add(path, file.hash)
+            store.link(file.hash, target / relative)
+            files[relative] = file
+            stats.files += 1
+
+    with atomic_output(target / SNAPSHOT_MANIFEST) as output, open(output, "w") as f:
+        json.dump({name: dataclasses.asdict(file) for (name, file) in files.items()}, f)
+    logger.info(
+        f"Snapshot of {source} into {target}: {stats.files} file(s), hashed "
+        f"{stats.hashed_bytes} B, stored {stats.stored_bytes} B"
+    )
+    return stats
@@ -0,0 +1,71 @@
+import json
+from pathlib import Path
+
+import pytest
+from hyperqueue import Job
+
+from ligate.awh.pipeline.hq import HqCtx, TaskBatcher
+
+
+def write_item(path: Path, text: str):
+    if text == "fail":
+        raise Exception("Item failed")
+    path.write_text(text)
+
+
+def run_task(task):
+    task.fn(*task.args)
+
+
+def test_batch_groups_tasks_with_same_deps(tmp_path):
+    job = Job()
+    dep = job.function(write_item, args=(tmp_path / "dep.txt", "dep"))
+    hq = HqCtx(job=job, batcher=TaskBatcher(job, max_size=2, workers=1)).with_dep(dep)
+
+    tasks = [
+        hq.short_function(write_item, args=(tmp_path / f"{i}.txt", str(i)), name=f"item-{i}")
+        for i in range(3)
+    ]
+    other = hq.with_deps([]).short_function(
+        write_item, args=(tmp_path / "other.txt", "other"), name="other"
+    )
+    assert tasks[0] is tasks[1]
+    assert tasks[2] is not tasks[0]
+    assert other not in tasks
+    assert len(job.tasks) == 4
+
+    for task in job.tasks:
+        run_task(task)
+    assert [(tmp_path / f"{i}.txt").read_text() for i in range(3)] == ["0", "1", "2"]
+
+
+def test_batch_reports_failed_items(tmp_path):
+    job = Job()
+    hq = HqCtx(job=job, batcher=TaskBatcher(job, workers=2, report_dir=tmp_path / "reports"))
+    for text in ("a", "fail", "b"):
+        hq.short_function(write_item, args=(tmp_path / f"{text}.txt", text), name=text)
+    (batch,) = job.tasks
+
+    with pytest.raises(Exception, match="1/3 item"):
+        run_task(batch)
+    # The remaining items were executed despite the failure
+    assert (tmp_path / "a.txt").read_text() == "a"
+    assert (tmp_path / "b.txt").read_text() == "b"
+
+    with open(tmp_path / "reports" / f"{batch.name}.jsonl") as f:
+        results = [json.loads(line) for line in f]
+    assert [result["name"] for result in results] == ["a", "fail", "b"]
+    assert [result["error"] is not None for result in results] == [False, True, False]
+
+
+def test_batch_requests_cores_per_item(tmp_path):
+    job = Job()
+    hq = HqCtx(job=job, batcher=TaskBatcher(job, max_size=8, workers=4))
+    small = hq.short_function(write_item, args=(tmp_path / "a.txt", "a"), name="a")
+    assert small.resources.resources["cpus"] == 1
+    for i in range(5):
+        large = hq.with_dep(small).short_function(
+            write_item, args=(tmp_path / f"{i}.txt", str(i)), name=f"item-{i}"
+        )
+    assert small.resources.resources["cpus"] == 1
+    assert large.resources.resources["cpus"] == 4
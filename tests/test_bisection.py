@@ -0,0 +1,93 @@
+from pathlib import Path
+
+import pytest
+
+from ligate.awh.ligen.bisection import (
+    BisectionAborted,
+    bisect_failures,
+    bisection_run_limit,
+    concatenate_csvs,
+    read_mol2_records,
+    read_smi_records,
+    run_with_bisection,
+)
+
+
+def test_bisection_isolates_failing_ligands(tmp_path: Path):
+    input = tmp_path / "input.smi"
+    input.write_text("".join(f"C ligand-{i}\n" for i in range(10)))
+    output = tmp_path / "output.csv"
+    rejects = tmp_path / "rejected.smi"
+    runs = []
+
+    def run(input: Path, output: Path):
+        names = [line.split()[1] for line in input.read_text().splitlines()]
+        runs.append(names)
+        if "ligand-3" in names or "ligand-8" in names:
+            raise Exception("LiGen crashed")
+        output.write_text("NAME\n" + "".join(f"{name}\n" for name in names))
+
+    run_with_bisection(run, input, output, read_smi_records, concatenate_csvs, rejects)
+    assert output.read_text().splitlines() == ["NAME"] + [
+        f"ligand-{i}" for i in range(10) if i not in (3, 8)
+    ]
+    assert rejects.read_text() == "C ligand-3\nC ligand-8\n"
+    assert len(runs) < 2 * 10
+
+
+def test_bisection_fails_if_all_ligands_fail(tmp_path: Path):
+    input = tmp_path / "input.smi"
+    input.write_text("C a\nC b\nC c\n")
+
+    def run(input: Path, output: Path):
+        raise Exception("Container not found")
+
+    with pytest.raises(Exception, match="Container not found"):
+        run_with_bisection(
+            run, input, tmp_path / "output.csv", read_smi_records, concatenate_csvs,
+            tmp_path / "rejected.smi",
+        )
+
+
+def test_read_mol2_records(tmp_path: Path):
+    path = tmp_path / "ligands.mol2"
+    path.write_text(
+        "@<TRIPOS>MOLECULE\na\n@<TRIPOS>ATOM\n1 C\n@<TRIPOS>MOLECULE\nb\n@<TRIPOS>ATOM\n1 N\n"
+    )
+    assert read_mol2_records(path) == [
+        b"@<TRIPOS>MOLECULE\na\n@<TRIPOS>ATOM\n1 C\n",
+        b"@<TRIPOS>MOLECULE\nb\n@<TRIPOS>ATOM\n1 N\n",
+    ]
+
+
+def test_bisection_stops_on_systemic_failure(tmp_path: Path):
+    input = tmp_path / "input.smi"
+    input.write_text("".join(f"C ligand-{i}\n" for i in range(64)))
+    runs = []
+
+    def run(input: Path, output: Path):
+        runs.append(input)
+        raise Exception("Out of memory")
+
+    with pytest.raises(Exception, match="Out of memory"):
+        run_with_bisection(
+            run, input, tmp_path / "output.csv", read_smi_records, concatenate_csvs,
+            tmp_path / "rejected.smi",
+        )
+    # The whole shard and the bisection up to its run limit
+    assert len(runs) == 1 + bisection_run_limit(64)
+
+
+def test_bisection_run_limit():
+    records = [f"{i}".encode() for i in range(1024)]
+    runs = []
+
+    def run(part):
+        runs.append(part)
+        # Every even ligand of the first half fails
+        if any(int(record) % 2 == 0 and int(record) < 512 for record in part):
+            raise Exception("LiGen crashed")
+
+    with pytest.raises(BisectionAborted):
+        bisect_failures(records, run, max_runs=bisection_run_limit(len(records)))
+    assert len(runs) == bisection_run_limit(len(records))
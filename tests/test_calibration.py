@@ -0,0 +1,23 @@
+import dataclasses
+import json
+from pathlib import Path
+
+from ligate.awh.ligen.calibration import (
+    candidate_thread_layouts,
+    load_thread_layout,
+    select_thread_layout,
+)
+
+
+def test_select_layout_with_best_throughput(tmp_path: Path):
+    layouts = candidate_thread_layouts(max_cores=4)
+    assert [layout.cores for layout in layouts] == [1, 1, 2, 2, 4, 4]
+
+    probes = []
+    for (index, (layout, throughput)) in enumerate(zip(layouts, [1, 2, 5, 3, 4, 0.5])):
+        path = tmp_path / f"probe-{index}.json"
+        path.write_text(json.dumps(dict(layout=dataclasses.asdict(layout), throughput=throughput)))
+        probes.append(path)
+
+    select_thread_layout(probes, tmp_path / "layout.json")
+    assert load_thread_layout(tmp_path / "layout.json") == layouts[2]
@@ -0,0 +1,177 @@
+import gzip
+import os
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from ligate.awh.ligen import container as container_module
+from ligate.awh.ligen.common import FileMappingMode
+from ligate.awh.ligen.container import LigenContainerContext
+from ligate.awh.ligen.session import REQUEST_OWNER_FILE, LigenSession, has_active_requests
+from ligate.awh.ligen.staging import NodeStagingCache
+from ligate.utils.io import partial_path
+
+
+class LocalContext(LigenContainerContext):
+    """
+    Executes commands directly on the host, the mapped files directory is thus accessible under
+    the same path as inside the container.
+    """
+
+    def __init__(self, directory: Path):
+        super().__init__(Path("container.sif"), directory, files_container_dir=directory / "files")
+
+    def execute(self, command: str, input: Optional[bytes] = None):
+        subprocess.run(["bash", "-c", command], input=input, check=True)
+
+
+class LocalBindContext(LocalContext):
+    """
+    Mounts files "directly", i.e. commands access the target (and partial output) paths.
+    """
+
+    def __init__(self, directory: Path):
+        super().__init__(directory)
+        self.file_mapping = FileMappingMode.Bind
+
+    def bound_container_path(self, path: Path, container_path: Path, input: bool) -> Path:
+        return path if input else partial_path(path)
+
+
+def test_stream_compressed_files(tmp_path: Path):
+    input_path = tmp_path / "input.mol2.gz"
+    with gzip.open(input_path, "wb") as f:
+        f.write(b"ligand\n" * 100000)
+    output_path = tmp_path / "outputs" / "output.csv.gz"
+
+    ctx = LocalContext(tmp_path / "ctx")
+    input = ctx.map_input(input_path)
+    output = ctx.map_output(output_path)
+    assert input.name == "input.mol2"
+    ctx.run(f"wc -l < {input} > {output}")
+
+    assert gzip.decompress(output_path.read_bytes()) == b"100000\n"
+
+
+def test_stream_unused_compressed_input(tmp_path: Path):
+    input_path = tmp_path / "input.mol2.gz"
+    with gzip.open(input_path, "wb") as f:
+        f.write(b"ligand\n" * 100000)
+    output_path = tmp_path / "output.txt"
+
+    ctx = LocalContext(tmp_path / "ctx")
+    ctx.map_input(input_path)
+    output = ctx.map_output(output_path)
+    ctx.run(f"echo done > {output}")
+    assert output_path.read_text() == "done\n"
+
+
+def test_stream_unwritten_compressed_output(tmp_path: Path):
+    output_path = tmp_path / "output.csv.gz"
+    ctx = LocalContext(tmp_path / "ctx")
+    ctx.map_output(output_path)
+    with pytest.raises(Exception, match="was not written"):
+        ctx.run("true")
+    assert not output_path.exists()
+    assert not partial_path(output_path).exists()
+
+
+def test_stream_failed_compressed_output(tmp_path: Path, monkeypatch):
+    output_path = tmp_path / "output.csv.gz"
+    ctx = LocalContext(tmp_path / "ctx")
+    output = ctx.map_output(output_path)
+
+    def copy(input, output, length):
+        # The whole input is read, so that the command does not fail on a closed pipe
+        input.read()
+        output.write(b"partial")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(container_module.shutil, "copyfileobj", copy)
+    with pytest.raises(Exception, match="has failed"):
+        ctx.run(f"echo done > {output} || true")
+    assert not output_path.exists()
+    assert not partial_path(output_path).exists()
+
+
+def test_bound_output(tmp_path: Path):
+    output_path = tmp_path / "output.csv"
+    ctx = LocalBindContext(tmp_path / "ctx")
+    output = ctx.map_output(output_path)
+    ctx.run(f"echo done > {output}")
+    assert output_path.read_text() == "done\n"
+    assert not partial_path(output_path).exists()
+
+
+def test_bound_output_not_written(tmp_path: Path):
+    output_path = tmp_path / "output.csv"
+    ctx = LocalBindContext(tmp_path / "ctx")
+    ctx.map_output(output_path)
+    with pytest.raises(Exception, match="was not written"):
+        ctx.run("true")
+    assert not output_path.exists()
+    assert not partial_path(output_path).exists()
+
+
+def test_failed_command_removes_partial_outputs(tmp_path: Path):
+    output_path = tmp_path / "output.csv"
+    compressed_path = tmp_path / "output.csv.gz"
+    ctx = LocalBindContext(tmp_path / "ctx")
+    output = ctx.map_output(output_path)
+    compressed = ctx.map_output(compressed_path)
+    with pytest.raises(subprocess.CalledProcessError):
+        ctx.run(f"echo partial > {output}; echo partial > {compressed}; false")
+    for path in (output_path, compressed_path):
+        assert not path.exists()
+        assert not partial_path(path).exists()
+
+
+def test_stage_shared_inputs(tmp_path: Path):
+    protein = tmp_path / "protein.pdb"
+    protein.write_text("ATOM")
+    staging = NodeStagingCache(tmp_path / "staging")
+
+    staged = staging.stage(protein)
+    assert staged.name == "protein.pdb"
+    assert staged.read_text() == "ATOM"
+    assert staging.stage(protein) == staged
+    assert (staging.stats.hits, staging.stats.misses) == (1, 1)
+
+    # Modified files are staged again
+    protein.write_text("ATOM ATOM")
+    assert staging.stage(protein).read_text() == "ATOM ATOM"
+    assert staging.stats.misses == 2
+
+
+def test_map_shared_input_uses_staged_copy(tmp_path: Path):
+    protein = tmp_path / "protein.pdb"
+    protein.write_text("ATOM")
+    output_path = tmp_path / "output.txt"
+
+    ctx = LocalContext(tmp_path / "ctx")
+    ctx.staging = NodeStagingCache(tmp_path / "staging")
+    input = ctx.map_shared_input(protein)
+    output = ctx.map_output(output_path)
+    ctx.run(f"cat {input} > {output}")
+
+    assert output_path.read_text() == "ATOM"
+    assert ctx.staging.stats.misses == 1
+
+
+def test_session_ignores_requests_of_dead_tasks(tmp_path: Path):
+    session = LigenSession(
+        name="ligen", directory=tmp_path, container=Path("container.sif"), apptainer_bin="apptainer"
+    )
+    process = subprocess.Popen(["true"])
+    process.wait()
+    for (name, pid) in (("dead", process.pid), ("alive", os.getpid())):
+        request_dir = session.requests_dir / name
+        request_dir.mkdir(parents=True)
+        (request_dir / REQUEST_OWNER_FILE).write_text(str(pid))
+
+    assert has_active_requests(session)
+    assert [path.name for path in session.requests_dir.iterdir()] == ["alive"]
+    (session.requests_dir / "alive" / REQUEST_OWNER_FILE).write_text(str(process.pid))
+    assert not has_active_requests(session)
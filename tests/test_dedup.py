@@ -0,0 +1,41 @@
+from pathlib import Path
+
+from ligate.awh.ligen.dedup import (
+    AliasPropagationConfig,
+    DeduplicationConfig,
+    LigandAliases,
+    deduplicate_smi_file,
+    propagate_alias_scores,
+)
+
+
+def test_deduplicate_keeps_first_occurrence(tmp_path: Path):
+    input_smi = tmp_path / "ligands.smi"
+    input_smi.write_text("CCO a\nCCN b\n\nCCO c\nCCC d\nCCN e\nCCO a\n")
+    config = DeduplicationConfig(
+        input_smi=input_smi,
+        output_smi=tmp_path / "unique.smi",
+        output_aliases=tmp_path / "aliases.sqlite",
+        partitions=3,
+    )
+    stats = deduplicate_smi_file(config)
+    assert (stats.unique, stats.duplicates) == (3, 3)
+    assert config.output_smi.read_text() == "CCO a\nCCN b\nCCC d\n"
+    with LigandAliases.open(config.output_aliases) as aliases:
+        assert aliases.aliases_of(["a", "b", "d"]) == {"a": ["c"], "b": ["e"]}
+
+
+def test_propagate_alias_scores(tmp_path: Path):
+    aliases_path = tmp_path / "aliases.sqlite"
+    with LigandAliases.create(aliases_path) as aliases:
+        aliases.add([("c", "a"), ("x", "a")])
+    scores = tmp_path / "scores.csv"
+    scores.write_text("NAME,D22_SCORE\na,1\nb,2\n")
+
+    config = AliasPropagationConfig(
+        scores_csv=scores, aliases=aliases_path, output_csv=tmp_path / "out.csv", batch_size=1
+    )
+    propagate_alias_scores(config)
+    lines = config.output_csv.read_text().splitlines()
+    assert lines[0] == "NAME,D22_SCORE"
+    assert sorted(lines[1:]) == ["a,1", "b,2", "c,1", "x,1"]
@@ -0,0 +1,15 @@
+from pathlib import Path
+
+from ligate.awh.ligen.docking import merge_docked_poses
+
+
+def test_merge_docked_poses(tmp_path: Path):
+    inputs = []
+    for (index, content) in enumerate(["@<TRIPOS>MOLECULE\nA_0_1.5\n", "", "@<TRIPOS>MOLECULE\nB"]):
+        path = tmp_path / f"docked-{index}.mol2"
+        path.write_text(content)
+        inputs.append(path)
+
+    output = tmp_path / "docked.mol2"
+    merge_docked_poses(inputs, output)
+    assert output.read_text() == "@<TRIPOS>MOLECULE\nA_0_1.5\n@<TRIPOS>MOLECULE\nB\n"
@@ -0,0 +1,120 @@
+from pathlib import Path
+from typing import List
+
+from hyperqueue import Job
+from hyperqueue.task.task import Task
+
+from ligate.awh.pipeline.common import construct_edge_set_from_dir
+from ligate.awh.pipeline.ledger import IncrementalStages, StageLedger, sync_input_items
+
+
+def append_to_pose(directory: Path, text: str):
+    with open(directory / "system.gro", "a") as f:
+        f.write(text)
+
+
+def mark_poses(directories: List[Path]):
+    for directory in directories:
+        (directory / "marked.txt").write_text("marked")
+
+
+def finalize_pose(directory: Path):
+    (directory / "final.txt").write_text((directory / "system.gro").read_text())
+
+
+def build_workflow(input_dir: Path, workdir: Path, text: str = "+") -> Job:
+    ledger = StageLedger(workdir / "ledger")
+    items = sync_input_items(
+        ledger, input_dir, workdir / "cadd", construct_edge_set_from_dir(input_dir)
+    )
+    job = Job()
+    stages = IncrementalStages(ledger, job, items)
+
+    def submit_append(state) -> List[Task]:
+        return [
+            job.function(
+                append_to_pose, args=(state.directory, text), deps=state.deps, name="append"
+            )
+        ]
+
+    stages.submit_per_item("append", text, submit_append)
+    stages.submit_shared(
+        "mark",
+        None,
+        lambda deps: job.function(
+            mark_poses, args=([state.directory for state in items],), deps=deps, name="mark"
+        ),
+    )
+    stages.submit_per_item(
+        "finalize",
+        None,
+        lambda state: [
+            job.function(finalize_pose, args=(state.directory,), deps=state.deps, name="finalize")
+        ],
+    )
+    stages.finish()
+    return job
+
+
+def run_job(job: Job) -> List[str]:
+    # Tasks are submitted after their dependencies, so they can be executed in order
+    for task in job.tasks:
+        task.fn(*task.args)
+    return [
+        task.name for task in job.tasks if not task.name.startswith(("record-", "restore-"))
+    ]
+
+
+def create_input(input_dir: Path, poses: List[str]):
+    for pose in poses:
+        directory = input_dir / pose
+        directory.mkdir(parents=True)
+        (directory / "system.gro").write_text(pose)
+
+
+def test_unchanged_items_are_skipped(tmp_path: Path):
+    input_dir = tmp_path / "input"
+    create_input(input_dir, ["edge_a/pose_0", "edge_b/pose_0"])
+    workdir = tmp_path / "workdir"
+
+    assert run_job(build_workflow(input_dir, workdir)) == [
+        "append", "append", "mark", "finalize", "finalize"
+    ]
+    assert (workdir / "cadd" / "edge_a" / "pose_0" / "system.gro").read_text() == "edge_a/pose_0+"
+    assert run_job(build_workflow(input_dir, workdir)) == []
+
+
+def test_changed_item_is_resubmitted(tmp_path: Path):
+    input_dir = tmp_path / "input"
+    create_input(input_dir, ["edge_a/pose_0", "edge_b/pose_0"])
+    workdir = tmp_path / "workdir"
+    run_job(build_workflow(input_dir, workdir))
+
+    (input_dir / "edge_a" / "pose_0" / "system.gro").write_text("changed")
+    # Only the changed pose is processed again, the shared stage processes all poses, but the
+    # unchanged pose keeps its outputs, so its following stages are skipped
+    assert run_job(build_workflow(input_dir, workdir)) == ["append", "mark", "finalize"]
+
+    cadd = workdir / "cadd"
+    assert (cadd / "edge_a" / "pose_0" / "system.gro").read_text() == "changed+"
+    assert (cadd / "edge_a" / "pose_0" / "final.txt").read_text() == "changed+"
+    # The unchanged pose was restored to its state after the last stage
+    assert (cadd / "edge_b" / "pose_0" / "system.gro").read_text() == "edge_b/pose_0+"
+    assert (cadd / "edge_b" / "pose_0" / "marked.txt").is_file()
+    assert (cadd / "edge_b" / "pose_0" / "final.txt").read_text() == "edge_b/pose_0+"
+    assert run_job(build_workflow(input_dir, workdir)) == []
+
+
+def test_interrupted_build_is_restored(tmp_path: Path):
+    input_dir = tmp_path / "input"
+    create_input(input_dir, ["edge_a/pose_0"])
+    workdir = tmp_path / "workdir"
+    run_job(build_workflow(input_dir, workdir))
+
+    # The job is built (which restores the pose to its input state), but it is never executed
+    build_workflow(input_dir, workdir, text="-")
+    assert run_job(build_workflow(input_dir, workdir)) == []
+    pose_dir = workdir / "cadd" / "edge_a" / "pose_0"
+    assert (pose_dir / "system.gro").read_text() == "edge_a/pose_0+"
+    assert (pose_dir / "marked.txt").is_file()
+    assert (pose_dir / "final.txt").read_text() == "edge_a/pose_0+"
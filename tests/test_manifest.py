@@ -0,0 +1,103 @@
+import json
+from pathlib import Path
+
+from hyperqueue import Job
+
+from ligate.awh.ligen.common import LigenTaskContext
+from ligate.awh.ligen.manifest import create_shard_completion
+from ligate.awh.pipeline.virtual_screening import (
+    VirtualScreeningPipelineConfig,
+    hq_submit_ligen_virtual_screening_workflow,
+)
+
+
+def test_shard_completion_is_stale_after_input_change(tmp_path: Path):
+    input = tmp_path / "shard.smi"
+    input.write_text("CCO\n")
+    output = tmp_path / "scores.csv"
+    output.write_text("NAME,D22_SCORE\n")
+
+    completion = create_shard_completion(
+        "shard", [input], [output], tmp_path / "shard.done", fingerprint="a"
+    )
+    assert not completion.is_complete()
+    completion.mark()
+    assert completion.is_complete()
+
+    assert not create_shard_completion(
+        "shard", [input], [output], completion.marker, fingerprint="b"
+    ).is_complete()
+    input.write_text("CCN\n")
+    assert not create_shard_completion(
+        "shard", [input], [output], completion.marker, fingerprint="a"
+    ).is_complete()
+
+
+def test_resume_skips_completed_shards(tmp_path: Path):
+    input_smi = tmp_path / "ligands.smi"
+    input_smi.write_text("CCO a\nCCN b\nCCC c\n")
+    (tmp_path / "protein.pdb").write_text("protein")
+    (tmp_path / "probe.mol2").write_text("probe")
+    ctx = LigenTaskContext(workdir=tmp_path, container_path=Path("ligen.sif"))
+    config = VirtualScreeningPipelineConfig(
+        input_smi=input_smi,
+        input_probe_mol2=tmp_path / "probe.mol2",
+        input_protein=tmp_path / "protein.pdb",
+        max_molecules_per_smi=1,
+        cost_model=None,
+        resume=True,
+    )
+    workdir = tmp_path / "vscreening"
+
+    def submit() -> Job:
+        job = Job()
+        hq_submit_ligen_virtual_screening_workflow(ctx, workdir, config, job, deps=[])
+        return job
+
+    full_job = submit()
+    manifest = json.loads((workdir / "manifest.json").read_text())
+    assert len(manifest) == 3
+    assert not any(shard["completed"] for shard in manifest)
+
+    # Simulate a completed shard
+    shard = manifest[0]
+    Path(shard["outputs"][0]).write_text("NAME,D22_SCORE\na,1\n")
+    Path(shard["marker"]).write_text(shard["input_hash"])
+
+    resumed_job = submit()
+    manifest = json.loads((workdir / "manifest.json").read_text())
+    assert [shard["completed"] for shard in manifest] == [True, False, False]
+    # Expansion and screening of the completed shard are not submitted again
+    assert len(resumed_job.tasks) == len(full_job.tasks) - 2
+
+
+def test_resume_deletes_stale_shard_outputs(tmp_path: Path):
+    input_smi = tmp_path / "ligands.smi"
+    input_smi.write_text("CCO a\nCCN b\n")
+    (tmp_path / "protein.pdb").write_text("protein")
+    (tmp_path / "probe.mol2").write_text("probe")
+    ctx = LigenTaskContext(workdir=tmp_path, container_path=Path("ligen.sif"))
+    config = VirtualScreeningPipelineConfig(
+        input_smi=input_smi,
+        input_probe_mol2=tmp_path / "probe.mol2",
+        input_protein=tmp_path / "protein.pdb",
+        max_molecules_per_smi=1,
+        cost_model=None,
+        resume=True,
+    )
+    workdir = tmp_path / "vscreening"
+    hq_submit_ligen_virtual_screening_workflow(ctx, workdir, config, Job(), deps=[])
+    manifest = json.loads((workdir / "manifest.json").read_text())
+
+    # Outputs of a previous run with a different protein
+    for shard in manifest:
+        Path(shard["outputs"][0]).write_text("NAME,D22_SCORE\na,1\n")
+        Path(shard["marker"]).write_text(shard["input_hash"])
+    (tmp_path / "protein.pdb").write_text("other protein")
+
+    hq_submit_ligen_virtual_screening_workflow(ctx, workdir, config, Job(), deps=[])
+    manifest = json.loads((workdir / "manifest.json").read_text())
+    assert not any(shard["completed"] for shard in manifest)
+    for shard in manifest:
+        assert not Path(shard["outputs"][0]).exists()
+        assert not Path(shard["marker"]).exists()
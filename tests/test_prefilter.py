@@ -0,0 +1,25 @@
+from pathlib import Path
+
+from ligate.awh.ligen.prefilter import LigandFilterRules, PrefilterConfig, prefilter_smi_file
+
+
+def test_prefilter_keeps_valid_ligands(tmp_path: Path):
+    input_smi = tmp_path / "ligands.smi"
+    input_smi.write_text(
+        "CCO ethanol\nnot-a-smiles invalid\nCC(=O)Cl acyl\n\nCCCCCCCCCCCCCCCC chain\nc1ccccc1\n"
+    )
+    config = PrefilterConfig(
+        input_smi=input_smi,
+        output_smi=tmp_path / "filtered.smi",
+        rejected_csv=tmp_path / "rejected.csv",
+        rules=LigandFilterRules(exclude_reactive_groups=True),
+        batch_size=2,
+        processes=2,
+    )
+    stats = prefilter_smi_file(config)
+    assert (stats.kept, stats.rejected) == (2, 3)
+    assert config.output_smi.read_text() == "CCO ethanol\nc1ccccc1\n"
+
+    rejected = config.rejected_csv.read_text().splitlines()
+    assert [line.split(",")[0] for line in rejected] == ["NAME", "invalid", "acyl", "chain"]
+    assert "rotatable bonds" in rejected[-1]
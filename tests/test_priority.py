@@ -0,0 +1,47 @@
+from hyperqueue import Job
+
+from ligate.awh.pipeline.priority import (
+    TaskDurationModel, TaskTrace, assign_critical_path_priorities, read_task_traces,
+    trace_task_durations,
+)
+
+
+def minimize(value: int) -> int:
+    return value
+
+
+def equilibrate(value: int) -> int:
+    return value
+
+
+def test_critical_path_starts_first():
+    job = Job()
+    short = job.function(minimize, args=(1,), name="minimize-ligand")
+    long = job.function(minimize, args=(2,), name="minimize-complex")
+    job.function(equilibrate, args=(1,), deps=[short], name="equilibrate-ligand")
+    job.function(equilibrate, args=(2,), deps=[long], name="equilibrate-complex")
+
+    model = TaskDurationModel(
+        [
+            TaskTrace(name="minimize-ligand", kind="minimize", duration=10),
+            TaskTrace(name="minimize-complex", kind="minimize", duration=100),
+            TaskTrace(name="equilibrate-complex", kind="equilibrate", duration=1000),
+        ],
+        defaults={"equilibrate": 50},
+    )
+    remaining = assign_critical_path_priorities(job, model)
+    # The ligand equilibration was not traced, so the mean of the traced equilibrations is used
+    assert [remaining[task.task_id] for task in job.tasks] == [1010, 1100, 1000, 1000]
+    assert long.priority > short.priority
+
+
+def test_traced_durations(tmp_path):
+    job = Job()
+    task = job.function(minimize, args=(1,), name="minimize-edge/pose")
+    trace_task_durations(job, tmp_path)
+    assert task.fn(*task.args) == 1
+
+    (trace,) = read_task_traces(tmp_path)
+    assert trace.name == "minimize-edge/pose"
+    assert trace.kind == "minimize"
+    assert TaskDurationModel.from_traces(tmp_path).duration(task) == trace.duration
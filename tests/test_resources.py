@@ -0,0 +1,32 @@
+import shutil
+
+from ligate.awh.common import Complex, Ligand
+from ligate.awh.pipeline.resources import (
+    CoreScalingModel, item_cores, read_gro_atom_count, system_atom_count,
+)
+from tests.conftest import get_test_data
+
+POSE_DIR = get_test_data("awh/1/create-hybrid-ligands/input/lig_35_L/pose_1")
+
+
+def test_ligand_leg_gets_fewer_cores(tmp_path):
+    shutil.copyfile(POSE_DIR / "full.gro", tmp_path / "full.gro")
+    shutil.copyfile(POSE_DIR / "ligand.gro", tmp_path / "merged.gro")
+    scaling = CoreScalingModel(atoms_per_core=5000)
+
+    complex = Complex(tmp_path)
+    ligand = Ligand(tmp_path)
+    # The estimate includes the water of the solvation box
+    assert system_atom_count(complex) > read_gro_atom_count(POSE_DIR / "full.gro")
+    assert system_atom_count(ligand) < system_atom_count(complex)
+
+    assert item_cores(complex, 8, scaling) == 8
+    assert item_cores(ligand, 8, scaling) < 8
+    assert item_cores(ligand, 8, None) == 8
+
+
+def test_solvated_system_is_counted_exactly(tmp_path):
+    shutil.copyfile(POSE_DIR / "full.gro", tmp_path / "solvated_complex.gro")
+    complex = Complex(tmp_path)
+    assert system_atom_count(complex) == read_gro_atom_count(POSE_DIR / "full.gro")
+    assert item_cores(complex, 4, CoreScalingModel(atoms_per_core=1000, max_cores=6)) == 6
@@ -0,0 +1,123 @@
+import gzip
+from pathlib import Path
+
+import pytest
+from hyperqueue import Job
+
+from ligate.awh.ligen.scores import ScoreReductionConfig, read_top_rows, reduce_scores
+from ligate.awh.pipeline.scores import SubmittedScores, hq_submit_score_reduction
+from tests.conftest import get_test_data
+from tests.utils.io import check_files_are_equal
+
+
+def test_reduce_scores(tmp_path: Path):
+    data = get_test_data("awh/1/01-vscreening-output")
+    config = ScoreReductionConfig(
+        input_csvs=[data / "screening-ligands-0.csv", data / "screening-ligands-1.csv"],
+        top_csvs={"D22_SCORE": tmp_path / "top.csv"},
+        n=10,
+        merged_csv=tmp_path / "scores.csv",
+    )
+    reduce_scores(config)
+    check_files_are_equal(data / "scores.csv", tmp_path / "scores.csv", bless=False)
+    check_files_are_equal(data / "top-D22_SCORE.csv", tmp_path / "top.csv", bless=False)
+
+
+def test_reduce_scores_bounded_top(tmp_path: Path):
+    inputs = []
+    for shard in range(3):
+        path = tmp_path / f"shard-{shard}.csv"
+        with open(path, "w") as f:
+            print("NAME,D22_SCORE", file=f)
+            for index in range(5):
+                print(f"lig-{shard}-{index},{shard * 5 + index}", file=f)
+        inputs.append(path)
+
+    top = tmp_path / "top.csv"
+    reduce_scores(ScoreReductionConfig(input_csvs=inputs, top_csvs={"D22_SCORE": top}, n=3))
+    with open(top) as f:
+        assert f.read().splitlines() == [
+            "NAME,D22_SCORE",
+            "lig-2-4,14",
+            "lig-2-3,13",
+            "lig-2-2,12",
+        ]
+
+
+def test_read_top_rows_keeps_first_on_ties(tmp_path: Path):
+    path = tmp_path / "scores.csv"
+    with open(path, "w") as f:
+        print("NAME,SCORE", file=f)
+        for name in ("a", "b", "c"):
+            print(f"{name},1.0", file=f)
+    header, rows = read_top_rows(path, "SCORE", 2)
+    assert header == ["NAME", "SCORE"]
+    assert [row[0] for row in rows] == ["a", "b"]
+
+
+def test_reduce_partial_top_rows(tmp_path: Path):
+    path = tmp_path / "scores.csv"
+    with open(path, "w") as f:
+        print("NAME,A,B", file=f)
+        for (name, a, b) in (("x", 3, 0), ("y", 0, 3), ("z", 1, 1), ("w", 2, 2)):
+            print(f"{name},{a},{b}", file=f)
+
+    partial = tmp_path / "partial.csv"
+    reduce_scores(
+        ScoreReductionConfig(
+            input_csvs=[path], top_csvs={}, n=1, partial_csv=partial, partial_columns=("A", "B")
+        )
+    )
+    top = tmp_path / "top.csv"
+    reduce_scores(ScoreReductionConfig(input_csvs=[partial], top_csvs={"B": top}, n=2))
+    assert partial.read_text().splitlines() == ["NAME,A,B", "x,3,0", "y,0,3"]
+    assert top.read_text().splitlines() == ["NAME,A,B", "y,0,3", "x,3,0"]
+
+
+def test_reduce_compressed_scores(tmp_path: Path):
+    compressed = tmp_path / "shard-0.csv.gz"
+    with gzip.open(compressed, "wt") as f:
+        f.write("NAME,D22_SCORE\na,1\nb,3\n")
+    # Empty shard without any ligands
+    empty = tmp_path / "shard-1.csv.gz"
+    empty.touch()
+
+    top = tmp_path / "top.csv"
+    reduce_scores(
+        ScoreReductionConfig(input_csvs=[compressed, empty], top_csvs={"D22_SCORE": top}, n=1)
+    )
+    assert top.read_text().splitlines() == ["NAME,D22_SCORE", "b,3"]
+
+
+def test_reduce_scores_missing_input_timeout(tmp_path: Path):
+    config = ScoreReductionConfig(
+        input_csvs=[tmp_path / "missing.csv"],
+        top_csvs={"D22_SCORE": tmp_path / "top.csv"},
+        n=10,
+        wait_for_inputs=True,
+        poll_interval=0.01,
+        timeout=0.05,
+    )
+    with pytest.raises(Exception, match="missing.csv"):
+        reduce_scores(config)
+
+
+def test_streamed_reduction_tree_limits_waiting_tasks(tmp_path: Path):
+    job = Job()
+    inputs = [
+        SubmittedScores(
+            csv=tmp_path / f"shard-{index}.csv",
+            task=job.function(print, name=f"screening-{index}"),
+        )
+        for index in range(8)
+    ]
+    final = hq_submit_score_reduction(
+        inputs, top_csvs={}, n=10, merged_csv=None, workdir=tmp_path, job=job, deps=[], arity=2,
+        stream=True, max_streaming=2,
+    )
+    reductions = [task for task in job.tasks if task.name.startswith("reduce-scores")]
+    streaming = [task for task in reductions if task.args[0].wait_for_inputs]
+    assert [task.name for task in streaming] == ["reduce-scores-0-0", "reduce-scores-0-1"]
+    assert all(not task.dependencies for task in streaming)
+    # Tasks of higher levels depend on the reductions of the previous level
+    assert [dep.name for dep in final.dependencies] == ["reduce-scores-1-0", "reduce-scores-1-1"]
@@ -0,0 +1,105 @@
+import csv
+import dataclasses
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from ligate.awh.ligen import cache as cache_module
+from ligate.awh.ligen.cache import (
+    ScreeningCache,
+    ScreeningCacheConfig,
+    ScreeningCacheLookup,
+    ScreeningCacheStoreConfig,
+    screening_context_key,
+    store_screening_scores,
+)
+from ligate.awh.ligen.smi import shard_smi_file
+from ligate.awh.ligen.virtual_screening import ScreeningConfig, ScreeningTarget
+
+
+def test_cache_skips_screened_ligands(tmp_path: Path):
+    cache_config = ScreeningCacheConfig(path=tmp_path / "cache.sqlite")
+
+    # First campaign screens all ligands and stores their scores
+    first = write_file(tmp_path / "first.smi", "CCO\nCCN\n")
+    scores = write_file(
+        tmp_path / "scores.csv", "NAME,SCORE_PROTEIN_NAME,D22_SCORE\nCCO,p,1.5\nCCN,p,2.5\n"
+    )
+    store_screening_scores(
+        ScreeningCacheStoreConfig(cache=cache_config, context="ctx", inputs=[(first, scores)])
+    )
+
+    # Second campaign only has to screen the new ligand
+    second = write_file(tmp_path / "second.smi", "CCO ethanol\nCCC\n")
+    shards_dir = tmp_path / "shards"
+    shards_dir.mkdir()
+    with ScreeningCache.open(cache_config.path) as cache:
+        with open(tmp_path / "cached.csv", "w", newline="") as f:
+            lookup = ScreeningCacheLookup(cache, "ctx", csv.writer(f, lineterminator="\n"))
+            shards = shard_smi_file(second, shards_dir, max_molecules=10, filter=lookup)
+        assert (lookup.stats.hits, lookup.stats.misses) == (1, 1)
+        assert cache.stats().stored == 2
+
+    assert [path.read_text() for path in shards] == ["CCC\n"]
+    assert (tmp_path / "cached.csv").read_text() == (
+        "NAME,SCORE_PROTEIN_NAME,D22_SCORE\nethanol,p,1.5\n"
+    )
+
+
+def test_cache_evicts_least_recently_used(tmp_path: Path):
+    with ScreeningCache.open(tmp_path / "cache.sqlite") as cache:
+        cache.store("ctx", ["NAME"], [("a", ["a"])])
+        cache.store("ctx", ["NAME"], [("b", ["b"])])
+        cache.lookup("ctx", ["a"])
+        assert cache.evict(max_size=len('["a"]')) == 1
+        assert cache.lookup("ctx", ["a", "b"]) == {"a": ["a"]}
+
+
+def write_file(path: Path, content: str) -> Path:
+    path.write_text(content)
+    return path
+
+
+def test_context_key_distinguishes_prepared_pocket(tmp_path: Path):
+    target = ScreeningTarget(
+        name="p",
+        protein_pdb=write_file(tmp_path / "protein.pdb", "ATOM\n"),
+        probe_mol2=write_file(tmp_path / "probe.mol2", "@<TRIPOS>ATOM\n"),
+    )
+    config = ScreeningConfig(
+        targets=(target,),
+        input_expanded_mol2=tmp_path / "ligands.mol2",
+        output_scores_csv=tmp_path / "scores.csv",
+        cores=1,
+    )
+
+    def with_pocket(pocket_pdb: Path, radius: Optional[float] = 10.0) -> ScreeningConfig:
+        return dataclasses.replace(
+            config,
+            targets=(dataclasses.replace(target, pocket_pdb=pocket_pdb, pocket_radius=radius),),
+        )
+
+    prepared = with_pocket(tmp_path / "not-prepared-yet.pdb")
+    assert screening_context_key(config) != screening_context_key(prepared)
+    # The key does not depend on the location of the pocket
+    assert screening_context_key(prepared) == screening_context_key(
+        with_pocket(tmp_path / "pocket.pdb")
+    )
+    # ... but it depends on the radius with which the pocket was trimmed
+    assert screening_context_key(prepared) != screening_context_key(
+        with_pocket(tmp_path / "pocket.pdb", radius=12.0)
+    )
+    # The content of a pocket provided as an input is hashed
+    provided = with_pocket(write_file(tmp_path / "input-pocket.pdb", "ATOM\n"), radius=None)
+    key = screening_context_key(provided)
+    write_file(tmp_path / "input-pocket.pdb", "HETATM\n")
+    assert screening_context_key(provided) != key
+
+
+def test_cache_rejects_different_key_scheme(tmp_path: Path, monkeypatch):
+    path = tmp_path / "cache.sqlite"
+    ScreeningCache.open(path).close()
+    monkeypatch.setattr(cache_module, "ligand_key_scheme", lambda: "other")
+    with pytest.raises(Exception, match="scheme"):
+        ScreeningCache.open(path)
@@ -0,0 +1,88 @@
+from pathlib import Path
+
+from ligate.awh.ligen.smi import (
+    LigandCostModel,
+    SmiIndex,
+    estimate_ligand_costs,
+    parse_smi_line,
+    shard_smi_file,
+    split_smi_file,
+)
+from tests.conftest import get_test_data
+
+
+def test_estimate_cost_grows_with_size():
+    costs = estimate_ligand_costs(
+        [b"CC\n", b"CCCCCCCCCC\n", b"c1ccccc1\n", b"[NH4+]\n"], LigandCostModel()
+    )
+    assert costs[0] < costs[1]
+    # Aromatic ring atoms are not rotatable
+    assert costs[2] < costs[1]
+    assert costs[3] < costs[0]
+
+
+def test_shard_unbalanced_by_line_count(tmp_path: Path):
+    input = write_smi(tmp_path / "input.smi", [f"C{'C' * i}" for i in range(25)])
+    shards = shard_smi_file(input, tmp_path, max_molecules=10)
+    assert [p.name for p in shards] == ["input-0.smi", "input-1.smi", "input-2.smi"]
+    assert [len(read_lines(p)) for p in shards] == [10, 10, 5]
+
+
+def test_shard_balanced_by_cost(tmp_path: Path):
+    small = ["C"] * 30
+    large = ["CCCCCCCCCCCCCCCCCCCCCCCCCCCCCC"] * 10
+    input = write_smi(tmp_path / "input.smi", small + large)
+    model = LigandCostModel()
+    shards = shard_smi_file(input, tmp_path, max_molecules=10, cost_model=model)
+    assert len(shards) == 4
+
+    costs = [sum(estimate_ligand_costs(read_lines(p), model)) for p in shards]
+    assert max(costs) / min(costs) < 2
+    # Shards with small ligands contain more lines
+    assert len(read_lines(shards[0])) > len(read_lines(shards[-1]))
+
+
+def test_shard_preserves_ligands(tmp_path: Path):
+    input = get_test_data("ligen/smi/c/input.smi")
+    shards = shard_smi_file(input, tmp_path, max_molecules=3, cost_model=LigandCostModel())
+    assert len(shards) == 4
+    lines = [line for shard in shards for line in read_lines(shard)]
+    assert lines == read_lines(input)
+
+
+def test_split_into_fixed_shard_count(tmp_path: Path):
+    input = write_smi(tmp_path / "input.smi", ["C", "CC", "CCC"])
+    outputs = [tmp_path / f"shard-{index}.smi" for index in range(4)]
+    split_smi_file(input, outputs)
+    assert [len(read_lines(p)) for p in outputs] == [1, 1, 1, 0]
+
+
+def test_index_reads_selected_ligands(tmp_path: Path):
+    input = tmp_path / "input.smi"
+    with open(input, "wb") as f:
+        f.write(b"CCO ethanol\r\n\nc1ccccc1\nCC(=O)O acid\nCCN")
+
+    with SmiIndex.create(tmp_path / "index") as index:
+        shard_smi_file(input, tmp_path, max_molecules=2, index=index)
+
+    with SmiIndex.open(tmp_path / "index") as index:
+        assert index.locate(["missing"]) == {}
+        lines = list(index.read_lines(["CCN", "acid", "ethanol", "missing"]))
+    assert lines == [("ethanol", b"CCO ethanol"), ("acid", b"CC(=O)O acid"), ("CCN", b"CCN")]
+
+
+def test_parse_smi_line():
+    assert parse_smi_line(b"c1ccccc1\n") == "c1ccccc1"
+    assert parse_smi_line(b"CCO ethanol extra\n") == "ethanol"
+
+
+def write_smi(path: Path, lines) -> Path:
+    with open(path, "w") as f:
+        for line in lines:
+            print(line, file=f)
+    return path
+
+
+def read_lines(path: Path):
+    with open(path, "rb") as f:
+        return f.readlines()
@@ -0,0 +1,54 @@
+import os
+from pathlib import Path
+
+from ligate.utils.snapshot import ContentStore, snapshot_directory
+
+
+def create_tree(directory: Path):
+    (directory / "pose").mkdir(parents=True)
+    (directory / "topol.top").write_text("topology")
+    (directory / "pose" / "system.gro").write_text("coordinates")
+
+
+def test_snapshot_shares_objects(tmp_path):
+    source = tmp_path / "source"
+    create_tree(source)
+    store = ContentStore(tmp_path / "objects")
+
+    stats = snapshot_directory(source, tmp_path / "a", store)
+    assert stats.files == 2
+    assert (tmp_path / "a" / "pose" / "system.gro").read_text() == "coordinates"
+
+    (source / "pose" / "system.gro").write_text("minimized")
+    stats = snapshot_directory(source, tmp_path / "b", store, previous=tmp_path / "a")
+    # Only the changed file is read and stored
+    assert stats.hashed_bytes == len("minimized")
+    assert stats.stored_bytes == len("minimized")
+
+    # The earlier snapshot is not affected by the change of the source
+    assert (tmp_path / "a" / "pose" / "system.gro").read_text() == "coordinates"
+    assert (tmp_path / "b" / "pose" / "system.gro").read_text() == "minimized"
+    assert os.path.samefile(tmp_path / "a" / "topol.top", tmp_path / "b" / "topol.top")
+
+
+def test_materialized_file_is_writable(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_text("content")
+    store = ContentStore(tmp_path / "objects")
+    file_hash = store.add(path)
+
+    target = tmp_path / "restored.txt"
+    store.materialize(file_hash, target)
+    target.write_text("modified")
+    assert store.object_path(file_hash).read_text() == "content"
+
+
+def test_add_existing_object(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_text("content")
+    store = ContentStore(tmp_path / "objects")
+    file_hash = store.add(path)
+    # Another writer has published the object in the meantime
+    assert store.add(path, file_hash) == file_hash
+    assert store.add(path) == file_hash
+    assert os.listdir(store.object_path(file_hash).parent) == [file_hash]
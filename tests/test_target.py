@@ -0,0 +1,56 @@
+from pathlib import Path
+
+from ligate.awh.ligen.target import (
+    TargetPreparationConfig,
+    pdb_residue_key,
+    prepare_target,
+    read_mol2_coordinates,
+)
+from tests.conftest import get_test_data
+
+
+def test_prepare_target_keeps_residues_around_probe(tmp_path: Path):
+    protein = get_test_data("ligen/p38/protein_amber/protein.pdb")
+    probe = get_test_data("ligen/p38/ligands_gaff2/lig_p38a_2aa/poses/1/ligand.mol2")
+    config = TargetPreparationConfig(
+        input_protein_pdb=protein, input_probe_mol2=probe, output_pocket_pdb=tmp_path / "pocket.pdb"
+    )
+    prepare_target(config)
+
+    def residues(path: Path):
+        return {
+            pdb_residue_key(line)
+            for line in path.read_text().splitlines()
+            if line.startswith(("ATOM  ", "HETATM"))
+        }
+
+    pocket = residues(config.output_pocket_pdb)
+    assert 0 < len(pocket) < len(residues(protein))
+    assert pocket <= residues(protein)
+    assert len(read_mol2_coordinates(probe)) > 0
+
+
+def test_prepare_target_keeps_whole_residues(tmp_path: Path):
+    probe = tmp_path / "probe.mol2"
+    probe.write_text(
+        "@<TRIPOS>MOLECULE\nprobe\n@<TRIPOS>ATOM\n"
+        "      1 C1          0.0000    0.0000    0.0000 c3  1 LIG 0.0\n"
+        "@<TRIPOS>BOND\n"
+    )
+    protein = tmp_path / "protein.pdb"
+    protein.write_text(
+        "ATOM      1  N   ALA A   1       5.000   0.000   0.000  1.00  0.00           N\n"
+        "ATOM      2  CA  ALA A   1      50.000   0.000   0.000  1.00  0.00           C\n"
+        "ATOM      3  N   GLY A   2      30.000   0.000   0.000  1.00  0.00           N\n"
+        "TER\n"
+        "CONECT    1    2\n"
+        "END\n"
+    )
+    output = tmp_path / "pocket.pdb"
+    prepare_target(
+        TargetPreparationConfig(
+            input_protein_pdb=protein, input_probe_mol2=probe, output_pocket_pdb=output
+        )
+    )
+    lines = output.read_text().splitlines()
+    assert [line[:6] for line in lines] == ["ATOM  ", "ATOM  ", "TER", "END"]
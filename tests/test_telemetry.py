@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pytest
+
+from ligate.awh.ligen.common import LigenTaskContext
+from ligate.awh.ligen.telemetry import (
+    aggregate_telemetry,
+    read_telemetry_records,
+    shard_telemetry,
+)
+from tests.test_container import LocalContext
+
+
+def test_container_timings(tmp_path: Path):
+    input_path = tmp_path / "input.smi"
+    input_path.write_text("C a\n")
+    ctx = LocalContext(tmp_path / "ctx")
+    input = ctx.map_input(input_path)
+    output = ctx.map_output(tmp_path / "output.txt")
+    ctx.run(f"sleep 0.2; cp {input} {output}")
+
+    assert ctx.timings.commands == 1
+    assert ctx.timings.compute >= 0.2
+    assert ctx.timings.startup < ctx.timings.compute
+    assert ctx.timings.copied_bytes == 2 * len("C a\n")
+
+
+def test_shard_telemetry_records(tmp_path: Path):
+    ctx = LigenTaskContext(
+        workdir=tmp_path, container_path=Path("ligen.sif"), telemetry_dir=tmp_path / "telemetry"
+    )
+    with shard_telemetry(ctx, "screening", Path("ligands-1.mol2.gz")) as telemetry:
+        telemetry.timings.compute = 1
+        telemetry.ligands = 10
+    with pytest.raises(Exception):
+        with shard_telemetry(ctx, "screening", Path("ligands-2.mol2")):
+            raise Exception("LiGen crashed")
+
+    paths = sorted((tmp_path / "telemetry").glob("*.jsonl"))
+    assert [p.name for p in paths] == ["screening-ligands-1.jsonl", "screening-ligands-2.jsonl"]
+    records = read_telemetry_records(paths)
+    assert [(r["shard"], r["failed"], r["ligands"]) for r in records] == [
+        ("ligands-1", False, 10),
+        ("ligands-2", True, 0),
+    ]
+
+    [summary] = aggregate_telemetry(records)
+    assert summary.kind == "screening"
+    assert summary.shards == 2
+    assert summary.failed == 1
+    assert summary.ligands == 10
+    assert summary.phases["compute"] == 1
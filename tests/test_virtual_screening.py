@@ -0,0 +1,57 @@
+import dataclasses
+from pathlib import Path
+
+from ligate.awh.ligen.virtual_screening import (
+    RESCORING_SCORE_COLUMN,
+    ScreeningConfig,
+    ScreeningTarget,
+    create_screening_description,
+    ligen_output_scores_csv,
+    pivot_target_scores,
+    screening_score_columns,
+)
+
+
+def test_multi_target_description():
+    config = create_config(Path("scores.csv"), ["a", "b"])
+    description = create_screening_description(
+        config, Path("ligands.mol2"), list(config.targets), Path("scores.csv")
+    )
+    assert [target["name"] for target in description["targets"]] == ["a", "b"]
+
+
+def test_rescore_description():
+    config = dataclasses.replace(create_config(Path("scores.csv"), ["a"]), rescore=True)
+    description = create_screening_description(
+        config, Path("ligands.mol2"), list(config.targets), Path("scores.csv")
+    )
+    writer = description["pipeline"][-1]
+    assert writer["csv_fields"][-1] == RESCORING_SCORE_COLUMN
+    assert description["pipeline"][-3]["kind"] == "d23rtmb_ligand"
+    assert screening_score_columns(config.targets, rescore=True)[-1] == RESCORING_SCORE_COLUMN
+
+
+def test_pivot_target_scores(tmp_path: Path):
+    config = create_config(tmp_path / "scores.csv", ["a", "b"])
+    ligen_output_scores_csv(config).write_text(
+        "NAME,SCORE_PROTEIN_NAME,D22_SCORE\nx,a,1\ny,a,2\nx,b,3\n"
+    )
+    pivot_target_scores(config)
+    assert config.output_scores_csv.read_text().splitlines() == [
+        "NAME,D22_SCORE_a,D22_SCORE_b",
+        "x,1,3",
+        "y,2,",
+    ]
+    assert not ligen_output_scores_csv(config).exists()
+
+
+def create_config(output: Path, targets) -> ScreeningConfig:
+    return ScreeningConfig(
+        targets=tuple(
+            ScreeningTarget(name=name, protein_pdb=Path(f"{name}.pdb"), probe_mol2=Path("p.mol2"))
+            for name in targets
+        ),
+        input_expanded_mol2=Path("ligands.mol2"),
+        output_scores_csv=output,
+        cores=1,
+    )